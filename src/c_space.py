@@ -1,26 +1,281 @@
 """ Function to compute the Configuration Space from obstacle + vehicle polygons. """
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 from scipy.spatial import ConvexHull
 import numpy as np
 from sortedcontainers import SortedDict, SortedList
-from .structures import Polygons, Polygon
+from .structures import Polygons, Polygon, PolygonSet
 from .point_location import PointLocator
+from .sweep import build_point_locator, rebuild_search_structure
 from .line_utils import *
 
-def compute_cspace(obstacle_polygons, vehicle_polygon):
-    """ Computes the configuration space of a set of polygons
+# Fewer obstacles than this are inflated serially even when workers are given
+PARALLEL_MIN_OBSTACLES = 1024
+
+def compute_cspace(obstacle_polygons, vehicle_polygon, workers=None):
+    """ Computes the configuration space of a set of polygons. Enlarged obstacles that overlap are
+        merged into one outline, see Polygons.merge_intersecting.
 
     Args:
         obstacle_polygons (list): A list of (T, 2) numpy arrays with the polygon representation of obstacles.
             polygons must be convex.
         vehicle_polygon (np.ndarray): A (N, 2) array of points representing the (convex) shape of the vehicle.
+        workers (int): inflate the obstacles in this many processes, see parallel_minkowski_sums.
     """
+    obstacles = PolygonSet.from_polygons(obstacle_polygons)
+    if workers is not None and workers > 1 and len(obstacles) >= PARALLEL_MIN_OBSTACLES:
+        enlarged_obstacles = parallel_minkowski_sums(obstacles, vehicle_polygon, workers)
+    else:
+        enlarged_obstacles = minkowski_sums(obstacles, vehicle_polygon)
+    return Polygons(enlarged_obstacles).merge_intersecting()
+
+class RotatedCSpace(object):
+    """ The configuration space of a vehicle at several orientations, one slice per orientation. The
+        obstacle edges are prepared once for all the slices, and the C-space and the point locator
+        of a slice are only built when it is first used."""
+
+    def __init__(self, obstacle_polygons, vehicle_polygon, orientations, bounds, **decomposition_args):
+        """
+        Args:
+            obstacle_polygons (list): the (T, 2) numpy arrays of the (convex) obstacles, or a PolygonSet.
+            vehicle_polygon (np.ndarray): A (N, 2) array of points representing the (convex) shape of the
+                vehicle at angle 0. It is rotated about its center.
+            orientations: the number of evenly spaced angles in [0, 2 * pi), or the angles themselves.
+            bounds: (x_min, y_min, x_max, y_max) the bounds of the point locators.
+            decomposition_args: passed on to trapezoid_decomposition_pl.
+        """
+        if np.ndim(orientations) == 0:
+            orientations = np.arange(orientations) * (2 * np.pi / orientations)
+        self.angles = np.asarray(orientations, dtype=float)
+        self.vehicle_polygon = np.asarray(vehicle_polygon, dtype=float)
+        self.bounds = bounds
+        self.decomposition_args = decomposition_args
+        self.edges = ObstacleEdges(obstacle_polygons)
+        self._cspaces = [None] * len(self.angles)
+        self._locators = [None] * len(self.angles)
+
+    def __len__(self):
+        return len(self.angles)
+
+    def vehicle(self, idx):
+        """Returns the vehicle polygon at orientation idx."""
+        angle = self.angles[idx]
+        rotation = np.array([[np.cos(angle), np.sin(angle)], [-np.sin(angle), np.cos(angle)]])
+        center = self.vehicle_polygon.mean(axis=0)
+        return (self.vehicle_polygon - center).dot(rotation) + center
+
+    def cspace(self, idx):
+        """Returns the merged C-space obstacles of orientation idx like compute_cspace."""
+        if self._cspaces[idx] is None:
+            self._cspaces[idx] = Polygons(minkowski_sums(self.edges, self.vehicle(idx))).merge_intersecting()
+        return self._cspaces[idx]
+
+    def locator(self, idx):
+        """Returns the PointLocator of the C-space of orientation idx."""
+        if self._locators[idx] is None:
+            self._locators[idx] = trapezoid_decomposition_pl(self.cspace(idx), self.bounds, **self.decomposition_args)
+        return self._locators[idx]
+
+    def nearest(self, angle):
+        """Returns the index of the orientation closest to angle."""
+        difference = np.mod(self.angles - angle + np.pi, 2 * np.pi) - np.pi
+        return int(np.argmin(np.abs(difference)))
+
+    def built(self):
+        """Returns the indices of the orientations whose point locator has been built."""
+        return [idx for idx, locator in enumerate(self._locators) if locator is not None]
+
+class IncrementalCSpace(object):
+    """ The C-space of a set of obstacles and its point locator, kept up to date as obstacles move.
+        Each merged outline of compute_cspace has a fixed id, which labels its trapezoids and those
+        along the holes in it. A move
+        re-inflates only the moved obstacles and recomputes only the outlines they leave or touch:
+        the edges of the old outlines are removed from the point locator and the new ones added.
+        Once the search structure grows rebuild_factor times past the depth or size it had after
+        the last full build, it is rebuilt with the plane sweep."""
+
+    def __init__(self, obstacle_polygons, vehicle_polygon, bounds, rng=None, rebuild_factor=2.0):
+        """
+        Args:
+            obstacle_polygons (list): A list of (T, 2) numpy arrays of the (convex) obstacles.
+            vehicle_polygon (np.ndarray): A (N, 2) array of points representing the (convex) shape of the vehicle.
+            bounds: (x_min, y_min, x_max, y_max) the bounds of the point locator.
+            rng: a np.random.Generator or a seed for the edge orders, see Polygons.edge_order.
+            rebuild_factor (float): how far the max depth or node count of the search structure may
+                grow past those of the last full build before move rebuilds it.
+        """
+        self.obstacles = [np.asarray(polygon) for polygon in obstacle_polygons]
+        self.vehicle_polygon = vehicle_polygon
+        self.bounds = bounds
+        self.rng = np.random.default_rng(rng) if rng is not None else None
+        self.inflated = list(minkowski_sums(self.obstacles, vehicle_polygon))
+        # Outline id to the (P, 2) outline followed by the holes in it, and the obstacles in it
+        self.outlines = {}
+        self.members = {}
+        self.owner = np.zeros(len(self.obstacles), dtype=np.int64)
+        self.next_id = 0
+        self.point_locator = PointLocator(bounds)
+        obstacles = list(range(len(self.obstacles)))
+        self.add_outlines(obstacles, *self.merge_outlines(obstacles, self.inflated))
+        self.rebuild_factor = rebuild_factor
+        self.build_stats = self.point_locator.depth_stats()
+
+    def cspace(self):
+        """Returns the merged C-space obstacles, like compute_cspace up to their order."""
+        rings = [ring for outline in self.outlines.values() for ring in outline]
+        return PolygonSet.from_polygons(rings, [i > 0 for outline in self.outlines.values() for i in range(len(outline))])
+
+    def move(self, changes):
+        """ Moves obstacles, and updates the C-space and the point locator to match. The new obstacles
+            are checked against the bounds and merged before anything changes, so a ValueError from
+            them leaves the C-space as it was.
+
+        Args:
+            changes (dict): obstacle index to its new (T, 2) polygon.
 
-    enlarged_obstacles = []
-    for obstacle in obstacle_polygons:
-        enlarged_obstacles.append(minkowski_sum_fast(obstacle, vehicle_polygon))
-    
-    # TODO: merge intersecting polygons into one.
-    return enlarged_obstacles
+        Returns:
+            set: the indices of the trapezoids that were added, removed or replaced. The ones that
+                are None in point_locator.trapezoids now are gone, the others are new.
+        """
+        indices = sorted(changes)
+        moved = dict(zip(indices, minkowski_sums([changes[idx] for idx in indices], self.vehicle_polygon)))
+        lower, upper = np.asarray(self.bounds[:2], dtype=float), np.asarray(self.bounds[2:], dtype=float)
+        for idx, inflated in moved.items():
+            # The point locator cannot hold edges on or past its bounds
+            if (inflated.min(axis=0) <= lower).any() or (inflated.max(axis=0) >= upper).any():
+                raise ValueError("[IncrementalCSpace] Obstacle {} leaves the bounds {}!".format(idx, self.bounds))
+
+        # The outlines the obstacles leave, and the ones the new obstacles may overlap
+        affected = set(int(self.owner[idx]) for idx in indices)
+        ids = np.array(list(self.outlines), dtype=np.int64)
+        boxes = np.array([np.concatenate([outline[0].min(axis=0), outline[0].max(axis=0)])
+                          for outline in self.outlines.values()]).reshape(-1, 4)
+        for inflated in moved.values():
+            low, high = inflated.min(axis=0), inflated.max(axis=0)
+            overlap = (boxes[:, :2] <= high).all(axis=1) & (boxes[:, 2:] >= low).all(axis=1)
+            affected.update(ids[overlap].tolist())
+        obstacles = sorted(set(indices).union(*[self.members[outline_id] for outline_id in affected]))
+        merged = self.merge_outlines(obstacles, {idx: moved.get(idx, self.inflated[idx]) for idx in obstacles})
+
+        for idx in indices:
+            self.obstacles[idx] = np.asarray(changes[idx])
+            self.inflated[idx] = moved[idx]
+        trapezoids = self.point_locator.trapezoids
+        trapezoids.changed = set()
+        for outline_id in affected:
+            del self.members[outline_id]
+            for ring in self.outlines.pop(outline_id):
+                for i in range(len(ring)):
+                    self.point_locator.remove_line(np.array([ring[i], ring[(i + 1) % len(ring)]]), prune=False)
+        # Pruning before the new edges go in frees the nodes only the old ones tested
+        self.point_locator.prune_stale()
+        self.add_outlines(obstacles, *merged)
+        changed, trapezoids.changed = trapezoids.changed, None
+        self.compact()
+        return changed
+
+    def compact(self):
+        """ Rebuilds the search structure of the point locator with rebuild_search_structure once its
+            max depth or node count passes rebuild_factor times the one of the last full build. The
+            trapezoids and their indices stay as they are. Returns whether it was rebuilt.
+
+            The point locator keeps both up to date as lines come and go, its max depth as a bound
+            from above, so the structure is only measured once they pass the factor."""
+        def within(max_depth, nodes):
+            return (max_depth <= self.rebuild_factor * self.build_stats["max_depth"] and
+                    nodes <= self.rebuild_factor * self.build_stats["nodes"])
+
+        if within(self.point_locator.max_depth, self.point_locator.node_count):
+            return False
+        stats = self.point_locator.depth_stats()
+        if within(stats["max_depth"], stats["nodes"]):
+            return False
+        rebuilt = rebuild_search_structure(self.point_locator)
+        # Without a rebuild the current structure is the new baseline, so the next moves do not retry it
+        self.build_stats = self.point_locator.depth_stats()
+        return rebuilt
+
+    def merge_outlines(self, obstacles, inflated):
+        """ Merges the inflated obstacles, without changing anything. Returns the Polygons of the
+            outlines and their holes, and the index in it of the outline around each obstacle.
+
+        Args:
+            obstacles (list): the indices of the obstacles.
+            inflated: obstacle index to its inflated (P, 2) polygon, a list or a dict.
+        """
+        located = Polygons(Polygons([inflated[idx] for idx in obstacles]).merge_intersecting())
+        owners = []
+        for idx in obstacles:
+            # The center of a convex obstacle is inside exactly one outline
+            position = located.polygon_at(inflated[idx].mean(axis=0))
+            if position is None:
+                raise ValueError("[IncrementalCSpace] Obstacle {} is in no outline!".format(idx))
+            owners.append(int(located.polygons.outlines[position]))
+        return located, owners
+
+    def add_outlines(self, obstacles, located, owners):
+        """Gives the outlines of merge_outlines new ids and adds their edges."""
+        rings = located.polygons
+        # The id of each ring, that of the outline a hole is in
+        starts = np.flatnonzero(~rings.holes)
+        ids = self.next_id + np.searchsorted(starts, rings.outlines)
+        self.next_id += len(starts)
+        for start, end in zip(starts, np.append(starts[1:], len(rings))):
+            self.outlines[int(ids[start])] = [rings[i] for i in range(start, end)]
+            self.members[int(ids[start])] = []
+        for idx, owner in zip(obstacles, owners):
+            self.owner[idx] = ids[owner]
+            self.members[int(ids[owner])].append(idx)
+
+        edges, owners, interior_above, order = located.edge_order(self.rng)
+        for i in order:
+            self.point_locator.add_line(edges[i], int(ids[owners[i]]), interior_above[i])
+
+def parallel_minkowski_sums(obstacles, vehicle, workers, chunks_per_worker=4):
+    """ Computes minkowski_sums in a pool of worker processes. The obstacles are split into chunks,
+        and as each inflated obstacle has as many vertices as the obstacle and the vehicle together,
+        every chunk writes its vertices straight into its own rows of one shared memory buffer.
+
+    Args:
+        obstacles (list): (M, 2) numpy arrays of the (convex) obstacles, or a PolygonSet of them.
+        vehicle (np.ndarray): An (N, 2) array of points representing the (convex) shape of the vehicle.
+        workers (int): the number of processes.
+        chunks_per_worker (int): the number of chunks per process, to even out the load.
+
+    Returns:
+        PolygonSet: the inflated obstacles in the order of obstacles.
+    """
+    obstacles = PolygonSet.from_polygons(obstacles)
+    vehicle = np.asarray(vehicle)
+    offsets = np.concatenate([[0], np.cumsum(obstacles.counts + len(vehicle))])
+    bounds = np.unique(np.linspace(0, len(obstacles), workers * chunks_per_worker + 1).astype(int))
+
+    buffer = shared_memory.SharedMemory(create=True, size=max(int(offsets[-1]) * 2 * 8, 1))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_minkowski_chunk, buffer.name, int(offsets[-1]), int(offsets[start]),
+                                       obstacles.vertices[obstacles.offsets[start]:obstacles.offsets[end]],
+                                       obstacles.offsets[start:end + 1] - obstacles.offsets[start], vehicle)
+                       for start, end in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+        vertices = np.ndarray((int(offsets[-1]), 2), dtype=float, buffer=buffer.buf).copy()
+    finally:
+        buffer.close()
+        buffer.unlink()
+    return PolygonSet(vertices, offsets)
+
+def _minkowski_chunk(name, total, start, vertices, offsets, vehicle):
+    """Writes minkowski_sums of the obstacles from vertices and offsets to the rows of the shared
+       (total, 2) buffer name from start on. Runs in the processes of parallel_minkowski_sums."""
+    enlarged = minkowski_sums(PolygonSet(vertices, offsets), vehicle)
+    buffer = shared_memory.SharedMemory(name=name)
+    try:
+        output = np.ndarray((total, 2), dtype=float, buffer=buffer.buf)
+        output[start:start + len(enlarged.vertices)] = enlarged.vertices
+        del output
+    finally:
+        buffer.close()
 
 def trapezoid_decomposition_linear(polygons):
     """
@@ -55,14 +310,74 @@ def trapezoid_decomposition_linear(polygons):
     return vertical_lines
 
 
-def trapezoid_decomposition_pl(polygons, bounds):
+def trapezoid_decomposition_pl(polygons, bounds, sweep=False, depth_factor=None, max_attempts=10, background=False,
+                               rng=None):
     """ Runs polygon decomposition while maintaining the 
-        point location datastructure for O(nlogn) runtime."""
+        point location datastructure for O(nlogn) runtime.
+
+    Args:
+        sweep (bool): build the static map from all the edges at once with a plane sweep, which is
+            deterministic and bounds the query depth, instead of adding the edges in random order.
+        depth_factor (float): if set, an edge order whose search structure gets deeper than
+            depth_factor * log2(n) is thrown away and the edges are added again in a new order.
+            The result has a `build_stats` dict with the depth statistics and the number of attempts.
+        max_attempts (int): the number of orders to try. The last attempt is always kept.
+        background (bool): keep the first build whatever its depth and try the new orders in a
+            background thread. build_stats["rebuild"] is then a Future of the shallower PointLocator,
+            or of None if no order stayed within the limit.
+        rng: a np.random.Generator or a seed for the edge orders, see Polygons.edge_order.
+    """
     polygons = Polygons(polygons)
+    if rng is not None:
+        rng = np.random.default_rng(rng)
+    if sweep:
+        return build_point_locator(polygons.random_edge_sampler(labels=True, rng=rng), bounds, labels=True)
+    if depth_factor is not None:
+        return depth_bounded_decomposition(polygons, bounds, depth_factor, max_attempts, background, rng)
     # print(bounds)
     point_locator = PointLocator(bounds)
-    for edge in polygons.random_edge_sampler():
-        point_locator.add_line(edge)
+    edges, owners, interior_above, order = polygons.edge_order(rng)
+    for i in order:
+        point_locator.add_line(edges[i], owners[i], interior_above[i])
+    return point_locator
+
+def depth_bounded_decomposition(polygons, bounds, depth_factor, max_attempts=10, background=False, rng=None):
+    """ Builds the point locator of the Polygons in random edge orders until the search structure
+        stays within depth_factor * log2(n). See trapezoid_decomposition_pl."""
+    edge_count = len(polygons.polygons.edges)
+    depth_limit = depth_factor * float(np.log2(edge_count + 1))
+
+    def attempt(depth_limit):
+        # Gives up as soon as the structure is deeper than depth_limit
+        point_locator = PointLocator(bounds)
+        edges, owners, interior_above, order = polygons.edge_order(rng)
+        for i in order:
+            point_locator.add_line(edges[i], owners[i], interior_above[i])
+            if point_locator.max_depth > depth_limit:
+                return None, point_locator.max_depth
+        return point_locator, point_locator.max_depth
+
+    def retry(attempts, last_limit):
+        for i in range(len(attempts), max_attempts):
+            point_locator, depth = attempt(depth_limit if i < max_attempts - 1 else last_limit)
+            attempts.append(depth)
+            if point_locator is not None:
+                point_locator.build_stats = dict(point_locator.depth_stats(), depth_limit=depth_limit,
+                                                 attempts=list(attempts), rebuild=None)
+                return point_locator
+        return None
+
+    if not background:
+        return retry([], np.inf)
+
+    point_locator, depth = attempt(np.inf)
+    rebuild = None
+    if depth > depth_limit:
+        executor = ThreadPoolExecutor(max_workers=1)
+        rebuild = executor.submit(retry, [depth], depth_limit)
+        executor.shutdown(wait=False)
+    point_locator.build_stats = dict(point_locator.depth_stats(), depth_limit=depth_limit,
+                                     attempts=[depth], rebuild=rebuild)
     return point_locator
 
 def minkowski_sum(obstacle, vehicle):
@@ -166,3 +481,103 @@ def minkowski_sum_fast(obstacle, vehicle):
     return output_polygon.points - shift
 
 
+
+class ObstacleEdges(object):
+    """ The edges of a PolygonSet of (convex) obstacles made counter-clockwise like
+        Polygon.counterclockwise, with the angles of Polygon.edge_angles. They do not depend on the
+        vehicle, so they are computed once for any number of minkowski_sums."""
+
+    def __init__(self, obstacles):
+        """
+        Args:
+            obstacles (list): (M, 2) numpy arrays of the (convex) obstacles, or a PolygonSet of them.
+        """
+        obstacles = PolygonSet.from_polygons(obstacles)
+        self.obstacles = obstacles
+        counts, starts = obstacles.counts, obstacles.offsets[:-1]
+        owners = obstacles.edge_polygon
+        self.owners = owners
+        if len(obstacles) == 0:
+            return
+
+        # Counter-clockwise like Polygon.counterclockwise is clockwise with y up
+        flip = obstacles.counterclockwise[owners]
+        position = np.arange(len(owners)) - starts[owners]
+        vertices = obstacles.vertices[np.where(flip, starts[owners] + counts[owners] - 1 - position, np.arange(len(owners)))]
+        following = np.arange(1, len(owners) + 1)
+        following[obstacles.offsets[1:] - 1] = starts
+        vectors = vertices[following] - vertices
+
+        # Angles of the outward normals from the y axis as in Polygon.edge_angles
+        centers = np.add.reduceat(vertices, starts) / counts[:, None]
+        normal_vecs = np.stack([-vectors[:, 1], vectors[:, 0]], axis=1)
+        outward = ((normal_vecs * ((vertices + vertices[following]) / 2 - centers[owners])).sum(axis=1) > 0)
+        normal_vecs = np.where(outward[:, None], normal_vecs, -normal_vecs)
+        angles = np.arctan2(normal_vecs[:, 0], normal_vecs[:, 1])
+        angles[angles < 0] += 2 * np.pi
+
+        # The sums start at the first vertex of the smallest angle edge
+        self.first = np.lexsort((angles, owners))[starts]
+        self.start_angles = angles[self.first]
+        self.keys = angles - self.start_angles[owners]
+        self.keys[self.keys < 0] += 2 * np.pi
+        self.keys[self.first] = 0
+        self.vertices = vertices
+        self.vectors = vectors
+        self.top_left = np.lexsort((-vertices[:, 1], vertices[:, 0], owners))[starts]
+
+def minkowski_sums(obstacles, vehicle):
+    """ Computes minkowski_sum_fast of every obstacle at once in O(M log M + N log N) for M obstacle
+        vertices in total. The vehicle edges are sorted by angle once, and the edges of each obstacle
+        are merged with them by sorting on the angle from the first obstacle edge.
+
+    Args:
+        obstacles (list): (M, 2) numpy arrays of the (convex) obstacles, a PolygonSet of them, or
+            their ObstacleEdges to reuse for several vehicles.
+        vehicle (np.ndarray): An (N, 2) array of points representing the (convex) shape of the vehicle.
+
+    Returns:
+        PolygonSet: the inflated obstacles in the order of obstacles.
+    """
+    if not isinstance(obstacles, ObstacleEdges):
+        obstacles = ObstacleEdges(obstacles)
+    edges, obstacles = obstacles, obstacles.obstacles
+    vehicle = -np.asarray(vehicle).astype(np.float32)
+    if len(obstacles) == 0:
+        return obstacles
+
+    # The vehicle edge vectors by angle, and where its top left vertex is from its center
+    vehicle_polygon = Polygon(vehicle)
+    vehicle_polygon.counterclockwise()
+    vehicle_angles, _ = vehicle_polygon.edge_angles()
+    order = np.argsort(vehicle_angles, kind="stable")
+    vehicle_angles = vehicle_angles[order]
+    vehicle_vectors = (vehicle_polygon.edges[:, 1] - vehicle_polygon.edges[:, 0])[order]
+    corner_offset = vehicle_polygon.center - vehicle_polygon.top_left_vertex()
+    counts, owners, vertices = obstacles.counts, edges.owners, edges.vertices
+    first, start_angles, obstacle_keys = edges.first, edges.start_angles, edges.keys
+
+    # Every vehicle edge is inserted after the obstacle edges of the same or smaller angle from the start
+    vehicle_keys = vehicle_angles[None, :] - start_angles[:, None]
+    vehicle_keys[vehicle_keys < 0] += 2 * np.pi
+    polygon_ids = np.concatenate([owners, np.repeat(np.arange(len(obstacles)), len(vehicle_vectors))])
+    keys = np.concatenate([obstacle_keys, vehicle_keys.ravel()])
+    from_vehicle = np.concatenate([np.zeros(len(owners), dtype=bool), np.ones(vehicle_keys.size, dtype=bool)])
+    merged = np.lexsort((from_vehicle, keys, polygon_ids))
+    all_vectors = np.concatenate([edges.vectors, np.tile(vehicle_vectors, (len(obstacles), 1))])[merged]
+
+    # Walk the merged edges from the start vertex, the last step closes the polygon
+    new_counts = counts + len(vehicle_vectors)
+    new_offsets = np.concatenate([[0], np.cumsum(new_counts)])
+    output = np.empty((new_offsets[-1], 2))
+    output[new_offsets[:-1]] = vertices[first]
+    # One step of every polygon at a time, so each polygon is summed alone in order
+    for step in range(1, new_counts.max()):
+        indices = new_offsets[:-1][new_counts > step] + step
+        output[indices] = output[indices - 1] + all_vectors[indices - 1]
+
+    # Align the top left corners like minkowski_sum_fast
+    output_owners = np.repeat(np.arange(len(obstacles)), new_counts)
+    top_left = np.lexsort((-output[:, 1], output[:, 0], output_owners))[new_offsets[:-1]]
+    shift = output[top_left] + corner_offset - vertices[edges.top_left]
+    return PolygonSet(output - shift[output_owners], new_offsets)
@@ -0,0 +1,233 @@
+""" Content-addressed LRU cache of C-space and decomposition results. """
+
+import copy
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+from .c_space import compute_cspace, trapezoid_decomposition_pl
+from .graph import Graph
+from .persistence import save_point_locator, load_point_locator, save_polygons, load_polygons, MappedPointLocator
+from .point_location import PointLocator
+from .structures import PolygonSet
+
+# Rough memory of one Trapezoid object with its vertex arrays, for the size of a PointLocator
+TRAPEZOID_NBYTES = 512
+# Rough memory of one PointQuery or SegmentQuery node of its search structure, about 200 and 350 bytes
+QUERY_NODE_NBYTES = 256
+# The file in a cache directory listing its files in the order they were used, one name per line
+JOURNAL_NAME = "access.journal"
+
+
+def scene_key(obstacle_polygons, vehicle_polygon, *extra):
+    """ Returns the hex digest of the obstacle vertex buffers, the vehicle polygon and the repr of
+        any extra arguments, so equal inputs give equal keys whatever their container or dtype."""
+    obstacles = PolygonSet.from_polygons(obstacle_polygons)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(obstacles.offsets, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(obstacles.vertices, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(vehicle_polygon, dtype=np.float64).tobytes())
+    digest.update(repr(extra).encode())
+    return digest.hexdigest()
+
+
+def decomposition_key(obstacle_polygons, vehicle_polygon, bounds, decomposition_args):
+    """ Returns the scene_key of a decomposition. Its arguments are part of the key by their repr, so
+        rng has to be an int seed or None: a Generator reprs with its address and would never hit."""
+    rng = decomposition_args.get("rng")
+    if rng is not None:
+        if not isinstance(rng, (int, np.integer)):
+            raise ValueError("[ResultCache] Cached decompositions take an int seed as rng, not {}!".format(
+                type(rng).__name__))
+        decomposition_args = dict(decomposition_args, rng=int(rng))
+    return scene_key(obstacle_polygons, vehicle_polygon, list(bounds), sorted(decomposition_args.items()))
+
+
+def result_nbytes(value):
+    """ Returns the memory a cached value takes: the array bytes of polygons and compiled locators,
+        TRAPEZOID_NBYTES per trapezoid object and QUERY_NODE_NBYTES per query node object."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, PolygonSet):
+        return value.vertices.nbytes + value.offsets.nbytes + value.holes.nbytes + value.edges.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(result_nbytes(item) for item in value)
+    if isinstance(value, Graph):
+        # Every interface is under both of its trapezoids
+        interfaces = sum(interface.interface_line.nbytes + interface.center.nbytes
+                         for adjacent in value.interfaces.values() for interface in adjacent.values())
+        return result_nbytes(value.pl) + interfaces // 2
+    if isinstance(value, MappedPointLocator):
+        return value.compiled.nbytes() + sum(arr.nbytes for arr in vars(value.trapezoids).values()
+                                             if isinstance(arr, np.ndarray))
+    if isinstance(value, PointLocator):
+        compiled = value.compiled.nbytes() if value.compiled is not None else 0
+        return (compiled + value.trapezoids.trap_count() * TRAPEZOID_NBYTES +
+                value.node_count * QUERY_NODE_NBYTES)
+    raise ValueError("[ResultCache] Cannot size a {}!".format(type(value).__name__))
+
+
+class ResultCache(object):
+    """ An LRU cache of compute_cspace outputs, point locators and graphs, keyed by scene_key of
+        their inputs. Entries are evicted least recently used first once the cached values take
+        more than max_bytes. With a directory, C-spaces and point locators are also written there
+        and evicted by the size of their files, so they outlive the process; locators come back as
+        memory-mapped MappedPointLocators. Graphs are only kept in memory. The order the files were
+        used in is appended to a journal in the directory, as file times are too coarse to order by.
+
+        Cached values are shared between the callers and must not be changed.
+    """
+
+    def __init__(self, max_bytes=2**28, directory=None, max_disk_bytes=2**32):
+        """
+        Args:
+            max_bytes (int): the most memory the cached values may take, see result_nbytes.
+            directory (str): where to keep the on-disk tier, None for memory only.
+            max_disk_bytes (int): the most bytes the files in directory may take.
+        """
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+        self.files = OrderedDict()
+        self.disk_nbytes = 0
+        self.journal_lines = 0
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # The last use of each file in the journal, files it does not list go first by name
+            used = {}
+            journal = os.path.join(directory, JOURNAL_NAME)
+            if os.path.isfile(journal):
+                with open(journal) as journal_file:
+                    for position, line in enumerate(journal_file):
+                        used[line.strip()] = position
+            names = [name for name in os.listdir(directory) if name.endswith(".plc")]
+            for name in sorted(names, key=lambda name: (used.get(name, -1), name)):
+                self.files[name] = os.path.getsize(os.path.join(directory, name))
+                self.disk_nbytes += self.files[name]
+            self._write_journal()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries or self._file_name(*key) in self.files
+
+    def cspace(self, obstacle_polygons, vehicle_polygon, workers=None):
+        """Returns compute_cspace(obstacle_polygons, vehicle_polygon), computed once per content."""
+        key = ("cspace", scene_key(obstacle_polygons, vehicle_polygon))
+        value = self.get(key)
+        if value is None:
+            value = compute_cspace(obstacle_polygons, vehicle_polygon, workers=workers)
+            self.put(key, value)
+        return value
+
+    def point_locator(self, obstacle_polygons, vehicle_polygon, bounds, **decomposition_args):
+        """ Returns the frozen trapezoid_decomposition_pl of the C-space of the obstacles, built once
+            per content, see decomposition_key."""
+        key = ("locator", decomposition_key(obstacle_polygons, vehicle_polygon, bounds, decomposition_args))
+        value = self.get(key)
+        if value is None:
+            cspace = self.cspace(obstacle_polygons, vehicle_polygon)
+            value = trapezoid_decomposition_pl(cspace, bounds, **decomposition_args)
+            value.freeze()
+            self.put(key, value)
+        return value
+
+    def graph(self, obstacle_polygons, vehicle_polygon, bounds, **decomposition_args):
+        """ Returns the Graph of the free trapezoids of point_locator, built once per content. The
+            occupied trapezoids are removed from a copy, as the cached point locator is shared."""
+        key = ("graph", decomposition_key(obstacle_polygons, vehicle_polygon, bounds, decomposition_args))
+        value = self.get(key)
+        if value is None:
+            point_locator = self.point_locator(obstacle_polygons, vehicle_polygon, bounds, **decomposition_args)
+            if isinstance(point_locator, MappedPointLocator):
+                point_locator = point_locator.thaw()
+                point_locator.freeze()
+            else:
+                point_locator = copy.deepcopy(point_locator)
+            point_locator.remove_occupied_traps()
+            value = Graph(point_locator, bounds[0])
+            self.put(key, value)
+        return value
+
+    def get(self, key):
+        """Returns the value cached under the (kind, digest) key, or None."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return self.entries[key][0]
+        name = self._file_name(*key)
+        if name in self.files:
+            path = os.path.join(self.directory, name)
+            value = load_polygons(path) if key[0] == "cspace" else load_point_locator(path)
+            self.files.move_to_end(name)
+            self._log_use(name)
+            self.stats["disk_hits"] += 1
+            self._remember(key, value)
+            return value
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, value):
+        """Caches value under the (kind, digest) key, and writes it to the directory if it has one."""
+        self._remember(key, value)
+        name = self._file_name(*key)
+        if name is None or name in self.files:
+            return
+        path = os.path.join(self.directory, name)
+        if key[0] == "cspace":
+            save_polygons(value, path + ".tmp")
+        else:
+            save_point_locator(value, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.files[name] = os.path.getsize(path)
+        self.disk_nbytes += self.files[name]
+        self._log_use(name)
+        while self.disk_nbytes > self.max_disk_bytes and len(self.files) > 0:
+            old_name, size = self.files.popitem(last=False)
+            os.remove(os.path.join(self.directory, old_name))
+            self.disk_nbytes -= size
+
+    def clear(self):
+        """Drops the in-memory entries, the files stay."""
+        self.entries.clear()
+        self.nbytes = 0
+
+    def _remember(self, key, value):
+        size = result_nbytes(value)
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (_, old_size) = self.entries.popitem(last=False)
+            self.nbytes -= old_size
+
+    def _log_use(self, name):
+        """Appends a use of the file name to the journal, rewriting it once it is mostly stale lines."""
+        if self.journal_lines > 2 * len(self.files) + 16:
+            self._write_journal()
+            return
+        with open(os.path.join(self.directory, JOURNAL_NAME), "a") as journal_file:
+            journal_file.write(name + "\n")
+        self.journal_lines += 1
+
+    def _write_journal(self):
+        """Rewrites the journal with one line per file, least recently used first."""
+        path = os.path.join(self.directory, JOURNAL_NAME)
+        with open(path + ".tmp", "w") as journal_file:
+            journal_file.writelines(name + "\n" for name in self.files)
+        os.replace(path + ".tmp", path)
+        self.journal_lines = len(self.files)
+
+    def _file_name(self, kind, digest):
+        """The file of a key in the directory, None if it is not kept on disk."""
+        if self.directory is None or kind not in ("cspace", "locator"):
+            return None
+        return "{}-{}.plc".format(kind, digest)
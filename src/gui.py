@@ -124,8 +124,10 @@ class GUI(object):
     def on_minkowski(self):
         self.start_minkowski.configure(bg="grey")
         expanded_polygons = compute_cspace(self.obstacle_polygons, self.vehicle_polygon)
-        for polygon in expanded_polygons:
-            self.canvas.create_polygon(*list(polygon.astype(int).flatten()), tag="expanded_p")
+        # Holes follow the outline they are in, so they are drawn over it
+        for polygon, hole in zip(expanded_polygons, expanded_polygons.holes):
+            self.canvas.create_polygon(*list(polygon.astype(int).flatten()), tag="expanded_p",
+                                       fill="white" if hole else "black")
         self.trap_decomp.configure(bg="PaleGreen3")
         self.start_cspace.configure(bg="PaleGreen3")
         self.show_instruction("To get Step-by-Step decomposition click, Start Trapezoid, otherwise click Start C-Space.")
@@ -135,13 +137,15 @@ class GUI(object):
         self.start_minkowski.configure(bg="grey")
         self.trap_decomp.configure(bg="grey")
         expanded_polygons = compute_cspace(self.obstacle_polygons, self.vehicle_polygon)
-        for polygon in expanded_polygons:
-            self.canvas.create_polygon(*list(polygon.astype(int).flatten()), tag="expanded_p")
+        # Holes follow the outline they are in, so they are drawn over it
+        for polygon, hole in zip(expanded_polygons, expanded_polygons.holes):
+            self.canvas.create_polygon(*list(polygon.astype(int).flatten()), tag="expanded_p",
+                                       fill="white" if hole else "black")
         self.polygons = Polygons(expanded_polygons)
         self.point_locator = PointLocator(self.window_bounds)
-        for edge in self.polygons.random_edge_sampler():
+        for edge, polygon, interior_above in self.polygons.random_edge_sampler(labels=True):
             self.canvas.create_line(*edge.flatten(), tag="trapezoid_line", fill="red")
-            intersecting = self.point_locator.add_line(edge)
+            intersecting = self.point_locator.add_line(edge, polygon, interior_above)
 
             if intersecting:
                 self.show_instruction("Polygons Intersect! Please click Clear to restart.")
@@ -153,7 +157,7 @@ class GUI(object):
             lines = self.point_locator.lines()
             for line in lines:
                 self.canvas.create_line(*line.flatten(), tag="trapezoid_line")
-        self.point_locator.remove_traps_within_polygons(self.polygons)
+        self.point_locator.remove_occupied_traps()
         self.choose_end.configure(bg="PaleGreen3")
         self.show_instruction("Choose a Destination Point.")
 
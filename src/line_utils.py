@@ -22,6 +22,29 @@ def linear_interpolation(edge, x):
         assert(edge[0][1] == edge[1][1])
         return edge[0][1]
 
+def line_fit(edge):
+    """Returns the (slope, intercept, x_min, x_max) of a left-to-right edge for fit_interpolation, with
+       the bounds tolerance of linear_interpolation. Vertical edges get a zero slope."""
+    x0, y0 = float(edge[0][0]), float(edge[0][1])
+    x1, y1 = float(edge[1][0]), float(edge[1][1])
+    m = (y0 - y1) / (x0 - x1) if x0 != x1 else 0.0
+    return (m, y0 - m * x0, x0 - 0.000001, x1 + 0.0000001)
+
+def fit_interpolation(fit, x):
+    """Same as linear_interpolation of the edge, from its line_fit with a single multiply-add."""
+    m, b, x_min, x_max = fit
+    if x < x_min or x > x_max:
+        return -1000000000
+    return m * x + b
+
+def endpoint_interpolation(edge, x):
+    """Like linear_interpolation, but gives the exact y of the endpoints at their x coordinates."""
+    if x == edge[0, 0]:
+        return edge[0, 1]
+    if x == edge[1, 0]:
+        return edge[1, 1]
+    return linear_interpolation(edge, x)
+
 def make_lr(edge):
     """Makes and edge so that the left point is first."""
     if len(edge) == 1:
@@ -40,4 +63,38 @@ def point_on_edge(edge, point):
         y_val = linear_interpolation(edge, point[0])
         return np.allclose(y_val, point[1])
     else:
-        return point[1] <= np.max(edge[:, 1]) and point[1] >= np.min(edge[:, 1])
\ No newline at end of file
+        return point[1] <= np.max(edge[:, 1]) and point[1] >= np.min(edge[:, 1])
+
+def slopes(edges):
+    """Batched slope of the (..., 2, 2) edges, nan for vertical edges."""
+    dx = edges[..., 0, 0] - edges[..., 1, 0]
+    return np.where(dx != 0, (edges[..., 0, 1] - edges[..., 1, 1]) / np.where(dx != 0, dx, 1), np.nan)
+
+def interpolate_edges(edges, x):
+    """Batched linear_interpolation of the (..., 2, 2) left-to-right edges at the x values broadcast
+       against them. Returns the y values and the mask of the x values within the segment bounds,
+       which is where linear_interpolation does not return its sentinel. Vertical edges give their
+       first y."""
+    x0, y0 = edges[..., 0, 0], edges[..., 0, 1]
+    x1, y1 = edges[..., 1, 0], edges[..., 1, 1]
+    dx = x0 - x1
+    m = (y0 - y1) / np.where(dx != 0, dx, np.inf)
+    in_range = (x >= x0 - 0.000001) & (x <= x1 + 0.0000001)
+    return m * x + (y0 - m * x0), in_range
+
+def make_lr_many(edges):
+    """Batched make_lr of the (..., 2, 2) edges."""
+    flip = edges[..., 0, 0] > edges[..., 1, 0]
+    return np.where(flip[..., None, None], edges[..., ::-1, :], edges)
+
+def normals(edges):
+    """Batched normal of the (..., 2, 2) edges."""
+    return np.stack([edges[..., 0, 1] - edges[..., 1, 1], edges[..., 1, 0] - edges[..., 0, 0]], axis=-1)
+
+def points_on_edges(edges, points):
+    """Batched point_on_edge of the (..., 2, 2) left-to-right edges and the (..., 2) points broadcast
+       against them."""
+    y, in_range = interpolate_edges(edges, points[..., 0])
+    on_sloped = in_range & np.isclose(y, points[..., 1])
+    on_vertical = (points[..., 1] <= edges[..., :, 1].max(axis=-1)) & (points[..., 1] >= edges[..., :, 1].min(axis=-1))
+    return np.where(edges[..., 0, 0] < edges[..., 1, 0], on_sloped, on_vertical)
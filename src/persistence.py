@@ -0,0 +1,351 @@
+""" Saving and memory-mapped loading of built point locators. """
+
+import json
+import numpy as np
+from sortedcontainers import SortedDict
+from .point_location import *
+from .structures import Polygons, PolygonSet
+
+# File layout: magic, little-endian uint64 header length, JSON header, then the
+# raw arrays each aligned to ALIGNMENT bytes so they can be viewed straight from the mapping.
+MAGIC = b"PLMAP001"
+SCENE_MAGIC = b"PLSCN001"
+POLYGONS_MAGIC = b"PLPLY001"
+ALIGNMENT = 64
+
+
+def save_point_locator(point_locator, path):
+    """ Writes a built PointLocator and its trapezoids to path."""
+    compiled = point_locator.compiled
+    if compiled is None:
+        compiled = CompiledLocator.compile(point_locator.tree_root)
+    arrays = {"node_" + name: arr for name, arr in compiled.arrays().items()}
+    arrays.update(_trapezoid_arrays(point_locator.trapezoids))
+    arrays["bounds"] = np.array(point_locator.bounds, dtype=float)
+    arrays["edge_history"] = np.array(point_locator.edge_history, dtype=float).reshape(-1, 2, 2)
+    arrays["segments"] = np.array(list(point_locator.segments.values()), dtype=float).reshape(-1, 2, 2)
+    arrays["segment_counts"] = np.array([point_locator.segment_count[key] for key in point_locator.segments],
+                                        dtype=np.int64)
+    _write_arrays(path, arrays)
+
+
+def load_point_locator(path, mmap=True):
+    """ Opens a file written by save_point_locator as a MappedPointLocator.
+
+    Args:
+        path (str): the file to open.
+        mmap (bool): map the arrays read-only instead of reading them into memory, so that
+            processes opening the same file share its pages.
+    """
+    arrays = _read_arrays(path, mmap)
+    node_arrays = {}
+    for name, arr in arrays.items():
+        if name.startswith("node_"):
+            node_arrays[name[len("node_"):]] = arr
+    compiled = CompiledLocator(**node_arrays)
+    return MappedPointLocator(compiled, MappedTrapezoids(arrays), arrays["bounds"].tolist(),
+                              arrays["edge_history"], arrays["segments"], arrays.get("segment_counts"))
+
+
+def save_random_scene(path, bounds, num_vertices, rng, max_polygon_vertices=8, chunk_polygons=2**16):
+    """ Writes the polygons of Polygons.random_scene to path chunk by chunk, so the whole scene is
+        never in memory. Returns the number of polygons."""
+    counts, chunks = Polygons.random_scene(bounds, num_vertices, rng, max_polygon_vertices, chunk_polygons)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    _write_arrays(path, {"bounds": np.array(bounds, dtype=float), "offsets": offsets,
+                         "vertices": _Streamed(np.float64, (int(offsets[-1]), 2), chunks)}, SCENE_MAGIC)
+    return len(counts)
+
+
+def load_scene(path, mmap=True):
+    """ Opens a file written by save_random_scene. Returns the bounds and the PolygonSet of the
+        polygons, over the mapped vertices if mmap."""
+    arrays = _read_arrays(path, mmap, SCENE_MAGIC, "scene")
+    return arrays["bounds"].tolist(), PolygonSet(arrays["vertices"], arrays["offsets"])
+
+
+def save_polygons(polygons, path):
+    """ Writes a list of (P, 2) polygons, or a PolygonSet, to path."""
+    polygons = PolygonSet.from_polygons(polygons)
+    _write_arrays(path, {"offsets": polygons.offsets, "vertices": polygons.vertices, "holes": polygons.holes},
+                  POLYGONS_MAGIC)
+
+
+def load_polygons(path, mmap=True):
+    """ Opens a file written by save_polygons as a PolygonSet, over the mapped vertices if mmap."""
+    arrays = _read_arrays(path, mmap, POLYGONS_MAGIC, "polygons")
+    # Files from before holes were kept have none
+    return PolygonSet(arrays["vertices"], arrays["offsets"], arrays.get("holes"))
+
+
+def _trapezoid_arrays(trapezoids):
+    """ Flattens the trapezoids into CSR vertex and originator arrays plus the by_left_x adjacency."""
+    count = len(trapezoids.trapezoids)
+    alive = np.zeros(count, dtype=bool)
+    vertex_offsets = np.zeros(count + 1, dtype=np.int64)
+    originator_offsets = np.zeros(count + 1, dtype=np.int64)
+    top = np.zeros((count, 2, 2))
+    bottom = np.zeros((count, 2, 2))
+    occupants = np.full((count, 2), -1, dtype=np.int64)
+    vertices = []
+    originators = []
+    for i, trap in enumerate(trapezoids.trapezoids):
+        vertex_offsets[i + 1] = vertex_offsets[i]
+        originator_offsets[i + 1] = originator_offsets[i]
+        if trap is None:
+            continue
+        alive[i] = True
+        vertices.append(trap.raw())
+        vertex_offsets[i + 1] += len(trap.raw())
+        if len(trap.originators) > 0:
+            originators.append(trap.originators)
+            originator_offsets[i + 1] += len(trap.originators)
+        top[i] = trap.top()
+        bottom[i] = trap.bottom()
+        occupants[i] = (trap.top_occupant, trap.bottom_occupant)
+
+    adjacency = []
+    for x, choices in trapezoids.by_left_x.items():
+        for bottom_y, trap in choices.items():
+            adjacency.append((x, bottom_y, trap.index))
+    adjacency.sort()
+    adjacency = np.array(adjacency, dtype=float).reshape(-1, 3)
+
+    return {"trap_alive": alive,
+            "trap_vertex_offsets": vertex_offsets,
+            "trap_vertices": np.concatenate(vertices + [np.zeros((0, 2))], axis=0).astype(float),
+            "trap_originator_offsets": originator_offsets,
+            "trap_originators": np.concatenate(originators + [np.zeros((0, 2))], axis=0).astype(float),
+            "trap_top": top,
+            "trap_bottom": bottom,
+            "trap_occupants": occupants,
+            "adjacent_x": adjacency[:, 0].copy(),
+            "adjacent_y": adjacency[:, 1].copy(),
+            "adjacent_trap": adjacency[:, 2].astype(np.int64)}
+
+
+class _Streamed(object):
+    """ An array for _write_arrays that is written as its chunks come, of the dtype and shape it will have."""
+
+    def __init__(self, dtype, shape, chunks):
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.chunks = chunks
+
+
+def _write_arrays(path, arrays, magic=MAGIC):
+    """ Writes the named arrays (or _Streamed arrays) in the aligned raw layout."""
+    entries = {}
+    offset = 0
+    for name, arr in arrays.items():
+        if not isinstance(arr, _Streamed):
+            arr = np.ascontiguousarray(arr)
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        entries[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset += arr.nbytes
+    header = json.dumps(entries).encode("utf-8")
+    data_start = -(-(len(magic) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    with open(path, "wb") as f:
+        f.write(magic)
+        f.write(np.array(len(header), dtype="<u8").tobytes())
+        f.write(header)
+        for name, arr in arrays.items():
+            f.seek(data_start + entries[name]["offset"])
+            if not isinstance(arr, _Streamed):
+                f.write(np.ascontiguousarray(arr).tobytes())
+                continue
+            written = 0
+            for chunk in arr.chunks:
+                chunk = np.ascontiguousarray(chunk, dtype=arr.dtype)
+                f.write(chunk.tobytes())
+                written += chunk.nbytes
+            if written != arr.nbytes:
+                raise ValueError("[persistence] {} has {} bytes instead of {}!".format(name, written, arr.nbytes))
+        f.truncate(data_start + offset)
+
+
+def _read_arrays(path, mmap, magic=MAGIC, kind="point locator"):
+    """ Reads the named arrays written by _write_arrays."""
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("[persistence] {} is not a {} file!".format(path, kind))
+        header_length = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+        entries = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = -(-(len(magic) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+    if mmap:
+        buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    else:
+        buffer = np.fromfile(path, dtype=np.uint8)
+
+    arrays = {}
+    for name, entry in entries.items():
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        start = data_start + entry["offset"]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        arrays[name] = buffer[start:start + nbytes].view(dtype).reshape(shape)
+    return arrays
+
+
+class MappedTrapezoids(object):
+    """ A read-only Trapezoids over the saved arrays. Trapezoid objects are only made when accessed."""
+
+    def __init__(self, arrays):
+        self.alive = arrays["trap_alive"]
+        self.vertex_offsets = arrays["trap_vertex_offsets"]
+        self.vertices = arrays["trap_vertices"]
+        self.originator_offsets = arrays["trap_originator_offsets"]
+        self.originators = arrays["trap_originators"]
+        self.top_lines = arrays["trap_top"]
+        self.bottom_lines = arrays["trap_bottom"]
+        self.occupants = arrays["trap_occupants"]
+        self.adjacent_x = arrays["adjacent_x"]
+        self.adjacent_y = arrays["adjacent_y"]
+        self.adjacent_trap = arrays["adjacent_trap"]
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.alive)
+
+    def __getitem__(self, idx):
+        if not self.alive[idx]:
+            return None
+        if idx not in self.cache:
+            self.cache[idx] = self.make_trapezoid(idx)
+        return self.cache[idx]
+
+    def make_trapezoid(self, idx):
+        """Builds the Trapezoid object at idx from the arrays."""
+        vertices = np.array(self.vertices[self.vertex_offsets[idx]:self.vertex_offsets[idx + 1]])
+        originators = np.array(self.originators[self.originator_offsets[idx]:self.originator_offsets[idx + 1]])
+        # The saved lines, the vertices alone do not always tell the top and bottom lines apart
+        trap = Trapezoid.from_lines(vertices, np.array(self.top_lines[idx]), np.array(self.bottom_lines[idx]),
+                                    list(originators), tuple(int(occupant) for occupant in self.occupants[idx]))
+        trap.set_idx(int(idx))
+        return trap
+
+    def trap_list(self):
+        """Returns all the trapezoids in point form."""
+        traps = []
+        for idx in np.flatnonzero(self.alive):
+            traps.append(np.array(self.vertices[self.vertex_offsets[idx]:self.vertex_offsets[idx + 1]]))
+        return traps
+
+    def trap_count(self):
+        """Return the number of trapezoids in the list."""
+        return int(np.count_nonzero(self.alive))
+
+    def right_adjacent_to(self, x):
+        """Return the dictionary of all trapezoids right of the provided x coordinate."""
+        start = np.searchsorted(self.adjacent_x, x, side="left")
+        end = np.searchsorted(self.adjacent_x, x, side="right")
+        return SortedDict([(self.adjacent_y[i], self[int(self.adjacent_trap[i])]) for i in range(start, end)])
+
+    def right_adjacent(self, index):
+        """Returns all trapezoids that share the right edge with the trapezoid at index."""
+        top = self.top_lines[index]
+        bottom = self.bottom_lines[index]
+        start = np.searchsorted(self.adjacent_x, top[1, 0], side="left")
+        end = np.searchsorted(self.adjacent_x, top[1, 0], side="right")
+        if start == end:
+            return []
+        # First bottom line below the top line
+        idx = start + np.searchsorted(self.adjacent_y[start:end], top[1, 1], side="left")
+        if idx == end:
+            idx -= 1
+
+        right_adjacent = []
+        while idx >= start:
+            curr = self.adjacent_trap[idx]
+            if bottom[1, 1] > self.top_lines[curr, 0, 1]:
+                break
+            if top[1, 1] >= self.bottom_lines[curr, 0, 1]:
+                right_adjacent.append(int(curr))
+            idx -= 1
+        return right_adjacent
+
+    def to_trapezoids(self, compact=False):
+        """Builds a mutable Trapezoids with the same indices."""
+        trapezoids = Trapezoids(compact)
+        holes = []
+        for idx in range(len(self)):
+            if self.alive[idx]:
+                trapezoids.add(self.make_trapezoid(idx))
+            else:
+                trapezoids.trapezoids.append(None)
+                holes.append(idx)
+        trapezoids.to_remove = holes
+        return trapezoids
+
+
+class MappedPointLocator(object):
+    """ A read-only point locator backed by the arrays of a saved file."""
+
+    def __init__(self, compiled, trapezoids, bounds, edge_history, segments, segment_counts=None):
+        """
+        Args:
+            compiled (CompiledLocator): the search structure.
+            trapezoids (MappedTrapezoids): the trapezoids the search structure points to.
+            bounds: (x_min, y_min, x_max, y_max) the bounds in which the polygons reside.
+            edge_history (np.ndarray): (H, 2, 2) the edges added to the saved locator.
+            segments (np.ndarray): (S, 2, 2) the edges still in the saved locator.
+            segment_counts (np.ndarray): (S,) how many times each of segments was added, None for
+                once each.
+        """
+        self.compiled = compiled
+        self.trapezoids = trapezoids
+        self.bounds = bounds
+        self.edge_history = edge_history
+        self.segments = segments
+        self.segment_counts = segment_counts
+        self.grid = None
+
+    def add_grid(self, resolution=256, max_bytes=2**24):
+        """ Puts a QueryGrid over the bounds in front of the search structure. Returns the grid."""
+        self.grid = QueryGrid(self.compiled, self.bounds, resolution, max_bytes)
+        return self.grid
+
+    def query(self, p):
+        """ Queries for the point p in self. Returns the index of the trapezoid containing p."""
+        trap_idx = (self.compiled if self.grid is None else self.grid).query(p)
+        if trap_idx == FAILURE_INDEX:
+            raise ValueError("[PointLocator] Obstacles out of bounds!")
+        return trap_idx
+
+    def query_many(self, points):
+        """ Queries for all the points in the (N, 2) array points at once."""
+        return (self.compiled if self.grid is None else self.grid).query_many(points)
+
+    def traps(self):
+        """ Returns a list of trapezoids that are in the data structure."""
+        return self.trapezoids.trap_list()
+
+    def lines(self):
+        """ Returns a list of all the lines in the point locator object for easy visualization."""
+        lines = []
+        for trapezoid in self.traps():
+            for idx in range(len(trapezoid)):
+                lines.append(np.array([trapezoid[idx], trapezoid[(idx + 1) % len(trapezoid)]]))
+        return lines
+
+    def thaw(self, compact=False):
+        """ Rebuilds a mutable PointLocator that lines can be added to. Its trapezoids are kept in a
+            TrapezoidStore if compact."""
+        point_locator = PointLocator(self.bounds, compact)
+        point_locator.trapezoids = self.trapezoids.to_trapezoids(compact)
+        point_locator.tree_root, parents = self.compiled.to_dag()
+        for trap_idx, trap_parents in parents.items():
+            point_locator.trapezoids[trap_idx].add_parent(trap_parents)
+        point_locator.edge_history = list(np.array(self.edge_history))
+        # The live segments are the arrays of their nodes, see PointLocator.prune
+        node_edges = {segment_key(node.x): node.x for node in point_locator.query_nodes()
+                      if isinstance(node, SegmentQuery)}
+        counts = np.ones(len(self.segments), dtype=np.int64) if self.segment_counts is None else self.segment_counts
+        for edge, count in zip(np.array(self.segments), counts):
+            for _ in range(int(count)):
+                point_locator.track_segment(node_edges.get(segment_key(edge), edge), 1)
+        point_locator.depth_stats()
+        return point_locator
@@ -1,10 +1,25 @@
 """A Class holding all the relevant classes for point location."""
 
 import numpy as np
+from collections import defaultdict
 from sortedcontainers import SortedDict
 from .line_utils import *
 from trapezoids import * 
 
+# Index returned by batch queries for points routed to the "failure" branch
+FAILURE_INDEX = -1
+# remove_line prunes the search structure once the nodes changed by removals since the last
+# prune are this share of all the nodes
+PRUNE_FRACTION = 0.25
+
+def segment_key(edge):
+    """Returns a hashable key for a left-to-right edge."""
+    return tuple(float(v) for v in np.ravel(edge))
+
+def point_key(point):
+    """Returns a hashable key for a point."""
+    return (float(point[0]), float(point[1]))
+
 class Query(object):
     """ Base class for point location query nodes."""
     def __init__(self, x, true_child, false_child):
@@ -17,9 +32,15 @@ class Query(object):
         self.x = x
         self.true_child = true_child
         self.false_child = false_child
+        # Length of the longest search path ending at this node
+        self.depth = 1
     
     def __call__(self, point):
         raise NotImplementedError("[Query] __call__ must be implemented in child class.")
+
+    def evaluate(self, points):
+        """Returns a boolean mask over the (N, 2) points which is true where a point goes to the true child."""
+        raise NotImplementedError("[Query] evaluate must be implemented in child class.")
     
     def set_value(self, node):
         """Set the value of the `None` child to the node."""
@@ -42,33 +63,365 @@ class PointQuery(Query):
             return self.true_child
         return self.false_child
 
+    def evaluate(self, points):
+        return points[:, 0] <= self.x
+
 class SegmentQuery(Query):
     """ A segment query object, differentiates between top and bottom."""
+    def __init__(self, x, true_child, false_child):
+        super(SegmentQuery, self).__init__(x, true_child, false_child)
+        # Slope, intercept and x bounds of the edge, so a visit is a single multiply-add
+        self.fit = line_fit(x)
+
     def __call__(self, point):
-        y = linear_interpolation(self.x, point[0])
+        y = fit_interpolation(self.fit, point[0])
         if point[1] > y:
             return self.true_child
         return self.false_child
 
+    def evaluate(self, points):
+        # Same arithmetic and bounds tolerance as linear_interpolation, over all points at once
+        m, b, x_min, x_max = self.fit
+        y = m * points[:, 0] + b
+        y[(points[:, 0] < x_min) | (points[:, 0] > x_max)] = -1000000000
+        return points[:, 1] > y
+
+class CompiledLocator(object):
+    """ The point location search structure compiled into flat arrays, for read-only maps.
+
+    Node 0 is the root. Point nodes split on `split`, segment nodes hold the slope, intercept and
+    x bounds of their edge, and leaf nodes hold the trapezoid index (or FAILURE_INDEX).
+    """
+    POINT = 0
+    SEGMENT = 1
+    LEAF = 2
+
+    def __init__(self, kind, split, slope, intercept, x_min, x_max, true_child, false_child, leaf,
+                 edge_index=None, edges=None):
+        """
+        Args:
+            kind (np.ndarray): (M,) node kinds, one of POINT, SEGMENT or LEAF.
+            split (np.ndarray): (M,) x coordinate of the point nodes.
+            slope (np.ndarray): (M,) slope of the segment nodes.
+            intercept (np.ndarray): (M,) y intercept of the segment nodes.
+            x_min (np.ndarray): (M,) x below which a point is out of the segment bounds.
+            x_max (np.ndarray): (M,) x above which a point is out of the segment bounds.
+            true_child (np.ndarray): (M,) node to go to if evaluated as true.
+            false_child (np.ndarray): (M,) node to go to if evaluated as false.
+            leaf (np.ndarray): (M,) trapezoid index of the leaf nodes.
+            edge_index (np.ndarray): (M,) index into edges of the segment nodes, -1 for other nodes.
+            edges (np.ndarray): (E, 2, 2) the distinct edges of the segment nodes.
+        """
+        self.kind = kind
+        self.split = split
+        self.slope = slope
+        self.intercept = intercept
+        self.x_min = x_min
+        self.x_max = x_max
+        self.true_child = true_child
+        self.false_child = false_child
+        self.leaf = leaf
+        self.edge_index = edge_index
+        self.edges = edges
+        # The node arrays as Python lists, for the scalar walk of query, made on its first call
+        self.node_lists = None
+
+    @staticmethod
+    def compile(tree_root):
+        """Flattens the search DAG rooted at tree_root."""
+        # Number the nodes breadth first, sharing a single leaf node per trapezoid
+        node_ids = {id(tree_root): 0}
+        nodes = [tree_root]
+        for node in nodes:
+            if not isinstance(node, Query):
+                continue
+            for child in (node.true_child, node.false_child):
+                if child is None:
+                    raise ValueError("[CompiledLocator] Query has an unfilled child!")
+                key = child if isinstance(child, (int, str)) else id(child)
+                if key not in node_ids:
+                    node_ids[key] = len(nodes)
+                    nodes.append(child)
+
+        count = len(nodes)
+        kind = np.full(count, CompiledLocator.LEAF, dtype=np.int8)
+        split = np.zeros(count)
+        slopes = np.zeros(count)
+        intercept = np.zeros(count)
+        x_min = np.zeros(count)
+        x_max = np.zeros(count)
+        true_child = np.zeros(count, dtype=np.int32)
+        false_child = np.zeros(count, dtype=np.int32)
+        leaf = np.full(count, FAILURE_INDEX, dtype=np.int32)
+        edge_index = np.full(count, -1, dtype=np.int32)
+        # Segment nodes made by the same add_line share their edge array
+        edge_ids = {}
+        edges = []
+        for i, node in enumerate(nodes):
+            if isinstance(node, PointQuery):
+                kind[i] = CompiledLocator.POINT
+                split[i] = node.x
+            elif isinstance(node, SegmentQuery):
+                edge = node.x
+                kind[i] = CompiledLocator.SEGMENT
+                slopes[i], intercept[i], x_min[i], x_max[i] = node.fit
+                if id(edge) not in edge_ids:
+                    edge_ids[id(edge)] = len(edges)
+                    edges.append(edge)
+                edge_index[i] = edge_ids[id(edge)]
+            elif isinstance(node, int):
+                leaf[i] = node
+                continue
+            else:
+                continue
+            for child, children in ((node.true_child, true_child), (node.false_child, false_child)):
+                children[i] = node_ids[child if isinstance(child, (int, str)) else id(child)]
+        edges = np.array(edges, dtype=float).reshape(-1, 2, 2)
+        return CompiledLocator(kind, split, slopes, intercept, x_min, x_max, true_child, false_child, leaf,
+                               edge_index, edges)
+
+    def node_count(self):
+        """Returns the number of nodes, leaves included."""
+        return len(self.kind)
+
+    def nbytes(self):
+        """Returns the memory used by the node arrays."""
+        return sum(arr.nbytes for arr in self.arrays().values())
+
+    def arrays(self):
+        """Returns the node arrays by name."""
+        arrays = {"kind": self.kind, "split": self.split, "slope": self.slope, "intercept": self.intercept,
+                  "x_min": self.x_min, "x_max": self.x_max, "true_child": self.true_child,
+                  "false_child": self.false_child, "leaf": self.leaf}
+        if self.edges is not None:
+            arrays["edge_index"] = self.edge_index
+            arrays["edges"] = self.edges
+        return arrays
+
+    def to_dag(self):
+        """Rebuilds the Query nodes. Returns the root and a dict of trapezoid index to parent nodes.
+           Needs the edges of the segment nodes."""
+        if self.edges is None:
+            raise ValueError("[CompiledLocator] Segment edges were not kept!")
+        # One array per edge, shared by its segment nodes as after add_line
+        edges = [np.array(edge) for edge in self.edges]
+        queries = {}
+        for i in range(len(self.kind)):
+            if self.kind[i] == CompiledLocator.POINT:
+                queries[i] = PointQuery(float(self.split[i]), None, None)
+            elif self.kind[i] == CompiledLocator.SEGMENT:
+                queries[i] = SegmentQuery(edges[self.edge_index[i]], None, None)
+
+        parents = {}
+        for i, query in queries.items():
+            for child in (self.true_child[i], self.false_child[i]):
+                if child in queries:
+                    query.set_value(queries[child])
+                elif self.leaf[child] == FAILURE_INDEX:
+                    query.set_value("failure")
+                else:
+                    trap_idx = int(self.leaf[child])
+                    query.set_value(trap_idx)
+                    parents.setdefault(trap_idx, []).append(query)
+        return queries[0], parents
+
+    def query(self, p, node=0):
+        """Returns the index of the trapezoid containing p, or FAILURE_INDEX. The walk starts at node,
+           which has to be on the path of p."""
+        return self.walk(float(p[0]), float(p[1]), int(node))
+
+    def walk(self, x, y, node):
+        """query for the float coordinates x and y, from the int node."""
+        # Indexing lists gives Python numbers, where indexing the arrays would box each value
+        if self.node_lists is None:
+            self.node_lists = tuple(arr.tolist() for arr in (self.kind, self.split, self.slope, self.intercept,
+                                                             self.x_min, self.x_max, self.true_child,
+                                                             self.false_child, self.leaf))
+        kinds, split, slope, intercept, x_min, x_max, true_child, false_child, leaf = self.node_lists
+        point_kind, leaf_kind = CompiledLocator.POINT, CompiledLocator.LEAF
+        kind = kinds[node]
+        while kind != leaf_kind:
+            if kind == point_kind:
+                go_true = x <= split[node]
+            elif x < x_min[node] or x > x_max[node]:
+                go_true = y > -1000000000
+            else:
+                go_true = y > slope[node] * x + intercept[node]
+            node = true_child[node] if go_true else false_child[node]
+            kind = kinds[node]
+        return leaf[node]
+
+    def query_many(self, points, nodes=None):
+        """Returns the trapezoid index of each point in the (N, 2) array, or FAILURE_INDEX.
+           All points advance one level of the structure per step, from the root or the (N,) nodes."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if nodes is None:
+            nodes = np.zeros(len(points), dtype=np.int32)
+        else:
+            nodes = np.array(nodes, dtype=np.int32)
+        active = np.arange(len(points))
+        while len(active) > 0:
+            curr = nodes[active]
+            not_leaf = self.kind[curr] != CompiledLocator.LEAF
+            active = active[not_leaf]
+            curr = curr[not_leaf]
+            x = points[active, 0]
+            y = self.slope[curr] * x + self.intercept[curr]
+            y[(x < self.x_min[curr]) | (x > self.x_max[curr])] = -1000000000
+            go_true = np.where(self.kind[curr] == CompiledLocator.POINT, x <= self.split[curr], points[active, 1] > y)
+            nodes[active] = np.where(go_true, self.true_child[curr], self.false_child[curr])
+        return self.leaf[nodes].astype(int)
+
+
+class QueryGrid(object):
+    """ A uniform grid over the bounds in front of a CompiledLocator.
+
+    Each cell keeps the deepest node every point of the cell passes through: a leaf when the cell lies
+    entirely in one trapezoid, so its points are answered with one lookup, else the node where the
+    points of the cell part ways, from which their walk starts. Points outside the bounds start at the
+    root.
+    """
+
+    def __init__(self, compiled, bounds, resolution=256, max_bytes=2**24):
+        """
+        Args:
+            compiled (CompiledLocator): the search structure to start the walks in.
+            bounds: (x_min, y_min, x_max, y_max) the area the grid covers.
+            resolution (int or tuple): the number of cells along x and y, or along both.
+            max_bytes (int): the most memory the cells may take, the resolution is lowered to fit.
+        """
+        nx, ny = (resolution, resolution) if np.isscalar(resolution) else resolution
+        # One int32 start node per cell
+        max_cells = max_bytes // 4
+        if nx * ny > max_cells:
+            scale = np.sqrt(float(max_cells) / (nx * ny))
+            nx, ny = max(1, int(nx * scale)), max(1, int(ny * scale))
+        self.compiled = compiled
+        self.bounds = bounds
+        self.shape = (ny, nx)
+        self.start = self.build(compiled, bounds, nx, ny)
+        # The bounds, the cells per unit along x and y and the last cell along each, for query
+        min_x, min_y, max_x, max_y = [float(bound) for bound in bounds]
+        self.cell_lookup = (min_x, min_y, max_x, max_y, nx / (max_x - min_x), ny / (max_y - min_y), nx - 1, ny - 1)
+
+    @staticmethod
+    def build(compiled, bounds, nx, ny):
+        """Returns the (ny, nx) start node of each cell, walking all cells down the structure at once."""
+        min_x, min_y, max_x, max_y = bounds
+        xs = np.linspace(min_x, max_x, nx + 1)
+        ys = np.linspace(min_y, max_y, ny + 1)
+        # Widened so that rounding in the cell lookup cannot put a point outside its cell
+        pad_x = 10**-6 * (xs[1] - xs[0])
+        pad_y = 10**-6 * (ys[1] - ys[0])
+        cell_y, cell_x = np.divmod(np.arange(nx * ny), nx)
+        x0, x1 = xs[cell_x] - pad_x, xs[cell_x + 1] + pad_x
+        y0, y1 = ys[cell_y] - pad_y, ys[cell_y + 1] + pad_y
+
+        nodes = np.zeros(nx * ny, dtype=np.int32)
+        active = np.arange(nx * ny)
+        while len(active) > 0:
+            curr = nodes[active]
+            kind = compiled.kind[curr]
+            not_leaf = kind != CompiledLocator.LEAF
+            active, curr, kind = active[not_leaf], curr[not_leaf], kind[not_leaf]
+            a_x0, a_x1, a_y0, a_y1 = x0[active], x1[active], y0[active], y1[active]
+
+            # 1 if the whole cell goes to the true child, 0 to the false child, -1 if it is split
+            go = np.full(len(active), -1, dtype=np.int8)
+            split = compiled.split[curr]
+            is_point = kind == CompiledLocator.POINT
+            go[is_point & (a_x1 <= split)] = 1
+            go[is_point & (a_x0 > split)] = 0
+
+            x_min, x_max = compiled.x_min[curr], compiled.x_max[curr]
+            y_start = compiled.slope[curr] * a_x0 + compiled.intercept[curr]
+            y_end = compiled.slope[curr] * a_x1 + compiled.intercept[curr]
+            low, high = np.minimum(y_start, y_end), np.maximum(y_start, y_end)
+            margin = 10**-9 * (1 + np.abs(low) + np.abs(high))
+            is_segment = kind == CompiledLocator.SEGMENT
+            within = is_segment & (a_x0 >= x_min) & (a_x1 <= x_max)
+            # Out of the segment bounds the query compares against -1000000000, so always goes true
+            go[is_segment & ((a_x1 < x_min) | (a_x0 > x_max))] = 1
+            go[within & (a_y0 > high + margin)] = 1
+            go[within & (a_y1 < low - margin)] = 0
+
+            moving = go >= 0
+            active, curr = active[moving], curr[moving]
+            nodes[active] = np.where(go[moving] == 1, compiled.true_child[curr], compiled.false_child[curr])
+        return nodes.reshape(ny, nx)
+
+    def nbytes(self):
+        """Returns the memory used by the cells."""
+        return self.start.nbytes
+
+    def leaf_fraction(self):
+        """Returns the fraction of cells that lie in a single trapezoid."""
+        return float(np.mean(self.compiled.kind[self.start] == CompiledLocator.LEAF))
+
+    def start_nodes(self, points):
+        """Returns the node each point of the (N, 2) array starts its walk at."""
+        min_x, min_y, max_x, max_y = self.bounds
+        ny, nx = self.shape
+        x = points[:, 0]
+        y = points[:, 1]
+        inside = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+        cell_x = np.clip(((x - min_x) * (nx / float(max_x - min_x))).astype(int), 0, nx - 1)
+        cell_y = np.clip(((y - min_y) * (ny / float(max_y - min_y))).astype(int), 0, ny - 1)
+        return np.where(inside, self.start[np.where(inside, cell_y, 0), np.where(inside, cell_x, 0)], 0)
+
+    def query(self, p):
+        """Returns the index of the trapezoid containing p, or FAILURE_INDEX. Finds the cell like
+           start_nodes, with Python numbers for a single point."""
+        x = float(p[0])
+        y = float(p[1])
+        min_x, min_y, max_x, max_y, scale_x, scale_y, last_x, last_y = self.cell_lookup
+        if min_x <= x <= max_x and min_y <= y <= max_y:
+            node = self.start.item(min(int((y - min_y) * scale_y), last_y), min(int((x - min_x) * scale_x), last_x))
+            return self.compiled.walk(x, y, node)
+        return self.compiled.walk(x, y, 0)
+
+    def query_many(self, points):
+        """Returns the trapezoid index of each point in the (N, 2) array, or FAILURE_INDEX."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return self.compiled.query_many(points, self.start_nodes(points))
+
+
 class PointLocator(object):
     """ A point location datastructure that can be queried to find the appropriate trapezoid. """
     
-    def __init__(self, bounds):
+    def __init__(self, bounds, compact=False):
         """
         Args:
             bounds: (x_min, y_min, x_max, y_max) the bounds in which the polygons reside.
+            compact (bool): keep the trapezoids in array columns (a TrapezoidStore) rather than one
+                object each, for very large maps.
         """
-        self.trapezoids = Trapezoids()
+        self.trapezoids = Trapezoids(compact)
         min_x, min_y, max_x, max_y = bounds
         bounds_vertices = np.array([[min_x, min_y], [min_x, max_y], [max_x, max_y], [max_x, min_y]])
         start_trap = Trapezoid(bounds_vertices, [])
         start_idx = self.trapezoids.add(start_trap)
         # Start query is the left bound
         self.tree_root = PointQuery(bounds[0], "failure", start_idx)
-        start_trap.add_parent(self.tree_root)
+        self.trapezoids[start_idx].add_parent(self.tree_root)
+        # Longest search path so far. Only grows, depth_stats() gives the exact value.
+        self.max_depth = 1
+        # The number of query nodes, counted as they are made, and the nodes changed by remove_line
+        # since the last prune. depth_stats() and prune() count the nodes again.
+        self.node_count = 1
+        self.stale_nodes = 0
         # For Debugging
         self.edge_history = []
         self.bounds = bounds
+        # The segments currently in the structure, how many times each was added, how many of them
+        # end at each point, and the y of the points at each x
+        self.segments = {}
+        self.segment_count = defaultdict(int)
+        self.endpoint_count = defaultdict(int)
+        self.endpoint_ys = defaultdict(set)
+        # Array form of the search structure and the grid in front of it, dropped whenever the structure changes
+        self.compiled = None
+        self.grid = None
 
     def lines(self):
         """ Returns a list of all the lines in the point locator object for easy visualization."""
@@ -87,14 +440,37 @@ class PointLocator(object):
         """ Remove the trapezoids that lie entirely in one of the polygons."""
         self.trapezoids.remove_traps_within_polygons(polygons)
 
-    def add_line(self, edge):
-        """ Add a line segment defined by p1 and p2 to the point location struct."""
+    def remove_occupied_traps(self):
+        """ Remove the trapezoids labelled as inside a polygon while the edges were added. Same as
+            remove_traps_within_polygons once every edge was added with its polygon, without any
+            geometric tests."""
+        self.trapezoids.remove_occupied()
+
+    def add_line(self, edge, polygon=-1, interior_above=True):
+        """ Add a line segment defined by p1 and p2 to the point location struct.
+
+        Args:
+            edge (np.ndarray): the (2, 2) segment.
+            polygon (int): the index of the polygon the segment is an edge of, -1 if none. The new
+                trapezoids on the interior side are labelled with it, see Trapezoid.occupant.
+            interior_above (bool): whether the interior of the polygon is above the segment.
+        """
+        occupants = (polygon, -1) if interior_above else (-1, polygon)
         edge = make_lr(edge)
         p_l = edge[0]
         p_r = edge[1]
+        self.compiled = None
+        self.grid = None
 
         is_intersecting = False
         self.edge_history.append(edge)
+        if segment_key(edge) in self.segments:
+            # A segment shared by polygons is in the structure once, and counted once per add_line
+            self.track_segment(edge, 1)
+            return is_intersecting
+        self.track_segment(edge, 1)
+        # The segment nodes of a segment share its array, which prune tells the live ones apart by
+        edge = self.segments[segment_key(edge)]
 
         # 1) Find the trapezoids that are intersected by the segment
         left_trap = self.query(p_l)
@@ -102,26 +478,23 @@ class PointLocator(object):
         intersected_traps = [left_trap]
 
         if left_trap != right_trap:
-            # Iterate through left trapezoids until find the trapezoid with p_r in it
-            intersected = True
+            # Follow the right neighbors until find the trapezoid with p_r in it
             last_includes_point =  False
-            while intersected:
-                traps = self.trapezoids.right_adjacent(left_trap)
-                intersected = False
-                for trap_idx in traps:
-                    if self.trapezoids[trap_idx].is_intersected(edge):
-                        intersected_traps.append(trap_idx)
-                        left_trap = trap_idx
-                        intersected = True
-                        break
+            while True:
+                trap_idx = self.trapezoids.next_along(left_trap, edge)
+                if trap_idx is not None:
+                    intersected_traps.append(trap_idx)
+                    left_trap = trap_idx
 
                 if self.trapezoids[intersected_traps[-1]].includes_point_loose(p_r):
                     last_includes_point =  True
                     break
+                if trap_idx is None:
+                    break
             is_intersecting = not last_includes_point
 
         # 2) Make the new trapezoids formed by the addition of the segment
-        new_traps = self.trapezoids.split_trapezoids(edge, intersected_traps)
+        new_traps = self.trapezoids.split_trapezoids(edge, intersected_traps, occupants)
 
         parents = []
         for i, trap_idx in enumerate(intersected_traps):
@@ -150,16 +523,410 @@ class PointLocator(object):
                     if "left" in indices:
                         new_node = PointQuery(p_l[0], indices["left"], new_node)
                         self.trapezoids[indices["left"]].add_parent(new_node)
+                    self.node_count += 1 + ("right" in indices) + ("left" in indices)
                 else:
                     new_node = PointQuery(edge[0, 0], indices["left"], indices["right"])
                     self.trapezoids[indices["left"]].add_parent(new_node)
                     self.trapezoids[indices["right"]].add_parent(new_node)
+                    self.node_count += 1
 
                 for p in parent:
                     p.set_value(new_node)
+                self.set_depths(new_node, max(p.depth for p in parent) + 1)
 
         return is_intersecting
 
+    def track_segment(self, edge, change):
+        """Records that the left-to-right edge was added (change=1) or removed (change=-1)."""
+        key = segment_key(edge)
+        self.segment_count[key] += change
+        if change > 0:
+            self.segments.setdefault(key, edge)
+        elif self.segment_count[key] == 0:
+            self.segment_count.pop(key)
+            self.segments.pop(key)
+        for point in edge:
+            x, y = point_key(point)
+            self.endpoint_count[(x, y)] += change
+            self.endpoint_ys[x].add(y)
+            if self.endpoint_count[(x, y)] == 0:
+                self.endpoint_count.pop((x, y))
+                self.endpoint_ys[x].discard(y)
+                if len(self.endpoint_ys[x]) == 0:
+                    self.endpoint_ys.pop(x)
+
+    def remove_line(self, edge, prune=True):
+        """ Remove a line segment previously added with add_line. Only the trapezoids bordering the 
+            segment (and the walls of its endpoints) are rebuilt. Returns the indices of the new trapezoids,
+            none while the segment is left from other add_line calls.
+
+        Args:
+            edge (np.ndarray): the (2, 2) segment.
+            prune (bool): prune the search structure once the nodes changed by removals are
+                PRUNE_FRACTION of it, see prune_stale. Callers removing many segments at once can
+                pass False and call prune_stale at the end.
+        """
+        edge = make_lr(edge)
+        if segment_key(edge) not in self.segments:
+            raise ValueError("[PointLocator] Edge {} was never added!".format(edge))
+        if self.segment_count[segment_key(edge)] > 1:
+            self.track_segment(edge, -1)
+            return []
+        self.compiled = None
+        self.grid = None
+
+        # 1) Find the trapezoids that change: the ones above and below the segment, and the ones
+        # across the walls of endpoints that no other segment uses.
+        p_l = edge[0]
+        p_r = edge[1]
+        shared = [self.endpoint_count[point_key(p)] > 1 for p in edge]
+        removed_walls = []
+        if edge[0, 0] < edge[1, 0]:
+            direction = edge[1] - edge[0]
+            region = self.segment_border(edge, direction, above=True)
+            region += self.segment_border(edge, direction, above=False)
+            if not shared[0]:
+                region.append(self.query_beside(p_l, np.array([-1, 0])))
+                removed_walls.append(p_l[0])
+            if not shared[1]:
+                region.append(self.query_beside(p_r, np.array([1, 0])))
+                removed_walls.append(p_r[0])
+        elif shared[0] or shared[1]:
+            # The walls of the remaining endpoint cover the vertical segment, nothing changes
+            region = []
+        else:
+            center = edge.mean(axis=0)
+            region = [self.query_beside(center, np.array([-1, 0])), self.query_beside(center, np.array([1, 0]))]
+            removed_walls.append(p_l[0])
+        region = list(dict.fromkeys(region))
+        # A wall stays where another endpoint at the same x still holds it up, as the far end of a
+        # vertical segment does
+        removed_walls = [x for x in removed_walls if not self.holds_wall(x, edge, region)]
+
+        # 2) Make the new trapezoids, one per slab between the walls that are left
+        new_traps = []
+        walls = []
+        if len(region) > 0:
+            walls, new_traps = self.merge_region(edge, region, removed_walls)
+
+        # 3) Replace the old trapezoids in the search structure by x splits over the new ones.
+        # A parent can point to two of the old trapezoids, so remember which child each one was.
+        old_traps = []
+        for idx in region:
+            trap = self.trapezoids[idx]
+            children = []
+            for p in {id(p): p for p in trap.parents}.values():
+                children.extend([(p, True)] if p.true_child == idx else [])
+                children.extend([(p, False)] if p.false_child == idx else [])
+            old_traps.append((trap.leftp()[0], trap.rightp()[0], children))
+            self.trapezoids.pop(idx)
+
+        new_indices = [self.trapezoids.add(trap) for trap in new_traps]
+        for left_x, right_x, children in old_traps:
+            start = np.searchsorted(walls, left_x, side="right") - 1
+            end = np.searchsorted(walls, right_x, side="left")
+            node = self.x_split_tree(walls[start + 1:end], new_indices[start:end])
+            # The parents of the old trapezoid, and the new split tree, are what prune may drop
+            self.stale_nodes += len(children) + end - start - 1
+            for p, is_true_child in children:
+                if isinstance(node, int):
+                    self.trapezoids[node].add_parent(p)
+                if is_true_child:
+                    p.true_child = node
+                else:
+                    p.false_child = node
+            if len(children) > 0:
+                self.set_depths(node, max(p.depth for p, _ in children) + 1)
+
+        self.track_segment(edge, -1)
+        if prune:
+            self.prune_stale()
+        return new_indices
+
+    def remove_polygon(self, polygon):
+        """ Remove all the edges of the (P, 2) polygon. Returns the indices of the new trapezoids."""
+        new_indices = set()
+        for i in range(len(polygon)):
+            new_indices.update(self.remove_line(np.array([polygon[i], polygon[(i + 1) % len(polygon)]]), prune=False))
+        self.prune_stale()
+        return sorted(idx for idx in new_indices if self.trapezoids[idx] is not None)
+
+    def holds_wall(self, x, edge, region):
+        """ Returns whether an endpoint at x that stays once edge is removed lies on the side at x of
+            the trapezoids in region, so that its wall is still there."""
+        leaving = set(y for y in self.endpoint_ys.get(float(x), ())
+                      if any(point_key(p) == (float(x), y) for p in edge) and self.endpoint_count[(float(x), y)] == 1)
+        staying = self.endpoint_ys.get(float(x), set()) - leaving
+        if len(staying) == 0:
+            return False
+        extents = [self.trapezoids[idx].extent(x) for idx in region
+                   if self.trapezoids[idx].leftp()[0] <= x <= self.trapezoids[idx].rightp()[0]]
+        bottom = min(extent[0] for extent in extents)
+        top = max(extent[1] for extent in extents)
+        return any(bottom - 10**-6 <= y <= top + 10**-6 for y in staying)
+
+    def segment_border(self, edge, direction, above):
+        """ Returns the trapezoids with the (non-vertical) edge as their bottom (above=True) or top line."""
+        trap_idx = self.query_beside(edge[0], direction, edge, above)
+        border = []
+        while True:
+            trap = self.trapezoids[trap_idx]
+            if not self.borders(trap, edge, above):
+                raise ValueError("[PointLocator] Trapezoid {} does not border {}!".format(trap_idx, edge))
+            border.append(trap_idx)
+            if trap.rightp()[0] >= edge[1, 0] - 10**-6:
+                return border
+            trap_idx = None
+            for next_idx in reversed(trap.right_neighbors):
+                if self.borders(self.trapezoids[next_idx], edge, above):
+                    trap_idx = next_idx
+                    break
+            if trap_idx is None:
+                # Fall back on the search structure when the adjacency is missing the next trapezoid
+                x = trap.rightp()[0]
+                trap_idx = self.query_beside(np.array([x, linear_interpolation(edge, x)]), direction, edge, above)
+                if trap_idx == border[-1]:
+                    raise ValueError("[PointLocator] Lost the trapezoids along {}!".format(edge))
+
+    def borders(self, trap, edge, above):
+        """ Returns whether the (non-vertical) edge is the bottom (above=True) or top of the trapezoid."""
+        for x in (trap.leftp()[0], trap.rightp()[0]):
+            if x < edge[0, 0] - 10**-6 or x > edge[1, 0] + 10**-6:
+                return False
+            bottom, top = trap.extent(x)
+            if abs((bottom if above else top) - linear_interpolation(edge, x)) > 10**-6:
+                return False
+        return True
+
+    def merge_region(self, edge, region, removed_walls):
+        """ Computes the trapezoids that cover the trapezoids in region once edge is removed.
+            Returns the sorted wall x coordinates and the trapezoid between each pair of walls."""
+        traps = [self.trapezoids[idx] for idx in region]
+        walls = set()
+        originators = {}
+        for trap in traps:
+            walls.update([trap.leftp()[0], trap.rightp()[0]])
+            for originator in trap.originators:
+                originators.setdefault(originator[0], originator)
+        walls = np.array(sorted(walls.difference(removed_walls)))
+
+        new_traps = []
+        for left_x, right_x in zip(walls[:-1], walls[1:]):
+            # The top and bottom segments are the same across the slab, read them at each end.
+            # Without the edge, they are the highest and lowest boundaries of the old trapezoids.
+            # The occupants come with the segments, from the trapezoids on the top and bottom.
+            ends = []
+            for x, at_left in ((left_x, True), (right_x, False)):
+                extents = [(trap.extent(x), trap) for trap in traps
+                           if ((trap.leftp()[0] <= x < trap.rightp()[0]) if at_left
+                               else (trap.leftp()[0] < x <= trap.rightp()[0]))]
+                if len(extents) == 0:
+                    raise ValueError("[PointLocator] Region around {} is not connected!".format(edge))
+                (_, top), top_trap = max(extents, key=lambda extent: extent[0][1])
+                (bottom, _), bottom_trap = min(extents, key=lambda extent: extent[0][0])
+                ends.append((top, bottom, top_trap, bottom_trap))
+            (top_left, bottom_left, top_trap, bottom_trap), (top_right, bottom_right, _, _) = ends
+            occupants = (top_trap.top_occupant, bottom_trap.bottom_occupant)
+
+            vertices = [[left_x, bottom_left], [right_x, bottom_right]]
+            if top_right != bottom_right:
+                vertices.append([right_x, top_right])
+            if top_left != bottom_left:
+                vertices.append([left_x, top_left])
+
+            trap_originators = [originators[x] for x in (left_x, right_x) if x in originators]
+            top_line = np.array([[left_x, top_left], [right_x, top_right]])
+            bottom_line = np.array([[left_x, bottom_left], [right_x, bottom_right]])
+            new_traps.append(Trapezoid.from_lines(np.array(vertices), top_line, bottom_line, trap_originators, occupants))
+        return walls, new_traps
+
+    def x_split_tree(self, walls, leaves):
+        """ Returns a balanced tree of PointQuery nodes that sends points between walls[i-1] and walls[i]
+            to leaves[i]."""
+        if len(leaves) == 1:
+            return leaves[0]
+        mid = len(walls) // 2
+        left = self.x_split_tree(walls[:mid], leaves[:mid + 1])
+        right = self.x_split_tree(walls[mid + 1:], leaves[mid + 1:])
+        node = PointQuery(walls[mid], left, right)
+        self.node_count += 1
+        for child in (left, right):
+            if isinstance(child, int):
+                self.trapezoids[child].add_parent(node)
+        return node
+
+    def set_depths(self, node, depth):
+        """ Sets the depth of the new search tree under node, which is reached at depth."""
+        stack = [(node, depth)]
+        while len(stack) > 0:
+            node, depth = stack.pop()
+            if isinstance(node, Query):
+                node.depth = depth
+                self.max_depth = max(self.max_depth, depth)
+                stack.extend([(node.true_child, depth + 1), (node.false_child, depth + 1)])
+
+    def prune_stale(self):
+        """ Prunes once the nodes changed by remove_line since the last prune are PRUNE_FRACTION of
+            the search structure, so that each removal pays for the whole structure only in proportion
+            to the nodes it changed. Returns the number of query nodes dropped."""
+        if self.stale_nodes <= PRUNE_FRACTION * self.node_count:
+            return 0
+        return self.prune()
+
+    def prune(self):
+        """ Drops the query nodes that removed segments leave behind, so the search structure does
+            not grow with every remove_line. Runs over the whole structure, see collapse_nodes and
+            narrow_links. Returns the number of query nodes dropped."""
+        count = len(self.query_nodes())
+        self.stale_nodes = 0
+        if self.collapse_nodes() + self.narrow_links() == 0:
+            self.node_count = count
+            return 0
+        # Links skipped by narrow_links can leave a PointQuery with the same two children
+        self.collapse_nodes()
+
+        # The parents of the trapezoids, once per child they are
+        parents = defaultdict(list)
+        for node in self.query_nodes():
+            for child in (node.true_child, node.false_child):
+                if isinstance(child, int):
+                    parents[child].append(node)
+        for trap_idx, trap_parents in parents.items():
+            self.trapezoids[trap_idx].parents = trap_parents
+        return count - self.depth_stats()["nodes"]
+
+    def collapse_nodes(self):
+        """ Replaces the nodes that no longer tell their children apart by one of their children.
+            Returns the number of nodes replaced.
+
+            A SegmentQuery of a removed segment is replaced by its child on one side when the
+            other side tests no segment: the points of that side then lie in the trapezoids the
+            removal merged across the segment, which the kept child reaches for them too. A
+            PointQuery whose two children became the same is replaced by that child."""
+        replaced = {}
+        tests_segment = {}
+        def resolve(child):
+            return replaced.get(id(child), child) if isinstance(child, Query) else child
+
+        # Children first, so each node sees the collapsed children
+        for node in reversed(self.query_nodes()):
+            node.true_child = resolve(node.true_child)
+            node.false_child = resolve(node.false_child)
+            true_tests, false_tests = [tests_segment.get(id(child), False)
+                                       for child in (node.true_child, node.false_child)]
+            # A segment removed and added again has a new array, the old nodes are gone with the old one
+            if isinstance(node, SegmentQuery) and self.segments.get(segment_key(node.x)) is not node.x:
+                if not false_tests:
+                    replaced[id(node)] = node.true_child
+                    continue
+                if not true_tests:
+                    replaced[id(node)] = node.false_child
+                    continue
+            elif isinstance(node, PointQuery):
+                same_child = node.true_child is node.false_child or (isinstance(node.true_child, int) and
+                                                                     node.true_child == node.false_child)
+                if same_child:
+                    replaced[id(node)] = node.true_child
+                    continue
+            tests_segment[id(node)] = isinstance(node, SegmentQuery) or true_tests or false_tests
+        self.tree_root = resolve(self.tree_root)
+        return len(replaced)
+
+    def narrow_links(self):
+        """ Points a link past the PointQuery nodes that send all of its points the same way.
+            Returns the number of nodes skipped.
+
+            remove_line puts the same x split tree under every parent of an old trapezoid, while
+            each parent only leads to the part of it between the walls above the parent. The
+            x interval (low, high] of the points along each link is followed from the root."""
+        skipped = 0
+        intervals = {id(self.tree_root): (-np.inf, np.inf)}
+        # Parents first, so each node has the intervals of all of its links
+        for node in self.query_nodes():
+            if id(node) not in intervals:
+                # Every link to it was pointed past it
+                continue
+            low, high = intervals[id(node)]
+            if isinstance(node, PointQuery):
+                sides = ((low, min(high, node.x)), (max(low, node.x), high))
+            else:
+                sides = ((low, high), (low, high))
+            children = []
+            for child, (child_low, child_high) in zip((node.true_child, node.false_child), sides):
+                while isinstance(child, PointQuery) and (child_high <= child.x or child_low >= child.x):
+                    child = child.true_child if child_high <= child.x else child.false_child
+                    skipped += 1
+                if isinstance(child, Query):
+                    known_low, known_high = intervals.get(id(child), (np.inf, -np.inf))
+                    intervals[id(child)] = (min(known_low, child_low), max(known_high, child_high))
+                children.append(child)
+            node.true_child, node.false_child = children
+        return skipped
+
+    def query_nodes(self):
+        """ Returns the query nodes of the search structure, each after all of its parents."""
+        order = []
+        visited = set()
+        stack = [(self.tree_root, False)]
+        while len(stack) > 0:
+            node, done = stack.pop()
+            if done:
+                order.append(node)
+                continue
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            stack.append((node, True))
+            for child in (node.true_child, node.false_child):
+                if isinstance(child, Query) and id(child) not in visited:
+                    stack.append((child, False))
+        order.reverse()
+        return order
+
+    def depth_stats(self):
+        """ Measures the search structure. Sets the depth of every node and returns a dict with
+            `max_depth`: the longest search path, `mean_depth`: the mean over the trapezoids of the
+            longest path to each, and `nodes`: the number of query nodes."""
+        order = self.query_nodes()
+        for node in order:
+            node.depth = 1
+        leaf_depths = {}
+        for node in order:
+            for child in (node.true_child, node.false_child):
+                if isinstance(child, Query):
+                    child.depth = max(child.depth, node.depth + 1)
+                elif isinstance(child, int):
+                    leaf_depths[child] = max(leaf_depths.get(child, 0), node.depth)
+        self.max_depth = max(node.depth for node in order)
+        self.node_count = len(order)
+        return {"max_depth": self.max_depth,
+                "mean_depth": float(np.mean(list(leaf_depths.values()))),
+                "nodes": len(order)}
+
+    def query_beside(self, p, direction, edge=None, above=True):
+        """ Like query, for a point moved off of p by an infinitesimal step in direction. 
+            At the nodes of edge itself (which p lies on), goes to the top if above."""
+        curr_node = self.tree_root
+        while isinstance(curr_node, Query):
+            if isinstance(curr_node, PointQuery):
+                if p[0] != curr_node.x:
+                    go_true = p[0] < curr_node.x
+                else:
+                    go_true = direction[0] <= 0
+            elif edge is not None and np.array_equal(curr_node.x, edge):
+                go_true = above
+            else:
+                y = fit_interpolation(curr_node.fit, p[0])
+                if abs(p[1] - y) > 10**-6:
+                    go_true = p[1] > y
+                else:
+                    go_true = direction[1] - curr_node.fit[0] * direction[0] > 0
+            curr_node = curr_node.true_child if go_true else curr_node.false_child
+
+        if not isinstance(curr_node, int):
+            raise ValueError("[PointLocator] No trapezoid beside {}!".format(p))
+        return curr_node
+
     def pop_leaf(self, idx):
         """Remove a trapezoid from the datastructure and return its parent nodes."""
         parent = self.trapezoids[idx].parents
@@ -173,8 +940,29 @@ class PointLocator(object):
                 raise ValueError("[PointLocator] Parent does not have child: {}".format(idx))
         return parent
 
+    def freeze(self, grid_resolution=None, grid_bytes=2**24):
+        """ Compiles the search structure into flat arrays that answer all following queries
+            until the next line is added. Returns the CompiledLocator.
+
+        Args:
+            grid_resolution (int or tuple): if given, also put a QueryGrid with this many cells along
+                x and y over the bounds in front of the compiled structure.
+            grid_bytes (int): the most memory the grid cells may take.
+        """
+        self.compiled = CompiledLocator.compile(self.tree_root)
+        self.grid = None
+        if grid_resolution is not None:
+            self.grid = QueryGrid(self.compiled, self.bounds, grid_resolution, grid_bytes)
+        return self.compiled
+
     def query(self, p):
         """ Queries for the point p in self. Returns the index of the trapezoid containing p."""
+        if self.compiled is not None:
+            trap_idx = (self.compiled if self.grid is None else self.grid).query(p)
+            if trap_idx == FAILURE_INDEX:
+                raise ValueError("[PointLocator] Obstacles out of bounds!")
+            return trap_idx
+
         curr_node = self.tree_root
         while True:
             curr_node = curr_node(p)
@@ -184,4 +972,67 @@ class PointLocator(object):
                 raise ValueError("[PointLocator] No trapezoid in that Area!")
                 return None
             elif isinstance(curr_node, str):
-                raise ValueError("[PointLocator] Obstacles out of bounds!")
\ No newline at end of file
+                raise ValueError("[PointLocator] Obstacles out of bounds!")
+
+    def query_many(self, points):
+        """ Queries for all the points in the (N, 2) array points at once. 
+            Returns an (N,) array of trapezoid indices, with FAILURE_INDEX for out of bounds points."""
+        if self.compiled is not None:
+            return (self.compiled if self.grid is None else self.grid).query_many(points)
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        result = np.full(len(points), FAILURE_INDEX, dtype=int)
+        # Each level of the frontier maps a node to the indices of the points that reached it
+        frontier = {id(self.tree_root): (self.tree_root, [np.arange(len(points))])}
+        while len(frontier) > 0:
+            next_frontier = {}
+            for node, indices in frontier.values():
+                indices = np.concatenate(indices)
+                mask = node.evaluate(points[indices])
+                for child, child_indices in ((node.true_child, indices[mask]), (node.false_child, indices[~mask])):
+                    if len(child_indices) == 0:
+                        continue
+                    if isinstance(child, Query):
+                        if id(child) not in next_frontier:
+                            next_frontier[id(child)] = (child, [])
+                        next_frontier[id(child)][1].append(child_indices)
+                    elif isinstance(child, int):
+                        result[child_indices] = child
+                    elif child is None:
+                        raise ValueError("[PointLocator] No trapezoid in that Area!")
+            frontier = next_frontier
+        return result
+
+    def query_from(self, hint_trap_idx, p, max_steps=8):
+        """ Queries for the point p starting from the trapezoid at hint_trap_idx, e.g. the answer to a
+            nearby point. Walks across the walls toward p and only falls back to the search structure
+            when p is not strictly inside a trapezoid within max_steps steps."""
+        trap_idx = hint_trap_idx
+        for _ in range(max_steps + 1):
+            if trap_idx is None or trap_idx < 0 or trap_idx >= len(self.trapezoids.trapezoids):
+                break
+            trap = self.trapezoids[trap_idx]
+            if trap is None:
+                break
+            if trap.includes_point(p):
+                return trap_idx
+            trap_idx = self.trapezoids.neighbor_toward(trap_idx, p)
+        return self.query(p)
+
+    def locate_trajectory(self, points, max_steps=8):
+        """ Yields the index of the trapezoid containing each point of a trajectory, using the answer
+            for each point as the hint for the next."""
+        trap_idx = None
+        for p in points:
+            trap_idx = self.query_from(trap_idx, p, max_steps)
+            yield trap_idx
+
+    def misplaced(self, points):
+        """ Checks the structure on the (N, 2) points: returns the indices of the points that are
+            located out of bounds or in a trapezoid that does not contain them."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        located = self.query_many(points)
+        found = np.flatnonzero(located != FAILURE_INDEX)
+        contained = self.trapezoids.contain_points(located[found], points[found])
+        bad = np.ones(len(points), dtype=bool)
+        bad[found[contained]] = False
+        return np.flatnonzero(bad)
\ No newline at end of file
@@ -1,10 +1,14 @@
 """Contains the classes for working with the polygons and the trapezoids in a coherent way."""
 
+import bisect
+import heapq
 import numpy as np
 import random
+from collections import defaultdict
 from matplotlib.path import Path
 import math
 from scipy.spatial import ConvexHull
+from sortedcontainers import SortedList
 from line_utils import *
 
 class Polygon(object):
@@ -26,9 +30,8 @@ class Polygon(object):
 
     def is_counterclockwise(self):
         """Checks if the points are counter-clockwise."""
-        total = 0
-        for edge in self.edges:
-            total += (edge[1, 0] - edge[0, 0]) * (edge[1, 1] + edge[0, 1])
+        edges = self.edges
+        total = np.sum((edges[:, 1, 0] - edges[:, 0, 0]) * (edges[:, 1, 1] + edges[:, 0, 1]))
         return total > 0
 
     def counterclockwise(self):
@@ -48,47 +51,442 @@ class Polygon(object):
     def edge_angles(self):
         """Returns edge vectors in order of angle from y axis, and the index of the smallest angle."""
         edges = self.edges
-        angles = []
-        pos_y = np.array([0, 1])
-        min_angle_idx = 0
-        min_angle = 400
-        for i, edge in enumerate(edges):
-            # Get the normal vector that points out of the shape
-            normal_vec = normal(edge)
-            normal_options = np.array([normal_vec, -1 * normal_vec])
-            center_line = edge.mean(axis=0) - self.center
-            products = np.matmul(normal_options, center_line)
-            assert(products.prod() < 0)
-            normal_vec = normal_options[np.argmax(products)]
-            normal_vec = np.divide(normal_vec, np.linalg.norm(normal_vec))
-
-            # compute the angle with positive y
-            # ax*by-ay*bx, ax*bx+ay*by
-            tan_1 = normal_vec[0] * pos_y[1] 
-            tan_2 = normal_vec[1] * pos_y[1]
-            angle = math.atan2(tan_1, tan_2)
-            if angle < 0:
-                angle += 2 * np.pi
-            angles.append(angle)
-            if angle < min_angle:
-                min_angle = angle
-                min_angle_idx = i
-        return np.array(angles), min_angle_idx
+        # Get the normal vectors that point out of the shape
+        normal_vecs = normals(edges)
+        center_lines = edges.mean(axis=1) - self.center
+        products = np.sum(normal_vecs * center_lines, axis=1)
+        assert((products != 0).all())
+        normal_vecs = np.where((products > 0)[:, None], normal_vecs, -1 * normal_vecs)
+        normal_vecs = normal_vecs / np.linalg.norm(normal_vecs, axis=1)[:, None]
+
+        # compute the angle with positive y
+        angles = np.arctan2(normal_vecs[:, 0], normal_vecs[:, 1])
+        angles[angles < 0] += 2 * np.pi
+        return angles, int(np.argmin(angles))
 
     def __repr__(self):
         return str(self.points)
 
 
 
+class PolygonIndex(object):
+    """ A static R-tree over the bounding boxes of polygons, packed with Sort-Tile-Recursive:
+        the boxes of each level are sorted into vertical slices by x center, then by y center within
+        a slice, and grouped node_size at a time under the nodes of the level above."""
+
+    def __init__(self, boxes, node_size=8):
+        """
+        Args:
+            boxes (np.ndarray): (N, 4) [x_min, y_min, x_max, y_max] box of each polygon.
+            node_size (int): the most children of a node.
+        """
+        self.node_size = node_size
+        self.boxes = boxes
+        # The polygon indices in leaf order, and per level from the leaves up the node boxes and the
+        # range of children (entries for the leaf level) of each node
+        self.entries = self.str_order(boxes)
+        self.levels = []
+        child_boxes = boxes[self.entries]
+        while len(child_boxes) > 0:
+            starts = np.arange(0, len(child_boxes), node_size)
+            ends = np.minimum(starts + node_size, len(child_boxes))
+            node_boxes = np.stack([np.minimum.reduceat(child_boxes[:, 0], starts),
+                                   np.minimum.reduceat(child_boxes[:, 1], starts),
+                                   np.maximum.reduceat(child_boxes[:, 2], starts),
+                                   np.maximum.reduceat(child_boxes[:, 3], starts)], axis=1)
+            order = self.str_order(node_boxes)
+            self.levels.append((node_boxes[order], starts[order], ends[order]))
+            if len(node_boxes) == 1:
+                break
+            child_boxes = node_boxes[order]
+
+    def str_order(self, boxes):
+        """Returns the Sort-Tile-Recursive order of the boxes."""
+        center_x = (boxes[:, 0] + boxes[:, 2]) / 2
+        center_y = (boxes[:, 1] + boxes[:, 3]) / 2
+        node_count = -(-len(boxes) // self.node_size)
+        per_slice = max(1, int(np.ceil(np.sqrt(node_count)))) * self.node_size
+        by_x = np.argsort(center_x, kind="stable")
+        order = [np.zeros(0, dtype=int)]
+        for start in range(0, len(boxes), per_slice):
+            chunk = by_x[start:start + per_slice]
+            order.append(chunk[np.argsort(center_y[chunk], kind="stable")])
+        return np.concatenate(order)
+
+    def query(self, low, high, containing=False):
+        """Returns the indices of the polygons whose boxes overlap the box from the low to the high corner,
+           or hold all of it if containing."""
+        nodes = np.arange(len(self.levels[-1][0])) if len(self.levels) > 0 else np.zeros(0, dtype=int)
+        for level in range(len(self.levels) - 1, -1, -1):
+            boxes, starts, ends = self.levels[level]
+            overlap = ((boxes[nodes, 0] <= high[0]) & (boxes[nodes, 2] >= low[0]) &
+                       (boxes[nodes, 1] <= high[1]) & (boxes[nodes, 3] >= low[1]))
+            nodes = nodes[overlap]
+            nodes = np.concatenate([np.zeros(0, dtype=int)] + [np.arange(starts[i], ends[i]) for i in nodes])
+        found = self.entries[nodes]
+        boxes = self.boxes[found]
+        if containing:
+            keep = (boxes[:, 0] <= low[0]) & (boxes[:, 1] <= low[1]) & (boxes[:, 2] >= high[0]) & (boxes[:, 3] >= high[1])
+        else:
+            keep = (boxes[:, 0] <= high[0]) & (boxes[:, 2] >= low[0]) & (boxes[:, 1] <= high[1]) & (boxes[:, 3] >= low[1])
+        return np.sort(found[keep])
+
+
+def point_in_polygon(polygon, point, boundary=True):
+    """Returns whether the point is inside the (P, 2) polygon, or on its boundary if boundary."""
+    start = polygon
+    end = np.roll(polygon, -1, axis=0)
+    direction = end - start
+    offset = point - start
+    # On an edge: along the edge line and within the edge box
+    cross = direction[:, 0] * offset[:, 1] - direction[:, 1] * offset[:, 0]
+    tolerance = 10**-6 * (np.abs(direction).sum(axis=1) + 1)
+    within = ((np.minimum(start, end) - tolerance[:, None] <= point) &
+              (np.maximum(start, end) + tolerance[:, None] >= point)).all(axis=1)
+    if boundary and (within & (np.abs(cross) <= tolerance * np.abs(direction).sum(axis=1))).any():
+        return True
+    # Inside: an odd number of edges cross the horizontal ray to the right of the point
+    straddles = (start[:, 1] > point[1]) != (end[:, 1] > point[1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cross_x = start[:, 0] + direction[:, 0] * (point[1] - start[:, 1]) / direction[:, 1]
+    return bool(np.count_nonzero(straddles & (point[0] < cross_x)) % 2)
+
+
+def signed_area(polygon):
+    """Returns the area of the (P, 2) polygon, negative if its points go clockwise with y up."""
+    x, y = polygon[:, 0], polygon[:, 1]
+    return float(np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)) / 2
+
+
+def split_at_intersections(edges, tolerance=None):
+    """ Finds where the (N, 2, 2) segments meet with a Bentley-Ottmann sweep, in O((N + K) log N) time
+        for K meeting points. The sweep goes left to right (bottom to top on a vertical line) keeping the
+        segments crossing it ordered bottom to top, and only tests segments that become neighbours
+        in that order. Points closer than tolerance are taken as the same point. A first sweep
+        splits the segments at the endpoints of other segments within tolerance of them, so that
+        segments that nearly touch meet at one shared point, then a second one finds the crossings
+        of the split segments.
+
+    Returns:
+        list: for each segment, the points as (x, y) tuples where it ends or meets another segment,
+            in order from its first to its second endpoint. A point met by several segments is the
+            same tuple for all of them.
+    """
+    edges = np.asarray(edges, dtype=float).reshape(-1, 2, 2)
+    if tolerance is None:
+        tolerance = 10**-9 * (np.abs(edges).max() if len(edges) > 0 else 1) + 10**-12
+
+    # Every point goes through snap, which returns the first point it saw within tolerance
+    cells = {}
+    def cell_of(point):
+        return int(np.floor(point[0] / tolerance)), int(np.floor(point[1] / tolerance))
+
+    def snap(point):
+        cell = cell_of(point)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for other in cells.get((cell[0] + dx, cell[1] + dy), []):
+                    if abs(other[0] - point[0]) <= tolerance and abs(other[1] - point[1]) <= tolerance:
+                        return other
+        point = (float(point[0]), float(point[1]))
+        cells.setdefault(cell, []).append(point)
+        return point
+
+    segments = [(snap(edge[0]), snap(edge[1])) for edge in edges]
+    # Segments narrower than tolerance are made vertical, and points within tolerance of a vertical
+    # segment are moved onto it, as the sweep would meet them out of order. The points of a vertical
+    # line are joined and take the x of the first of them.
+    order = {}
+    for segment in segments:
+        for point in segment:
+            order.setdefault(point, len(order))
+    roots = {}
+    def find(point):
+        while roots.get(point, point) != point:
+            point = roots[point]
+        return point
+    def join(a, b):
+        a, b = sorted((find(a), find(b)), key=order.get)
+        roots[b] = a
+        return a != b
+    joined = True
+    while joined:
+        joined = False
+        for first, second in segments:
+            if abs(find(second)[0] - find(first)[0]) <= tolerance:
+                joined = join(first, second) or joined
+        # The y extent of each vertical line, by its x
+        extents = {}
+        for first, second in segments:
+            root = find(first)
+            if root == find(second):
+                low, high = extents.get(root, (np.inf, -np.inf))
+                extents[root] = (min(low, first[1], second[1]), max(high, first[1], second[1]))
+        lines = defaultdict(list)
+        for root, (low, high) in extents.items():
+            lines[root[0]].append((low, high, root))
+        xs = sorted(lines)
+        for point in order:
+            x = find(point)[0]
+            for line_x in xs[bisect.bisect_left(xs, x - tolerance):bisect.bisect_right(xs, x + tolerance)]:
+                for low, high, root in lines[line_x]:
+                    if line_x != find(point)[0] and low - tolerance <= point[1] <= high + tolerance:
+                        joined = join(point, root) or joined
+    moved = {}
+    for point in order:
+        x = find(point)[0]
+        if x != point[0]:
+            moved[point] = (x, point[1])
+            cells[cell_of(point)].remove(point)
+            cells.setdefault(cell_of(moved[point]), []).append(moved[point])
+    segments = [(moved.get(first, first), moved.get(second, second)) for first, second in segments]
+    contacts = _sweep(segments, snap, tolerance, crossings=False)
+    # The pieces between the endpoints each segment passes, and the segment each piece is of
+    pieces, parents = [], []
+    for idx, points in enumerate(contacts):
+        points = _along(points, segments[idx])
+        pieces.extend(zip(points[:-1], points[1:]))
+        parents.extend([idx] * (len(points) - 1))
+    points_on = [set(segment) for segment in segments]
+    for idx, points in enumerate(_sweep(pieces, snap, tolerance, crossings=True)):
+        points_on[parents[idx]].update(points)
+    return [_along(points, segment) for points, segment in zip(points_on, segments)]
+
+
+def _along(points, segment):
+    """Returns the points on the segment in order from its first to its second endpoint."""
+    first, second = segment
+    direction = (second[0] - first[0], second[1] - first[1])
+    return sorted(points, key=lambda point: (point[0] - first[0]) * direction[0] + (point[1] - first[1]) * direction[1])
+
+
+def _sweep(segments, snap, tolerance, crossings):
+    """ The sweep of split_at_intersections over the segments, pairs of snapped points. Returns, for each
+        segment, the set of its endpoints and of the endpoints of other segments on it, and the points
+        where it crosses other segments if crossings."""
+    # The sweep meets the lower-left endpoint of each segment first
+    ordered = [sorted(segment) for segment in segments]
+    starts = [first for first, _ in ordered]
+    ends = [second for _, second in ordered]
+    # Vertical segments have an infinite slope
+    segment_slopes = slopes(np.array(ordered, dtype=float).reshape(-1, 2, 2))
+    segment_slopes = np.where(np.isnan(segment_slopes), np.inf, segment_slopes).tolist()
+    points_on = [{starts[i], ends[i]} for i in range(len(segments))]
+    endpoints = set(starts + ends)
+
+    def y_at(idx, x, y):
+        """The height of segment idx on the sweep line at x. Vertical segments give the y closest to y."""
+        if segment_slopes[idx] == np.inf:
+            return min(max(y, starts[idx][1]), ends[idx][1])
+        return starts[idx][1] + (x - starts[idx][0]) * segment_slopes[idx]
+
+    def near(idx, x, y):
+        """Whether the point (x, y) is within tolerance of segment idx."""
+        (ax, ay), (bx, by) = starts[idx], ends[idx]
+        dx, dy = bx - ax, by - ay
+        t = min(max(((x - ax) * dx + (y - ay) * dy) / (dx * dx + dy * dy or 1), 0), 1)
+        return math.hypot(ax + t * dx - x, ay + t * dy - y) <= tolerance
+
+    def intersection(a, b):
+        """The point where the segments a and b cross, None if they do not or are parallel."""
+        (ax, ay), (bx, by) = starts[a], starts[b]
+        adx, ady = ends[a][0] - ax, ends[a][1] - ay
+        bdx, bdy = ends[b][0] - bx, ends[b][1] - by
+        denominator = adx * bdy - ady * bdx
+        if abs(denominator) <= 10**-12 * (abs(adx) + abs(ady)) * (abs(bdx) + abs(bdy)):
+            # Parallel. Overlaps start at an endpoint, where the other segment is found on the sweep line.
+            return None
+        t = ((bx - ax) * bdy - (by - ay) * bdx) / denominator
+        u = ((bx - ax) * ady - (by - ay) * adx) / denominator
+        if not (-10**-9 <= t <= 1 + 10**-9 and -10**-9 <= u <= 1 + 10**-9):
+            return None
+        return (ax + t * adx, ay + t * ady)
+
+    starting = defaultdict(list)
+    for idx in range(len(segments)):
+        starting[starts[idx]].append(idx)
+    events = list(endpoints)
+    heapq.heapify(events)
+    queued = set(events)
+    # The point each crossing event is recorded as, see check
+    names = {}
+
+    # The segments on the sweep line, compared by their height at the current event. The segments
+    # going on from the event are at its height, ordered by slope as they are just past it.
+    event, going_on = None, set()
+
+    class Entry(object):
+        __slots__ = ("idx",)
+
+        def __init__(self, idx):
+            self.idx = idx
+
+        def key(self):
+            x, y = event
+            if self.idx is None:
+                return (y, -np.inf, -1)
+            height = y if self.idx in going_on else y_at(self.idx, x, y)
+            return (height, segment_slopes[self.idx], self.idx)
+
+        def __lt__(self, other):
+            return self.key() < other.key()
+
+    entries = [Entry(idx) for idx in range(len(segments))]
+    below_event = Entry(None)
+    status = SortedList()
+
+    def check(below, above, event):
+        """Queues the crossing of the segments at status positions below and above if it is past event."""
+        if below < 0 or above >= len(status):
+            return
+        crossing = intersection(status[below].idx, status[above].idx)
+        if crossing is None:
+            return
+        point = snap(crossing)
+        # A crossing within tolerance of a point the sweep has passed is met where it is, under the
+        # name of that point
+        at = point if point > event else crossing
+        if at > event and at not in queued:
+            queued.add(at)
+            names[at] = point
+            heapq.heappush(events, at)
+
+    while len(events) > 0:
+        event = heapq.heappop(events)
+        queued.discard(event)
+        name = names.pop(event, event)
+        going_on = set()
+        # The segments on the sweep line passing within tolerance of the event
+        low = high = status.bisect_left(below_event)
+        while low > 0 and near(status[low - 1].idx, *event):
+            low -= 1
+        while high < len(status) and near(status[high].idx, *event):
+            high += 1
+        through = [entry.idx for entry in status[low:high]]
+        beginning = starting.pop(event, [])
+        if len(through) + len(beginning) > 1 and (crossings or event in endpoints):
+            for idx in through + beginning:
+                points_on[idx].add(name)
+
+        # Past the event, the segments that go on are ordered by slope
+        del status[low:high]
+        going_on = set(idx for idx in through + beginning if ends[idx] != event)
+        status.update(entries[idx] for idx in going_on)
+        low = status.bisect_left(below_event)
+        check(low - 1, low, event)
+        if len(going_on) > 0:
+            check(low + len(going_on) - 1, low + len(going_on), event)
+    return points_on
+
+
+def _boundary_distance(polygon, point):
+    """Returns the distance from the point to the closest edge of the (P, 2) polygon."""
+    starts = np.asarray(polygon, dtype=float)
+    directions = np.roll(starts, -1, axis=0) - starts
+    lengths = (directions ** 2).sum(axis=1)
+    along = ((point - starts) * directions).sum(axis=1) / np.where(lengths > 0, lengths, 1)
+    closest = starts + np.clip(along, 0, 1)[:, None] * directions
+    return np.hypot(*(closest - point).T).min()
+
+
+class PolygonSet(object):
+    """ Polygons in one (V, 2) vertex array, one polygon after the other, with the offsets where each
+        starts (CSR style). Indexing and iterating give the (P, 2) vertex views of the polygons, so it
+        can be used wherever a list of polygons is."""
+
+    def __init__(self, vertices, offsets, holes=None):
+        """
+        Args:
+            vertices (np.ndarray): (V, 2) the vertices of all the polygons.
+            offsets (np.ndarray): (N + 1,) polygon i has the vertices offsets[i] to offsets[i + 1].
+            holes (np.ndarray): (N,) whether each polygon is a hole in the last polygon before it that is
+                not one, see Polygons.merge_intersecting. None if there are no holes.
+        """
+        self.vertices = np.asarray(vertices, dtype=float).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.counts = np.diff(self.offsets)
+        if self.offsets[0] != 0 or self.offsets[-1] != len(self.vertices) or (self.counts < 1).any():
+            raise ValueError("[PolygonSet] Offsets {} do not split {} vertices!".format(self.offsets, len(self.vertices)))
+        self.holes = np.zeros(len(self.counts), dtype=bool) if holes is None else np.asarray(holes, dtype=bool)
+        if self.holes.shape != self.counts.shape or (len(self.holes) > 0 and self.holes[0]):
+            raise ValueError("[PolygonSet] Holes {} do not follow {} polygons!".format(self.holes, len(self.counts)))
+        # The polygon each hole is in, and each other polygon itself
+        self.outlines = np.maximum.accumulate(np.where(self.holes, 0, np.arange(len(self.counts))))
+        starts = self.offsets[:-1]
+        # Edge i goes from vertex i to the next vertex of its polygon
+        following = np.arange(1, len(self.vertices) + 1)
+        following[self.offsets[1:] - 1] = starts
+        self.edges = np.stack([self.vertices, self.vertices[following]], axis=1)
+        self.edge_polygon = np.repeat(np.arange(len(self.counts)), self.counts)
+        if len(self.counts) > 0:
+            self.boxes = np.concatenate([np.minimum.reduceat(self.vertices, starts),
+                                         np.maximum.reduceat(self.vertices, starts)], axis=1)
+            cross = self.edges[:, 0, 0] * self.edges[:, 1, 1] - self.edges[:, 1, 0] * self.edges[:, 0, 1]
+            self.areas = np.add.reduceat(cross, starts) / 2
+        else:
+            self.boxes = np.zeros((0, 4))
+            self.areas = np.zeros(0)
+        # Whether the points of each polygon go counter-clockwise with y up, the interior left of each edge
+        self.counterclockwise = self.areas > 0
+
+    @classmethod
+    def from_polygons(cls, polygons, holes=None):
+        """Makes the PolygonSet of a list of (P, 2) polygons, with the holes flags of PolygonSet."""
+        if isinstance(polygons, cls) and holes is None:
+            return polygons
+        polygons = [np.asarray(polygon, dtype=float).reshape(-1, 2) for polygon in polygons]
+        offsets = np.concatenate([[0], np.cumsum([len(polygon) for polygon in polygons], dtype=np.int64)])
+        return cls(np.concatenate(polygons + [np.zeros((0, 2))]), offsets, holes)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.vertices[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            indices = range(*idx.indices(len(self)))
+            # A hole without its polygon is left out
+            indices = [i for i in indices if self.outlines[i] in indices]
+            return PolygonSet.from_polygons([self[i] for i in indices], self.holes[indices])
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("[PolygonSet] Index {} out of range!".format(idx))
+        return self.vertices[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def polygon_edges(self, idx):
+        """Returns the (P, 2, 2) edges of polygon idx."""
+        return self.edges[self.offsets[idx]:self.offsets[idx + 1]]
+
+
 class Polygons(object):
     """ A class to hold several polygons and implements useful polygon operations."""
 
     def __init__(self, polygons):
         """
         Args:
-            polygons (list): a list of (P,2) np.ndarrays which represent individual polygons.
+            polygons (list): a list of (P,2) np.ndarrays which represent individual polygons, or a PolygonSet.
         """
-        self.polygons = polygons
+        self.polygons = PolygonSet.from_polygons(polygons)
+        # Built on first use
+        self._index = None
+
+    @property
+    def index(self):
+        """The PolygonIndex over the bounding boxes of the polygons."""
+        if self._index is None:
+            polygons = self.polygons
+            boxes = polygons.boxes.copy()
+            if len(polygons) > 0:
+                # Padded by the tolerance of point_on_edge
+                pad = 10**-5 * np.maximum.reduceat(np.abs(polygons.vertices).max(axis=1), polygons.offsets[:-1]) + 10**-6
+                boxes[:, :2] -= pad[:, None]
+                boxes[:, 2:] += pad[:, None]
+            self._index = PolygonIndex(boxes)
+        return self._index
 
     @staticmethod
     def make_convex(max_num_vertices, bounds):
@@ -180,44 +578,241 @@ class Polygons(object):
         else:
             return polygons, vertices_generated
 
+    @staticmethod
+    def random_boxes(bounds, count, rng):
+        """Splits the bounds into count disjoint [x_min, y_min, x_max, y_max] boxes, cutting the largest
+           boxes across their longer side at a random point each round."""
+        boxes = np.array([bounds], dtype=float)
+        while len(boxes) < count:
+            sizes = boxes[:, 2:] - boxes[:, :2]
+            split = np.argsort(-sizes.prod(axis=1), kind="stable")[:count - len(boxes)]
+            axis = np.argmax(sizes[split], axis=1)
+            cut = boxes[split, axis] + rng.uniform(0.3, 0.7, len(split)) * sizes[split, axis]
+            lower = boxes[split]
+            upper = boxes[split]
+            lower[np.arange(len(split)), axis + 2] = cut
+            upper[np.arange(len(split)), axis] = cut
+            boxes = np.concatenate([np.delete(boxes, split, axis=0), lower, upper])
+        return boxes
 
-    def merge_intersecting(self):
-        """Merge intersecting polygons into a single polygon."""
-        # TODO
-        pass
+    @staticmethod
+    def convex_in_boxes(boxes, counts, rng, max_vertices=None):
+        """Makes a convex polygon with counts[i] vertices in each of the (N, 4) boxes, at sorted random
+           angles on the ellipse in the middle 80% of the box. Returns the (sum(counts), 2) vertices,
+           counter-clockwise polygon after polygon. max_vertices is the most counts can be, which
+           fixes how many random numbers each polygon takes."""
+        width = max_vertices if max_vertices is not None else (counts.max() if len(counts) > 0 else 0)
+        angles = rng.random((len(boxes), width)) * 2 * np.pi
+        used = np.arange(width) < counts[:, None]
+        # Unused angles sort to the end of their row
+        angles = np.sort(np.where(used, angles, 4 * np.pi), axis=1)
+        center = (boxes[:, :2] + boxes[:, 2:]) / 2
+        radius = 0.4 * (boxes[:, 2:] - boxes[:, :2])
+        vertices = np.stack([center[:, 0, None] + radius[:, 0, None] * np.cos(angles),
+                             center[:, 1, None] + radius[:, 1, None] * np.sin(angles)], axis=-1)
+        return vertices[used]
+
+    @staticmethod
+    def random_scene(bounds, num_vertices, rng, max_polygon_vertices=8, chunk_polygons=2**16):
+        """ Makes disjoint convex polygons with about num_vertices vertices in total, like make_random
+            but without a Python loop per polygon and from the given random generator. The polygons are
+            made chunk_polygons at a time, so large scenes can be written out as they are made.
+
+        Args:
+            bounds: (x_min, y_min, x_max, y_max) to fill.
+            num_vertices (int): the total number of vertices, less at most 2.
+            rng (np.random.Generator): the source of randomness, the same seed gives the same scene.
+            max_polygon_vertices (int): the most vertices of one polygon, each has between 3 and this many.
+            chunk_polygons (int): the number of polygons per chunk.
+
+        Returns:
+            counts (np.ndarray): the number of vertices of each polygon.
+            chunks (iterator): the (V, 2) vertices of the polygons of each chunk.
+        """
+        counts = rng.integers(3, max_polygon_vertices + 1, num_vertices // 3 + 1)
+        counts = counts[np.cumsum(counts) <= num_vertices]
+        left = num_vertices - counts.sum()
+        if left >= 3:
+            counts = np.append(counts, left)
+        boxes = Polygons.random_boxes(bounds, len(counts), rng)
+
+        def chunks():
+            for start in range(0, len(counts), chunk_polygons):
+                yield Polygons.convex_in_boxes(boxes[start:start + chunk_polygons],
+                                               counts[start:start + chunk_polygons], rng, max_polygon_vertices)
+        return counts, chunks()
+
+    @staticmethod
+    def make_random_scene(bounds, num_vertices, rng, max_polygon_vertices=8):
+        """Returns the PolygonSet of random_scene."""
+        counts, chunks = Polygons.random_scene(bounds, num_vertices, rng, max_polygon_vertices)
+        vertices = np.concatenate(list(chunks) + [np.zeros((0, 2))])
+        return PolygonSet(vertices, np.concatenate([[0], np.cumsum(counts)]))
+
+
+    def merge_intersecting(self, fill_holes=False):
+        """ Returns the outlines of the union of the polygons as a PolygonSet, going counter-clockwise
+            with y up, each followed by the holes in it going clockwise (see PolygonSet.holes). Polygons
+            that do not meet any other come back unchanged up to their orientation. The edges are split
+            where they meet with split_at_intersections and only the pieces outside every other polygon
+            are kept, then walked into outlines.
 
-    def random_edge_sampler(self):
-        """Returns an iterator that randomly samples edges without replacement."""
-        # Make edges
+        Args:
+            fill_holes (bool): leave the holes out, which makes the space in them part of the union.
+        """
+        polygons = [polygon if counterclockwise else polygon[::-1]
+                    for polygon, counterclockwise in zip(self.polygons, self.polygons.counterclockwise)]
         edges = []
-        for polygon in self.polygons:
-            for i in range(len(polygon)):
-                edges.append(np.array([polygon[i], polygon[(i + 1) % len(polygon)]]))
-        
-        # Get a random shuffling of edge indices
-        indices = [i for i in range(len(edges))]
-        random.shuffle(indices)
-        for i in indices:
-            yield edges[i]
+        owners = []
+        for i, polygon in enumerate(polygons):
+            for j in range(len(polygon)):
+                edge = np.array([polygon[j], polygon[(j + 1) % len(polygon)]])
+                if (edge[0] != edge[1]).any():
+                    edges.append(edge)
+                    owners.append(i)
+        if len(edges) == 0:
+            return PolygonSet.from_polygons([])
+        edges = np.array(edges)
+        scale = np.abs(edges).max() + 1
+        index = Polygons(polygons).index
+
+        # The pieces outside every other polygon. Points closer than float32 rounding (as in
+        # minkowski_sum_fast) are one point, so edges that nearly touch meet at one shared point.
+        tolerance = 10**-7 * scale
+        pieces = defaultdict(int)
+        for idx, points in enumerate(split_at_intersections(edges, tolerance)):
+            for a, b in zip(points[:-1], points[1:]):
+                if a == b:
+                    continue
+                middle = np.add(a, b) / 2
+                others = [i for i in index.query(middle - tolerance, middle + tolerance) if i != owners[idx]]
+                if any(_boundary_distance(polygons[i], middle) <= tolerance for i in others):
+                    # On the boundary of another polygon, look just right of the piece (outside its own)
+                    direction = np.subtract(b, a)
+                    length = np.hypot(direction[0], direction[1])
+                    middle = middle + np.array([direction[1], -direction[0]]) / length * min(tolerance / 2, 0.1 * length)
+                if not any(point_in_polygon(polygons[i], middle, boundary=False) for i in others):
+                    pieces[(a, b)] += 1
+        # Kept once if walked more times one way than the other. Overlapping edges of polygons on the
+        # same side count once, the spikes rounding leaves on some outlines cancel out.
+        pieces = set(piece for piece, count in pieces.items() if count > pieces.get(piece[::-1], 0))
+
+        # Walk the pieces keeping the union on the left. Where outlines touch at a point, turn off
+        # the way we came as sharply as possible to stay on the same outline.
+        outgoing = defaultdict(list)
+        for a, b in sorted(pieces):
+            outgoing[a].append(b)
+        outlines = []
+        holes = []
+        for first in sorted(pieces):
+            if first not in pieces:
+                continue
+            pieces.discard(first)
+            outline = [first[0]]
+            a, b = first
+            while b != first[0]:
+                outline.append(b)
+                choices = [c for c in outgoing[b] if (b, c) in pieces]
+                if len(choices) == 0:
+                    raise ValueError("[Polygons] The union outline does not close at {}!".format(b))
+                back = math.atan2(a[1] - b[1], a[0] - b[0])
+                c = min(choices, key=lambda c: (back - math.atan2(c[1] - b[1], c[0] - b[0])) % (2 * np.pi) or 2 * np.pi)
+                pieces.discard((b, c))
+                a, b = b, c
+            outline = np.array(outline)
+
+            # Drop the points where the outline goes straight on
+            before = outline - np.roll(outline, 1, axis=0)
+            after = np.roll(outline, -1, axis=0) - outline
+            cross = before[:, 0] * after[:, 1] - before[:, 1] * after[:, 0]
+            straight = (np.abs(cross) <= 10**-9 * np.hypot(*before.T) * np.hypot(*after.T)) & \
+                       ((before * after).sum(axis=1) > 0)
+            if np.count_nonzero(~straight) >= 3:
+                outline = outline[~straight]
+            if signed_area(outline) > 0:
+                outlines.append(outline)
+            elif signed_area(outline) < 0 and not fill_holes:
+                holes.append(outline)
+
+        # Just left of a hole edge is the union, in the smallest outline around the hole
+        located = Polygons(outlines)
+        in_outline = defaultdict(list)
+        for hole in holes:
+            direction = hole[1] - hole[0]
+            length = np.hypot(direction[0], direction[1])
+            point = (hole[0] + hole[1]) / 2 + np.array([-direction[1], direction[0]]) / length * min(tolerance, 0.1 * length)
+            around = [i for i in located.index.query(point, point) if point_in_polygon(outlines[i], point)]
+            if len(around) == 0:
+                raise ValueError("[Polygons] The hole at {} is in no outline!".format(hole[0]))
+            in_outline[min(around, key=lambda i: signed_area(outlines[i]))].append(hole)
+        rings = [ring for i, outline in enumerate(outlines) for ring in [outline] + in_outline[i]]
+        return PolygonSet.from_polygons(rings, [signed_area(ring) < 0 for ring in rings])
+
+    def edge_order(self, rng=None):
+        """ Returns the edges of the polygons in one (E, 2, 2) array made left to right, the polygon
+            index of each edge, whether the polygon interior is above each edge, and a random
+            permutation of the edges to insert them in. The edges of a hole have the index of the
+            outline around it, the polygon its trapezoids are labelled with.
+
+        Args:
+            rng: a np.random.Generator or a seed for one, which makes the permutation reproducible.
+                If None, the permutation comes from the random module, as before.
+        """
+        edges = self.polygons.edges
+        rings = self.polygons.edge_polygon
+        # The interior is left of the edges of counter-clockwise polygons and of clockwise holes
+        interior_left = self.polygons.counterclockwise != self.polygons.holes
+        interior_above = (edges[:, 1, 0] > edges[:, 0, 0]) == interior_left[rings]
+        owners = self.polygons.outlines[rings]
+        if rng is None:
+            order = list(range(len(edges)))
+            random.shuffle(order)
+            order = np.array(order, dtype=np.int64)
+        else:
+            order = np.random.default_rng(rng).permutation(len(edges))
+        return make_lr_many(edges), owners, interior_above, order
+
+    def random_edge_sampler(self, labels=False, rng=None):
+        """Returns an iterator that randomly samples edges without replacement, see edge_order. With labels,
+           it gives (edge, polygon index, whether the polygon interior is above the edge) for PointLocator.add_line."""
+        edges, owners, interior_above, order = self.edge_order(rng)
+        for i in order:
+            yield (edges[i], int(owners[i]), bool(interior_above[i])) if labels else edges[i]
         
     def __getitem__(self, idx):
         return self.polygons[idx]
 
 
+    def polygon_at(self, point):
+        """ Returns the index of a polygon the point is in or on the boundary of, None if there is none.
+            A point in a hole is in no polygon, unless it is in a polygon within the hole."""
+        point = np.asarray(point, dtype=float)
+        around = [int(i) for i in self.index.query(point, point) if point_in_polygon(self.polygons[i], point)]
+        if not self.polygons.holes[around].any():
+            return around[0] if len(around) > 0 else None
+        # The innermost polygon or hole decides
+        innermost = min(around, key=lambda i: abs(self.polygons.areas[i]))
+        if self.polygons.holes[innermost] and point_in_polygon(self.polygons[innermost], point, boundary=False):
+            return None
+        return innermost
+
     def contains_trap(self, trap):
         """Returns whether a polygon surrounds all points."""
         points = trap.raw()
-        for poly in self.polygons:
-            # TODO First check that the bounding boxes overlap to reduce time complexity
-
-            contained = np.zeros(len(points)).astype(bool)
-            for idx in range(len(poly)):
-                edge = make_lr(np.array([poly[idx], poly[(idx + 1) % len(poly)]]))
-                # Check each point to see if they lie on the edge
-                for i, point in enumerate(points):
-                    contained[i] = contained[i] or point_on_edge(edge, point)
-
-            if contained.all():
+        polygons = self.polygons
+        # Only the polygons whose boxes hold the whole trapezoid
+        for i in self.index.query(points.min(axis=0), points.max(axis=0), containing=True):
+            if polygons.holes[i]:
+                continue
+            # The edges of the polygon and of the holes in it
+            end = np.searchsorted(polygons.outlines, i, side="right")
+            edges = make_lr_many(polygons.edges[polygons.offsets[i]:polygons.offsets[end]])
+            # Check each point to see if they lie on an edge
+            if not points_on_edges(edges[:, None], points[None]).any(axis=0).all():
+                continue
+            # A trapezoid filling a hole has its points on the edges too
+            center = points.mean(axis=0)
+            if not any(point_in_polygon(polygons[j], center, boundary=False) for j in range(i + 1, end)):
                 return True
 
         return False
@@ -0,0 +1,362 @@
+""" Bulk construction of the point location structure with a plane sweep over all the edges. """
+
+import numpy as np
+from .point_location import *
+
+
+class _SweepNode(object):
+    """ A node of the persistent AVL tree of the edges crossing a slab, ordered bottom to top.
+        Nodes are never changed after they are made, so the trees of neighbouring slabs share every
+        subtree the sweep did not touch."""
+    __slots__ = ("data", "left", "right", "height")
+
+    def __init__(self, data, left, right):
+        """
+        Args:
+            data (tuple): (edge index, gap below the edge, gap above the edge).
+            left (_SweepNode): the subtree of edges below.
+            right (_SweepNode): the subtree of edges above.
+        """
+        self.data = data
+        self.left = left
+        self.right = right
+        self.height = max(_height(left), _height(right)) + 1
+
+
+def _height(node):
+    return node.height if node is not None else 0
+
+
+def _balance(data, left, right):
+    """ Makes a node from data and the two subtrees, rotating so the heights differ by at most one."""
+    if _height(left) > _height(right) + 1:
+        if _height(left.left) >= _height(left.right):
+            return _SweepNode(left.data, left.left, _SweepNode(data, left.right, right))
+        pivot = left.right
+        return _SweepNode(pivot.data, _SweepNode(left.data, left.left, pivot.left), _SweepNode(data, pivot.right, right))
+    if _height(right) > _height(left) + 1:
+        if _height(right.right) >= _height(right.left):
+            return _SweepNode(right.data, _SweepNode(data, left, right.left), right.right)
+        pivot = right.left
+        return _SweepNode(pivot.data, _SweepNode(data, left, pivot.left), _SweepNode(right.data, pivot.right, right.right))
+    return _SweepNode(data, left, right)
+
+
+def _insert(node, data, compare):
+    """ Returns the tree with data added. compare(edge) is negative if the new edge is below edge."""
+    if node is None:
+        return _SweepNode(data, None, None)
+    if compare(node.data[0]) < 0:
+        return _balance(node.data, _insert(node.left, data, compare), node.right)
+    return _balance(node.data, node.left, _insert(node.right, data, compare))
+
+
+def _pop_min(node):
+    """ Returns the tree without its lowest node, and the data of that node."""
+    if node.left is None:
+        return node.right, node.data
+    left, data = _pop_min(node.left)
+    return _balance(node.data, left, node.right), data
+
+
+def _delete(node, edge, compare):
+    """ Returns the tree without the node of edge."""
+    if node is None:
+        raise ValueError("[sweep] Edge {} is not in the sweep!".format(edge))
+    if node.data[0] == edge:
+        if node.left is None:
+            return node.right
+        if node.right is None:
+            return node.left
+        right, successor = _pop_min(node.right)
+        return _balance(successor, node.left, right)
+    if compare(node.data[0]) < 0:
+        return _balance(node.data, _delete(node.left, edge, compare), node.right)
+    return _balance(node.data, node.left, _delete(node.right, edge, compare))
+
+
+def _find(node, edge, compare):
+    """ Returns the data of the node of edge."""
+    while node is not None and node.data[0] != edge:
+        node = node.left if compare(node.data[0]) < 0 else node.right
+    if node is None:
+        raise ValueError("[sweep] Edge {} is not in the sweep!".format(edge))
+    return node.data
+
+
+def _set_gap(node, edge, compare, below=None, above=None):
+    """ Returns the tree with the gap below and/or above edge replaced."""
+    edge_idx, old_below, old_above = node.data
+    if edge_idx == edge:
+        data = (edge_idx, old_below if below is None else below, old_above if above is None else above)
+        return _SweepNode(data, node.left, node.right)
+    if compare(edge_idx) < 0:
+        return _SweepNode(node.data, _set_gap(node.left, edge, compare, below, above), node.right)
+    return _SweepNode(node.data, node.left, _set_gap(node.right, edge, compare, below, above))
+
+
+def _neighbours(node, compare):
+    """ Returns the edges just below and just above a key, None where there are none.
+        compare(edge) is negative if the key is below edge, zero if the key is edge."""
+    below = None
+    above = None
+    while node is not None:
+        side = compare(node.data[0])
+        if side == 0:
+            if node.left is not None:
+                below = _extreme(node.left, highest=True)
+            if node.right is not None:
+                above = _extreme(node.right, highest=False)
+            break
+        if side < 0:
+            above = node.data[0]
+            node = node.left
+        else:
+            below = node.data[0]
+            node = node.right
+    return below, above
+
+
+def _extreme(node, highest):
+    """ Returns the highest or lowest edge of the tree."""
+    child = node.right if highest else node.left
+    while child is not None:
+        node = child
+        child = node.right if highest else node.left
+    return node.data[0]
+
+
+def _gap_at(node, compare, empty_gap):
+    """ Returns the gap containing a key, empty_gap if there are no edges."""
+    gap = empty_gap
+    while node is not None:
+        if compare(node.data[0]) <= 0:
+            gap = node.data[1]
+            node = node.left
+        else:
+            gap = node.data[2]
+            node = node.right
+    return gap
+
+
+def build_point_locator(edges, bounds, compact=False, labels=False):
+    """ Builds a PointLocator over all the edges at once with a plane sweep over their x coordinates.
+
+    Between each pair of consecutive endpoint x coordinates the edges crossing the slab are kept in a
+    persistent balanced tree of SegmentQuery nodes, so the search structure is a balanced tree of
+    PointQuery nodes over the slabs followed by the tree of the slab. The build is deterministic, takes
+    O(n log n) time and space, and every query visits O(log n) nodes. Edges may only meet at endpoints.
+
+    Args:
+        edges (iterable): (2, 2) arrays of the segments to add.
+        bounds: (x_min, y_min, x_max, y_max) the bounds in which the segments reside.
+        compact (bool): keep the trapezoids in a TrapezoidStore.
+        labels (bool): edges gives (edge, polygon, interior_above) like Polygons.random_edge_sampler,
+            and the trapezoids are labelled with the polygon they lie in as in PointLocator.add_line.
+    """
+    min_x, min_y, max_x, max_y = bounds
+    # Sorted, so the result does not depend on the order of the edges
+    edge_list = {}
+    edge_occupants = {}
+    for edge in edges:
+        polygon, interior_above = -1, True
+        if labels:
+            edge, polygon, interior_above = edge
+        edge = make_lr(np.array(edge, dtype=float))
+        edge_list[segment_key(edge)] = edge
+        edge_occupants[segment_key(edge)] = (polygon, -1) if interior_above else (-1, polygon)
+    # The (above, below) occupants of each edge
+    edge_occupants = [edge_occupants[key] for key in sorted(edge_list)]
+    edge_list = [edge_list[key] for key in sorted(edge_list)]
+
+    # The edges starting and ending at each x, and all the endpoints there by y
+    starts = defaultdict(list)
+    ends = defaultdict(list)
+    points = defaultdict(dict)
+    for idx, edge in enumerate(edge_list):
+        if edge[0, 0] < edge[1, 0]:
+            starts[edge[0, 0]].append(idx)
+            ends[edge[1, 0]].append(idx)
+        for point in edge:
+            points[point[0]][point[1]] = point
+
+    def order(idx):
+        """ Compares edges against edge idx in the middle of where both exist."""
+        edge = edge_list[idx]
+        def compare(other_idx):
+            if other_idx == idx:
+                return 0
+            other = edge_list[other_idx]
+            x = (max(edge[0, 0], other[0, 0]) + min(edge[1, 0], other[1, 0])) / 2.0
+            diff = endpoint_interpolation(edge, x) - endpoint_interpolation(other, x)
+            if diff == 0:
+                diff = idx - other_idx
+            return -1 if diff < 0 else 1
+        return compare
+
+    def height(x, y):
+        """ Compares edges against the point (x, y)."""
+        def compare(other_idx):
+            diff = y - endpoint_interpolation(edge_list[other_idx], x)
+            return -1 if diff < 0 else (0 if diff == 0 else 1)
+        return compare
+
+    def y_below(idx, x):
+        return min_y if idx is None else endpoint_interpolation(edge_list[idx], x)
+
+    def y_above(idx, x):
+        return max_y if idx is None else endpoint_interpolation(edge_list[idx], x)
+
+    def originator(x, ys, low, high):
+        """ Returns the endpoint at x on the wall between the y values low and high."""
+        for y in ys:
+            if low - 10**-6 <= y <= high + 10**-6:
+                return points[x][y]
+        raise ValueError("[sweep] No endpoint on the wall at {} between {} and {}!".format(x, low, high))
+
+    # Each gap between consecutive edges becomes one trapezoid:
+    # [edge below, edge above, left x, left originator, right x, right originator]
+    gaps = [[None, None, min_x, None, None, None]]
+    empty_gap = 0
+    root = None
+    slabs = []
+    xs = sorted(points.keys())
+    for x in xs:
+        slabs.append((root, empty_gap))
+        ys = sorted(points[x].keys())
+
+        # 1) Close the gaps the walls at x cut off: the ones next to an ending edge or with an endpoint in them
+        closing = set()
+        for idx in ends[x]:
+            _, below, above = _find(root, idx, order(idx))
+            closing.update([below, above])
+        for y in ys:
+            closing.add(_gap_at(root, height(x, y), empty_gap))
+        for gap_idx in closing:
+            gap = gaps[gap_idx]
+            gap[4] = x
+            gap[5] = originator(x, ys, y_below(gap[0], x), y_above(gap[1], x))
+
+        # 2) Move the sweep past x
+        for idx in ends[x]:
+            root = _delete(root, idx, order(idx))
+        for idx in starts[x]:
+            root = _insert(root, (idx, None, None), order(idx))
+
+        # 3) Open the gaps right of the walls
+        pairs = []
+        starting_points = set()
+        for idx in starts[x]:
+            below, above = _neighbours(root, order(idx))
+            pairs.extend([(below, idx), (idx, above)])
+            starting_points.add(edge_list[idx][0, 1])
+        for y in ys:
+            if y not in starting_points:
+                pairs.append(_neighbours(root, height(x, y)))
+        for below, above in dict.fromkeys(pairs):
+            gap_idx = len(gaps)
+            gaps.append([below, above, x, originator(x, ys, y_below(below, x), y_above(above, x)), None, None])
+            if below is not None:
+                root = _set_gap(root, below, order(below), above=gap_idx)
+            if above is not None:
+                root = _set_gap(root, above, order(above), below=gap_idx)
+            if below is None and above is None:
+                empty_gap = gap_idx
+    slabs.append((root, empty_gap))
+
+    # The trapezoids, with the gap numbers as indices
+    point_locator = PointLocator(bounds, compact)
+    point_locator.trapezoids = Trapezoids(compact)
+    for below, above, left_x, left_originator, right_x, right_originator in gaps:
+        if right_x is None:
+            right_x = max_x
+        bottom_left = y_below(below, left_x)
+        bottom_right = y_below(below, right_x)
+        top_left = y_above(above, left_x)
+        top_right = y_above(above, right_x)
+        vertices = [[left_x, bottom_left], [right_x, bottom_right]]
+        if top_right != bottom_right:
+            vertices.append([right_x, top_right])
+        if top_left != bottom_left:
+            vertices.append([left_x, top_left])
+        trap_originators = [p for p in (left_originator, right_originator) if p is not None]
+        top_line = np.array([[left_x, top_left], [right_x, top_right]], dtype=float)
+        bottom_line = np.array([[left_x, bottom_left], [right_x, bottom_right]], dtype=float)
+        occupants = (-1 if above is None else edge_occupants[above][1], -1 if below is None else edge_occupants[below][0])
+        point_locator.trapezoids.add(Trapezoid.from_lines(np.array(vertices, dtype=float), top_line, bottom_line,
+                                                          trap_originators, occupants))
+
+    # The search structure, sharing the query of every node the slabs share
+    queries = {}
+    def to_query(node, empty_gap):
+        if node is None:
+            return empty_gap
+        if id(node) not in queries:
+            idx, below, above = node.data
+            true_child = above if node.right is None else to_query(node.right, empty_gap)
+            false_child = below if node.left is None else to_query(node.left, empty_gap)
+            query = SegmentQuery(edge_list[idx], true_child, false_child)
+            for child in (true_child, false_child):
+                if isinstance(child, int):
+                    point_locator.trapezoids[child].add_parent(query)
+            queries[id(node)] = query
+        return queries[id(node)]
+
+    leaves = [to_query(node, empty_gap) for node, empty_gap in slabs]
+    slab_tree = point_locator.x_split_tree(xs, leaves)
+    point_locator.tree_root = PointQuery(min_x, "failure", slab_tree)
+    if isinstance(slab_tree, int):
+        point_locator.trapezoids[slab_tree].add_parent(point_locator.tree_root)
+
+    for edge in edge_list:
+        point_locator.edge_history.append(edge)
+        point_locator.track_segment(edge, 1)
+    point_locator.depth_stats()
+    return point_locator
+
+
+def rebuild_search_structure(point_locator):
+    """ Replaces the search structure of a PointLocator by the one build_point_locator makes over its
+        segments, keeping the trapezoids and their indices. After many add_line and remove_line calls
+        this brings the structure back to the depth of a fresh build.
+
+    Returns:
+        bool: whether the structure was replaced. Nothing changes when the sweep cuts the plane
+            into other trapezoids than the point locator has.
+    """
+    built = build_point_locator(list(point_locator.segments.values()), point_locator.bounds)
+    traps = [(idx, trap) for idx, trap in enumerate(built.trapezoids.trapezoids) if trap is not None]
+    if len(traps) != point_locator.trapezoids.trap_count():
+        return False
+
+    # Each new trapezoid is the one of the point locator around its center
+    located = point_locator.query_many(np.array([trap.raw().mean(axis=0) for _, trap in traps]))
+    indices = {}
+    for (idx, trap), trap_idx in zip(traps, located):
+        old = point_locator.trapezoids[trap_idx] if trap_idx != FAILURE_INDEX else None
+        if old is None or not (np.allclose(old.top(), trap.top(), atol=10**-6) and
+                               np.allclose(old.bottom(), trap.bottom(), atol=10**-6)):
+            return False
+        indices[idx] = int(trap_idx)
+    if len(set(indices.values())) != len(indices):
+        return False
+
+    # The nodes of the sweep, on the trapezoids and the segment arrays of the point locator
+    parents = defaultdict(list)
+    for node in built.query_nodes():
+        if isinstance(node, SegmentQuery):
+            node.x = point_locator.segments[segment_key(node.x)]
+        children = []
+        for child in (node.true_child, node.false_child):
+            if isinstance(child, int):
+                child = indices[child]
+                parents[child].append(node)
+            children.append(child)
+        node.true_child, node.false_child = children
+    for trap_idx, trap_parents in parents.items():
+        point_locator.trapezoids[trap_idx].parents = trap_parents
+    point_locator.tree_root = built.tree_root
+    point_locator.compiled = None
+    point_locator.grid = None
+    point_locator.depth_stats()
+    return True
@@ -15,23 +15,56 @@ class Trapezoid(object):
             originator_vertices (list): the vertices that originated the left and right lines, if applicable.
         """
         self.vertices = vertices
-        # find two topmost point
-        y_sorted = np.argsort(self.vertices[:, 1])
-        idx = 2
-        if len(vertices) == 3:
-            idx = 1
         self.top_line = self.set_line(top=True)
         self.bottom_line = self.set_line(top=False)
         self.left_p = self.vertices[np.argmin(self.vertices[:, 0])]
         self.right_p = self.vertices[np.argmax(self.vertices[:, 0])]
         assert(self.left_p[0] < self.right_p[0]), "left p: {} right_p: {}  all points: {}".format(self.left_p, self.right_p, self.vertices)
+        self.init_state(originator_vertices)
+
+    @classmethod
+    def from_lines(cls, vertices, top_line, bottom_line, originator_vertices=(), occupants=(-1, -1)):
+        """ Makes a trapezoid whose top and bottom lines are already known, without analysing the vertices.
+
+        Args:
+            vertices (np.ndarray): An (n, 2) array of 2d vertex coordinates.
+            top_line (np.ndarray): the (2, 2) left-to-right top line.
+            bottom_line (np.ndarray): the (2, 2) left-to-right bottom line.
+            originator_vertices (list): the vertices that originated the left and right lines, if applicable.
+            occupants (tuple): the top_occupant and bottom_occupant, see init_state.
+        """
+        trapezoid = cls.__new__(cls)
+        trapezoid.vertices = vertices
+        trapezoid.top_line = top_line
+        trapezoid.bottom_line = bottom_line
+        trapezoid.left_p = bottom_line[0]
+        trapezoid.right_p = bottom_line[1]
+        trapezoid.init_state(originator_vertices, occupants)
+        return trapezoid
+
+    def init_state(self, originator_vertices, occupants=(-1, -1)):
+        """Sets the line fits, the occupants, the originators and the empty links of a new trapezoid."""
+        # Slope, intercept and x bounds of the top and bottom lines, see line_fit
+        self.top_fit = line_fit(self.top_line)
+        self.bottom_fit = line_fit(self.bottom_line)
+        # The polygon whose interior is just below the top line / just above the bottom line, -1 if
+        # that side of the segment is outside its polygon or the line is not a polygon edge
+        self.top_occupant, self.bottom_occupant = occupants
         self.parents = []
+        # Indices of the trapezoids sharing the left / right wall, bottom to top. Kept by Trapezoids.
+        self.left_neighbors = []
+        self.right_neighbors = []
+        # (bottom, top) of the left and right walls, set when added to Trapezoids
+        self.walls = None
 
         # Can have at most 2 originators
         assert(len(originator_vertices) <= 2)
         self.originators = []
-        if len(originator_vertices) > 0:
-            self.originators = make_lr(np.array(originator_vertices))
+        if len(originator_vertices) == 1:
+            self.originators = np.array(originator_vertices)
+        elif len(originator_vertices) == 2:
+            left_idx = 0 if originator_vertices[0][0] <= originator_vertices[1][0] else 1
+            self.originators = np.array([originator_vertices[left_idx], originator_vertices[1 - left_idx]])
         self.index = 0 
 
     def __repr__(self):
@@ -85,6 +118,32 @@ class Trapezoid(object):
         """Returns the right-most point of the trapezoid."""
         return self.right_p
     
+    @property
+    def occupant(self):
+        """The polygon the trapezoid lies in, -1 for free space. Only final once every edge of the
+           polygons bounding it has been added."""
+        return self.top_occupant if self.top_occupant >= 0 else self.bottom_occupant
+
+    @property
+    def upper_left(self):
+        """Index of the highest trapezoid sharing the left wall, None if there is none."""
+        return self.left_neighbors[-1] if len(self.left_neighbors) > 0 else None
+
+    @property
+    def lower_left(self):
+        """Index of the lowest trapezoid sharing the left wall, None if there is none."""
+        return self.left_neighbors[0] if len(self.left_neighbors) > 0 else None
+
+    @property
+    def upper_right(self):
+        """Index of the highest trapezoid sharing the right wall, None if there is none."""
+        return self.right_neighbors[-1] if len(self.right_neighbors) > 0 else None
+
+    @property
+    def lower_right(self):
+        """Index of the lowest trapezoid sharing the right wall, None if there is none."""
+        return self.right_neighbors[0] if len(self.right_neighbors) > 0 else None
+
     def is_intersected(self, edge):
         """ Returns whether an edge intersects the trapezoid."""
         assert(edge[0, 0] <= edge[1, 0])
@@ -94,8 +153,8 @@ class Trapezoid(object):
             criteria_bottom_left = linear_interpolation(edge, self.bottom_line[0, 0]) >= self.bottom_line[0, 1] - 10 **-6
 
         else: 
-            criteria_top_left = edge[0, 1] <= linear_interpolation(self.top_line, edge[0, 0]) + 10**-6
-            criteria_bottom_left = edge[0, 1] >= linear_interpolation(self.bottom_line, edge[0, 0]) - 10**-6
+            criteria_top_left = edge[0, 1] <= fit_interpolation(self.top_fit, edge[0, 0]) + 10**-6
+            criteria_bottom_left = edge[0, 1] >= fit_interpolation(self.bottom_fit, edge[0, 0]) - 10**-6
 
         if not criteria_top_left or not criteria_bottom_left:
             return False
@@ -106,8 +165,8 @@ class Trapezoid(object):
             criteria_bottom_right = linear_interpolation(edge, self.bottom_line[1, 0]) >= self.bottom_line[1, 1] - 10**-6
 
         else: 
-            criteria_top_right = edge[1, 1] <= linear_interpolation(self.top_line, edge[1, 0]) + 10**-6
-            criteria_bottom_right = edge[1, 1] >= linear_interpolation(self.bottom_line, edge[1, 0]) - 10**-6
+            criteria_top_right = edge[1, 1] <= fit_interpolation(self.top_fit, edge[1, 0]) + 10**-6
+            criteria_bottom_right = edge[1, 1] >= fit_interpolation(self.bottom_fit, edge[1, 0]) - 10**-6
 
         if not criteria_top_right or not criteria_bottom_right:
             return False
@@ -125,8 +184,8 @@ class Trapezoid(object):
         if point[0] < self.left_p[0] or point[0] > self.right_p[0]:
             return False
 
-        y_upper = linear_interpolation(self.top_line, point[0])
-        y_lower = linear_interpolation(self.bottom_line, point[0])
+        y_upper = fit_interpolation(self.top_fit, point[0])
+        y_lower = fit_interpolation(self.bottom_fit, point[0])
 
         if point[1] < y_lower - 10**-6 or point[1] > y_upper + 10**-6:
             return False
@@ -137,17 +196,33 @@ class Trapezoid(object):
         if point[0] <= self.left_p[0] or point[0] >= self.right_p[0]:
             return False
 
-        y_upper = linear_interpolation(self.top_line, point[0])
-        y_lower = linear_interpolation(self.bottom_line, point[0])
+        y_upper = fit_interpolation(self.top_fit, point[0])
+        y_lower = fit_interpolation(self.bottom_fit, point[0])
 
         if point[1] <= y_lower or point[1] >= y_upper:
             return False
         return True
-    
+
+    def includes_points(self, points, loose=False):
+        """Returns the mask of the (N, 2) points inside the trapezoid, on edges counting if loose."""
+        return includes_points_mask(self.top_line, self.bottom_line, self.left_p[0], self.right_p[0],
+                                    np.asarray(points, dtype=float), loose)
+
     def raw(self):
         """Returns the raw vertices of the trapezoid."""
         return self.vertices
 
+    def extent(self, x):
+        """Returns the lowest and highest y of the trapezoid at x, read from the vertices directly."""
+        ys = []
+        for i, a in enumerate(self.vertices):
+            if a[0] == x:
+                ys.append(a[1])
+            for b in self.vertices[i + 1:]:
+                if min(a[0], b[0]) < x < max(a[0], b[0]):
+                    ys.append(linear_interpolation(make_lr(np.array([a, b])), x))
+        return min(ys), max(ys)
+
     def is_left_pointed(self):
         """Returns whether the trapezoid converges to a point on the left side."""
         top_y = self.top_line[0, 1]
@@ -160,24 +235,29 @@ class Trapezoid(object):
         bottom_y = self.bottom_line[1, 1]
         return top_y == bottom_y
 
-    def split_by(self, edge):
+    def split_by(self, edge, intersected=None, occupants=(-1, -1)):
         """ Returns the trapezoids formed as a result of splitting by an edge. 
             `top`: trapezoid on top
             `left`: trapezoid on left
             `right`: trapezoid on right
             `bottom`: trapezoid on bottom
+            intersected is whether the edge intersects the trapezoid, tested here if None.
+            occupants is the (above, below) polygon the edge bounds the interior of on each side, -1
+            for none. It becomes the bottom_occupant of `top` and the top_occupant of `bottom`.
         """
         new_traps = {}
         merge = {}
         curr_trap = self
 
-        if curr_trap.is_intersected(edge):
+        if intersected is None:
+            intersected = curr_trap.is_intersected(edge)
+        if intersected:
             assert(edge[0, 0] <= edge[1, 0])
             for i, key in enumerate(["left", "right"]):
                 if curr_trap.includes_point(edge[i]):
                     # Top and bottom of the line from the line endpoint
-                    top_point = [edge[i][0], linear_interpolation(curr_trap.top_line, edge[i][0])]
-                    bottom_point = [edge[i][0], linear_interpolation(curr_trap.bottom_line, edge[i][0])]
+                    top_point = [edge[i][0], fit_interpolation(curr_trap.top_fit, edge[i][0])]
+                    bottom_point = [edge[i][0], fit_interpolation(curr_trap.bottom_fit, edge[i][0])]
                     center_points = [top_point, bottom_point]
 
                     points = [curr_trap.bottom_line[i]]
@@ -203,17 +283,29 @@ class Trapezoid(object):
                     new_originators.append(edge[i])
                     leftover_originators.append(edge[i])
 
-                    trap = Trapezoid(points, new_originators)
+                    # The lines of both pieces run between the old lines and the wall through the endpoint
+                    wall_top = np.array(top_point)
+                    wall_bottom = np.array(bottom_point)
+                    if i == 0:
+                        lines = (np.array([curr_trap.top_line[0], wall_top]), np.array([curr_trap.bottom_line[0], wall_bottom]))
+                        leftover_lines = (np.array([wall_top, curr_trap.top_line[1]]), np.array([wall_bottom, curr_trap.bottom_line[1]]))
+                    else:
+                        lines = (np.array([wall_top, curr_trap.top_line[1]]), np.array([wall_bottom, curr_trap.bottom_line[1]]))
+                        leftover_lines = (np.array([curr_trap.top_line[0], wall_top]), np.array([curr_trap.bottom_line[0], wall_bottom]))
+
+                    kept_occupants = (curr_trap.top_occupant, curr_trap.bottom_occupant)
+                    trap = Trapezoid.from_lines(points, lines[0], lines[1], new_originators, kept_occupants)
                     new_traps[key] = trap
 
                     # Make the remaining trapezoid:
-                    curr_trap = Trapezoid(leftover_points, leftover_originators)
+                    curr_trap = Trapezoid.from_lines(leftover_points, leftover_lines[0], leftover_lines[1], leftover_originators,
+                                                     kept_occupants)
 
             # Split the remaining trapezoid area into top and bottom
             if edge[0, 0] < edge[1, 0]:
                 # Center line for split
-                center_left = [curr_trap.left_p[0], linear_interpolation(edge, curr_trap.left_p[0])]
-                center_right = [curr_trap.right_p[0], linear_interpolation(edge, curr_trap.right_p[0])]
+                center_left = [curr_trap.left_p[0], endpoint_interpolation(edge, curr_trap.left_p[0])]
+                center_right = [curr_trap.right_p[0], endpoint_interpolation(edge, curr_trap.right_p[0])]
                 center_points = np.array([center_right, center_left])
 
                 # Top and bottom trapezoid points
@@ -228,8 +320,14 @@ class Trapezoid(object):
                     if originator[0] in bottom_points[:, 0]:
                         bottom_originators.append(originator)
 
-                new_traps["top"] = Trapezoid(top_points, top_originators)
-                new_traps["bottom"] = Trapezoid(bottom_points, bottom_originators)
+                center_line = center_points[::-1]
+                # Copies, as the lines of a stored trapezoid are views of a row that gets reused
+                top_line = np.array(curr_trap.top_line)
+                bottom_line = np.array(curr_trap.bottom_line)
+                new_traps["top"] = Trapezoid.from_lines(top_points, top_line, center_line, top_originators,
+                                                        (curr_trap.top_occupant, occupants[0]))
+                new_traps["bottom"] = Trapezoid.from_lines(bottom_points, center_line, bottom_line, bottom_originators,
+                                                           (occupants[1], curr_trap.bottom_occupant))
 
             else: # case of vertical edge, split into left and right
                 assert("right" not in new_traps)
@@ -239,13 +337,291 @@ class Trapezoid(object):
         return new_traps
 
 
+class TrapezoidView(Trapezoid):
+    """A Trapezoid whose data lives in a row of a TrapezoidStore."""
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def set_idx(self, i):
+        """The row of a view is fixed."""
+        assert(i == self.index)
+
+    @property
+    def vertices(self):
+        return self.store.vertices[self.index, :self.store.vertex_count[self.index]]
+
+    @property
+    def top_line(self):
+        return self.store.top_lines[self.index]
+
+    @property
+    def bottom_line(self):
+        return self.store.bottom_lines[self.index]
+
+    @property
+    def left_p(self):
+        return self.store.vertices[self.index, self.store.left_vertex[self.index]]
+
+    @property
+    def right_p(self):
+        return self.store.vertices[self.index, self.store.right_vertex[self.index]]
+
+    @property
+    def top_fit(self):
+        return self.store.fits[self.index, 0].tolist()
+
+    @property
+    def bottom_fit(self):
+        return self.store.fits[self.index, 1].tolist()
+
+    @property
+    def top_occupant(self):
+        return int(self.store.occupants[self.index, 0])
+
+    @property
+    def bottom_occupant(self):
+        return int(self.store.occupants[self.index, 1])
+
+    @property
+    def originators(self):
+        count = self.store.originator_count[self.index]
+        if count == 0:
+            return []
+        return self.store.originators[self.index, :count]
+
+    @property
+    def walls(self):
+        # Rows are linked as soon as they are added, so the walls are always set
+        return self.store.walls[self.index]
+
+    @walls.setter
+    def walls(self, walls):
+        self.store.walls[self.index] = np.nan if walls is None else walls
+
+    @property
+    def parents(self):
+        return self.store.parents[self.index]
+
+    @parents.setter
+    def parents(self, parents):
+        self.store.parents[self.index] = parents
+
+    @property
+    def left_neighbors(self):
+        # A copy of the row, changes go through the setter
+        return self.store.neighbors(self.index, 0)
+
+    @left_neighbors.setter
+    def left_neighbors(self, neighbors):
+        self.store.set_neighbors(self.index, 0, neighbors)
+
+    @property
+    def right_neighbors(self):
+        return self.store.neighbors(self.index, 1)
+
+    @right_neighbors.setter
+    def right_neighbors(self, neighbors):
+        self.store.set_neighbors(self.index, 1, neighbors)
+
+
+class TrapezoidStore(object):
+    """Holds trapezoids in growable columns instead of one object each. Behaves like the list of
+       Trapezoids uses: indexing gives a TrapezoidView (or None for a removed row), assigning a
+       Trapezoid copies it into the row and assigning None removes it."""
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.alive = np.zeros(capacity, dtype=bool)
+        # At most 4 vertices per trapezoid
+        self.vertices = np.zeros((capacity, 4, 2))
+        self.vertex_count = np.zeros(capacity, dtype=np.int8)
+        self.left_vertex = np.zeros(capacity, dtype=np.int8)
+        self.right_vertex = np.zeros(capacity, dtype=np.int8)
+        self.top_lines = np.zeros((capacity, 2, 2))
+        self.bottom_lines = np.zeros((capacity, 2, 2))
+        # line_fit of the top and bottom lines
+        self.fits = np.zeros((capacity, 2, 4))
+        self.occupants = np.full((capacity, 2), -1, dtype=np.int64)
+        self.originators = np.zeros((capacity, 2, 2))
+        self.originator_count = np.zeros(capacity, dtype=np.int8)
+        self.walls = np.full((capacity, 2, 2), np.nan)
+        # The search structure nodes pointing at each row, objects rather than rows so kept in lists
+        self.parents = []
+        # The rows across the left and right wall of each row, sorted by wall height, as CSR blocks of
+        # neighbor_data. Links come and go as the map changes, so a block has spare capacity and moves
+        # to the end of neighbor_data when it outgrows it, see set_neighbors.
+        self.neighbor_start = np.zeros((capacity, 2), dtype=np.int64)
+        self.neighbor_count = np.zeros((capacity, 2), dtype=np.int32)
+        self.neighbor_capacity = np.zeros((capacity, 2), dtype=np.int32)
+        self.neighbor_data = np.zeros(4 * capacity, dtype=np.int64)
+        self.neighbor_end = 0
+
+    def grow(self):
+        """Doubles the capacity of the columns."""
+        for name in ("alive", "vertices", "vertex_count", "left_vertex", "right_vertex", "top_lines",
+                     "bottom_lines", "fits", "occupants", "originators", "originator_count", "walls",
+                     "neighbor_start", "neighbor_count", "neighbor_capacity"):
+            column = getattr(self, name)
+            grown = np.zeros((2 * len(column),) + column.shape[1:], dtype=column.dtype)
+            if name == "walls":
+                grown[:] = np.nan
+            elif name == "occupants":
+                grown[:] = -1
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+    def nbytes(self):
+        """Returns the memory used by the array columns."""
+        return sum(getattr(self, name).nbytes for name in
+                   ("alive", "vertices", "vertex_count", "left_vertex", "right_vertex", "top_lines",
+                    "bottom_lines", "fits", "occupants", "originators", "originator_count", "walls",
+                    "neighbor_start", "neighbor_count", "neighbor_capacity", "neighbor_data"))
+
+    def neighbors(self, idx, side):
+        """Returns the list of rows across the left (side 0) or right (side 1) wall of row idx."""
+        start = self.neighbor_start[idx, side]
+        return self.neighbor_data[start:start + self.neighbor_count[idx, side]].tolist()
+
+    def set_neighbors(self, idx, side, neighbors):
+        """Sets the rows across the left (side 0) or right (side 1) wall of row idx."""
+        count = len(neighbors)
+        if count > self.neighbor_capacity[idx, side]:
+            capacity = max(2, 2 * count)
+            if self.neighbor_end + capacity > len(self.neighbor_data):
+                self.pack_neighbors(capacity)
+            self.neighbor_start[idx, side] = self.neighbor_end
+            self.neighbor_capacity[idx, side] = capacity
+            self.neighbor_end += capacity
+        start = self.neighbor_start[idx, side]
+        self.neighbor_data[start:start + count] = neighbors
+        self.neighbor_count[idx, side] = count
+
+    def pack_neighbors(self, extra):
+        """Moves the neighbor blocks next to each other, dropping the space of the ones that moved
+           away, and makes room for extra more entries after them."""
+        counts = self.neighbor_count[:self.count].ravel()
+        capacities = np.maximum(counts, 2)
+        starts = np.concatenate([[0], np.cumsum(capacities)[:-1]]).astype(np.int64)
+        self.neighbor_end = int(capacities.sum())
+        data = np.zeros(max(2 * (self.neighbor_end + extra), len(self.neighbor_data)), dtype=np.int64)
+        # The position of each entry within its block
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        data[np.repeat(starts, counts) + within] = \
+            self.neighbor_data[np.repeat(self.neighbor_start[:self.count].ravel(), counts) + within]
+        self.neighbor_data = data
+        self.neighbor_start[:self.count] = starts.reshape(-1, 2)
+        self.neighbor_capacity[:self.count] = capacities.reshape(-1, 2)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for idx in range(self.count):
+            yield self[idx]
+
+    def __getitem__(self, idx):
+        if idx < 0 or idx >= self.count:
+            raise IndexError("[TrapezoidStore] Index {} out of range!".format(idx))
+        if not self.alive[idx]:
+            return None
+        return TrapezoidView(self, idx)
+
+    def __setitem__(self, idx, trapezoid):
+        if trapezoid is None:
+            self.alive[idx] = False
+            self.walls[idx] = np.nan
+            self.parents[idx] = []
+            self.neighbor_count[idx] = 0
+            return
+
+        vertices = trapezoid.vertices
+        assert(len(vertices) <= 4)
+        self.alive[idx] = True
+        self.vertices[idx, :len(vertices)] = vertices
+        self.vertex_count[idx] = len(vertices)
+        self.left_vertex[idx] = np.argmin(vertices[:, 0])
+        self.right_vertex[idx] = np.argmax(vertices[:, 0])
+        self.top_lines[idx] = trapezoid.top_line
+        self.bottom_lines[idx] = trapezoid.bottom_line
+        self.fits[idx] = (trapezoid.top_fit, trapezoid.bottom_fit)
+        self.occupants[idx] = (trapezoid.top_occupant, trapezoid.bottom_occupant)
+        self.originator_count[idx] = len(trapezoid.originators)
+        if len(trapezoid.originators) > 0:
+            self.originators[idx, :len(trapezoid.originators)] = trapezoid.originators
+        self.walls[idx] = np.nan if trapezoid.walls is None else trapezoid.walls
+        self.parents[idx] = list(trapezoid.parents)
+        neighbors = (trapezoid.left_neighbors, trapezoid.right_neighbors)
+        for side in range(2):
+            self.set_neighbors(idx, side, neighbors[side])
+
+    def append(self, trapezoid):
+        """Adds a row at the end, removed if trapezoid is None."""
+        if self.count == len(self.alive):
+            self.grow()
+        self.count += 1
+        self.parents.append([])
+        self[self.count - 1] = trapezoid
+
+
+# Below this many trapezoids intersected_by tests them one by one, as gathering their lines for
+# intersected_mask costs more
+MIN_BLOCK = 24
+
+
+def interpolate_lines(lines, x):
+    """Vectorized linear_interpolation: the y of each left-to-right line in the (..., 2, 2) array at
+       the x values broadcast against it, -1000000000 outside the line."""
+    y, in_range = interpolate_edges(lines, x)
+    return np.where(in_range, y, -1000000000)
+
+
+def intersected_mask(top_lines, bottom_lines, left_x, right_x, edge):
+    """Trapezoid.is_intersected of one left-to-right edge against a block of trapezoids, given by
+       their (N, 2, 2) top and bottom lines and (N,) left and right x."""
+    assert(edge[0, 0] <= edge[1, 0])
+    # Indexed by [left / right end, top / bottom line, trapezoid]
+    lines = np.stack((top_lines, bottom_lines))
+    corner_x = lines[..., 0].transpose(2, 0, 1)
+    corner_y = lines[..., 1].transpose(2, 0, 1)
+    # Past the trapezoid the edge has to pass between the corners, else the endpoint between the lines
+    outside = np.stack((edge[0, 0] < top_lines[:, 0, 0], edge[1, 0] > top_lines[:, 1, 0]))[:, None]
+    edge_y = np.where(outside, interpolate_lines(edge, corner_x), edge[:, 1].reshape(2, 1, 1))
+    line_y = np.where(outside, corner_y, interpolate_lines(lines, edge[:, 0].reshape(2, 1, 1)))
+    between = (edge_y[:, 0] <= line_y[:, 0] + 10**-6) & (edge_y[:, 1] >= line_y[:, 1] - 10**-6)
+    return between[0] & between[1] & (edge[1, 0] > left_x) & (edge[0, 0] < right_x)
+
+
+def includes_points_mask(top_lines, bottom_lines, left_x, right_x, points, loose=False):
+    """Trapezoid.includes_point (or includes_point_loose) with the lines, left and right x and the
+       (..., 2) points broadcast against each other: one point against many trapezoids, many points
+       against one, or each point against its own trapezoid."""
+    x = points[..., 0]
+    y = points[..., 1]
+    y_upper = interpolate_lines(top_lines, x)
+    y_lower = interpolate_lines(bottom_lines, x)
+    if loose:
+        return (x >= left_x) & (x <= right_x) & (y >= y_lower - 10**-6) & (y <= y_upper + 10**-6)
+    return (x > left_x) & (x < right_x) & (y > y_lower) & (y < y_upper)
+
+
 class Trapezoids(object):
     """A class to hold a list of joint trapezoids"""
-    def __init__(self):
-        self.trapezoids = []
+    def __init__(self, compact=False):
+        """
+        Args:
+            compact (bool): keep the trapezoids in a TrapezoidStore instead of a list of objects.
+        """
+        self.trapezoids = TrapezoidStore() if compact else []
         self.to_remove = []
         # For finding right adjacent
         self.by_left_x = {}
+        # For linking neighbors: wall x to the trapezoids with a left / right wall there
+        self.left_walls = {}
+        self.right_walls = {}
+        # If a set, the indices of the trapezoids added, removed or replaced are recorded in it
+        self.changed = None
 
     def trap_list(self):
         """Returns all the trapezoids in point form."""
@@ -301,14 +677,148 @@ class Trapezoids(object):
                 break
         return right_adjacent
 
+    def next_along(self, index, edge):
+        """Returns the trapezoid the left-to-right edge enters through the right wall of the trapezoid at
+           index, None if it does not leave through the right wall."""
+        trap = self.trapezoids[index]
+        x = trap.rightp()[0]
+        if x >= edge[1, 0]:
+            return None
+        y = linear_interpolation(edge, x)
+        candidates = [idx for idx in reversed(trap.right_neighbors)
+                      if self.trapezoids[idx].walls[0][0] - 10**-6 <= y <= self.trapezoids[idx].walls[0][1] + 10**-6]
+        if len(candidates) == 1:
+            return candidates[0]
+        if len(candidates) == 0:
+            # Walls that only meet at a point are not linked, look through the index
+            candidates = self.right_adjacent(index)
+        if len(candidates) == 0:
+            return None
+        intersected = np.flatnonzero(self.intersected_by(edge, candidates))
+        return candidates[intersected[0]] if len(intersected) > 0 else None
+
+    def neighbor_toward(self, index, point):
+        """Returns the trapezoid across the left or right wall of the trapezoid at index in the direction
+           of a point left or right of it, None if the point is not beside it or the wall is not linked."""
+        trap = self.trapezoids[index]
+        if point[0] > trap.rightp()[0]:
+            side, neighbors = 1, trap.right_neighbors
+        elif point[0] < trap.leftp()[0]:
+            side, neighbors = 0, trap.left_neighbors
+        else:
+            return None
+        if len(neighbors) == 0:
+            return None
+        # Cross the wall as close to the height of the point as the wall allows
+        bottom, top = trap.walls[side]
+        y = min(max(point[1], bottom), top)
+        best = None
+        best_distance = None
+        for idx in neighbors:
+            other_bottom, other_top = self.trapezoids[idx].walls[1 - side]
+            distance = max(other_bottom - y, y - other_top, 0)
+            if best is None or distance < best_distance:
+                best, best_distance = idx, distance
+        return best
+
+    def line_arrays(self, indices):
+        """Returns the (N, 2, 2) top and bottom lines and the (N,) left and right x of the trapezoids
+           at indices, for the array versions of the trapezoid tests."""
+        if isinstance(self.trapezoids, TrapezoidStore):
+            store = self.trapezoids
+            indices = np.asarray(indices, dtype=int)
+            left_x = store.vertices[indices, store.left_vertex[indices], 0]
+            right_x = store.vertices[indices, store.right_vertex[indices], 0]
+            return store.top_lines[indices], store.bottom_lines[indices], left_x, right_x
+        traps = [self.trapezoids[idx] for idx in indices]
+        return (np.array([trap.top_line for trap in traps]).reshape(-1, 2, 2),
+                np.array([trap.bottom_line for trap in traps]).reshape(-1, 2, 2),
+                np.array([trap.left_p[0] for trap in traps], dtype=float),
+                np.array([trap.right_p[0] for trap in traps], dtype=float))
+
+    def intersected_by(self, edge, indices):
+        """Returns the mask of the trapezoids at indices that the left-to-right edge intersects, with
+           intersected_mask for blocks of MIN_BLOCK trapezoids or more. The add_line walk mostly asks
+           about a handful at a time, which are tested one by one."""
+        if len(indices) < MIN_BLOCK:
+            return np.array([self.trapezoids[idx].is_intersected(edge) for idx in indices], dtype=bool)
+        top_lines, bottom_lines, left_x, right_x = self.line_arrays(indices)
+        return intersected_mask(top_lines, bottom_lines, left_x, right_x, edge)
+
+    def contain_points(self, indices, points, loose=True):
+        """Returns whether each of the (N, 2) points is in the trapezoid at the same place of indices,
+           on the edges counting if loose."""
+        top_lines, bottom_lines, left_x, right_x = self.line_arrays(indices)
+        return includes_points_mask(top_lines, bottom_lines, left_x, right_x,
+                                    np.asarray(points, dtype=float).reshape(-1, 2), loose)
+
+    def link(self, trapezoid):
+        """Links the trapezoid with the trapezoids across its walls."""
+        vertices = trapezoid.vertices.tolist()
+        xs = (trapezoid.leftp()[0], trapezoid.rightp()[0])
+        walls = []
+        for x in xs:
+            ys = [vertex[1] for vertex in vertices if vertex[0] == x]
+            walls.append((min(ys), max(ys)))
+        trapezoid.walls = tuple(walls)
+        for side, x in enumerate(xs):
+            bottom, top = walls[side]
+            if top - bottom <= 10**-9:
+                continue
+            own_walls = (self.left_walls, self.right_walls)[side]
+            other_walls = (self.right_walls, self.left_walls)[side]
+            if x not in own_walls:
+                own_walls[x] = []
+            own_walls[x].append(trapezoid.index)
+
+            # The walls on the other side at x that overlap this one
+            neighbors = []
+            for idx in other_walls.get(x, []):
+                other_bottom, other_top = self.trapezoids[idx].walls[1 - side]
+                if other_bottom < top and other_top > bottom:
+                    neighbors.append(idx)
+            neighbors.sort(key=lambda i: self.trapezoids[i].walls[1 - side][0])
+            if side == 0:
+                trapezoid.left_neighbors = neighbors
+            else:
+                trapezoid.right_neighbors = neighbors
+            for idx in neighbors:
+                other = self.trapezoids[idx]
+                # Assigned back, as the neighbors of a TrapezoidView are a copy
+                other_neighbors = (other.right_neighbors if side == 0 else other.left_neighbors) + [trapezoid.index]
+                other_neighbors.sort(key=lambda i: self.trapezoids[i].walls[side][0])
+                if side == 0:
+                    other.right_neighbors = other_neighbors
+                else:
+                    other.left_neighbors = other_neighbors
+
+    def unlink(self, trapezoid):
+        """Removes the links to the trapezoid."""
+        for side, x in enumerate((trapezoid.leftp()[0], trapezoid.rightp()[0])):
+            own_walls = (self.left_walls, self.right_walls)[side]
+            if trapezoid.index in own_walls.get(x, []):
+                own_walls[x].remove(trapezoid.index)
+            for idx in (trapezoid.left_neighbors, trapezoid.right_neighbors)[side]:
+                other = self.trapezoids[idx]
+                if side == 0:
+                    other.right_neighbors = [i for i in other.right_neighbors if i != trapezoid.index]
+                else:
+                    other.left_neighbors = [i for i in other.left_neighbors if i != trapezoid.index]
+        trapezoid.left_neighbors = []
+        trapezoid.right_neighbors = []
+
     def __getitem__(self, idx):
         return self.trapezoids[idx]
     
     def pop(self, idx):
         """Remove the trapezoid at index."""
         trap = self.trapezoids[idx]
+        if trap is not None:
+            self.unlink(trap)
         self.trapezoids[idx] = None
         self.to_remove.append(idx)
+        if self.changed is not None:
+            self.changed.add(idx)
         if trap is not None and not trap.is_left_pointed():
             self.by_left_x[trap.leftp()[0]].pop(trap.bottom()[0, 1])
     
@@ -322,6 +832,11 @@ class Trapezoids(object):
         else:
             self.trapezoids.append(trapezoid)
             idx = len(self.trapezoids) - 1
+        trapezoid.set_idx(idx)
+        if self.changed is not None:
+            self.changed.add(idx)
+        # The stored trapezoid, a view if the data was copied into a TrapezoidStore
+        trapezoid = self.trapezoids[idx]
 
         if not trapezoid.is_left_pointed(): # Don't insert triangles that will never be intersected
             x = trapezoid.left_p[0]
@@ -329,8 +844,8 @@ class Trapezoids(object):
                 self.by_left_x[x] = SortedDict()
             self.by_left_x[x].update([(trapezoid.bottom()[0, 1], trapezoid)])
 
-        trapezoid.set_idx(idx)
-        return trapezoid.index
+        self.link(trapezoid)
+        return idx
     
     def update_idx(self, idx, trapezoid):
         """Exchange the trapezoid at the given index for a new one."""
@@ -338,14 +853,19 @@ class Trapezoids(object):
         old_trap = self.trapezoids[idx] 
         if not old_trap.is_left_pointed():
             self.by_left_x[old_trap.leftp()[0]].pop(old_trap.bottom()[0, 1])
+        self.unlink(old_trap)
 
         self.trapezoids[idx] = trapezoid
+        trapezoid.set_idx(idx)
+        if self.changed is not None:
+            self.changed.add(idx)
+        trapezoid = self.trapezoids[idx]
         if not trapezoid.is_left_pointed():
-            trapezoid.set_idx(idx)
             x = trapezoid.leftp()[0]
             if x not in self.by_left_x:
                 self.by_left_x[x] = SortedDict()
             self.by_left_x[x].update([(trapezoid.bottom()[0, 1], trapezoid)])
+        self.link(trapezoid)
 
     def remove_traps_within_polygons(self, polygons):
         """ Removes trapezoids that lie within a polygon in polygons. """
@@ -353,12 +873,24 @@ class Trapezoids(object):
             if trap is not None and polygons.contains_trap(trap):
                 self.pop(trap.index)
     
-    def split_trapezoids(self, edge, indices):
-        """Split trapezoids at indices by the edge."""
+    def remove_occupied(self):
+        """ Removes the trapezoids labelled as lying in a polygon, see Trapezoid.occupant."""
+        if isinstance(self.trapezoids, TrapezoidStore):
+            store = self.trapezoids
+            occupied = store.alive[:store.count] & (store.occupants[:store.count].max(axis=1) >= 0)
+            indices = np.flatnonzero(occupied).tolist()
+        else:
+            indices = [trap.index for trap in self.trapezoids if trap is not None and trap.occupant >= 0]
+        for idx in indices:
+            self.pop(idx)
+
+    def split_trapezoids(self, edge, indices, occupants=(-1, -1)):
+        """Split trapezoids at indices by the edge, see Trapezoid.split_by for the occupants."""
         new_trapezoids = []
-        for trap_idx in indices:
+        intersected = self.intersected_by(edge, indices)
+        for i, trap_idx in enumerate(indices):
             trap = self.trapezoids[trap_idx]
-            split_traps = trap.split_by(edge)
+            split_traps = trap.split_by(edge, intersected[i], occupants)
             new_trapezoids.append(split_traps)
         return new_trapezoids
     
@@ -390,19 +922,16 @@ class Trapezoids(object):
         if (trap_left.originators[-1] != trap_right.originators[0]).any():
             return None
 
-        # Check vertices to merge are the same
+        # Check vertices to merge are the same. Parallel segments can be much closer than a unit apart,
+        # so only rounding is allowed for, or a top line would jump from one segment to the other.
         left_merger = np.array([trap_left.top_line[1], trap_left.bottom_line[1]])
         right_merger = np.array([trap_right.top_line[0], trap_right.bottom_line[0]])
-        if not np.allclose(left_merger, right_merger, atol=10**-1):
+        if not np.allclose(left_merger, right_merger, rtol=0, atol=10**-6):
             return None
 
         # Check that the slopes match
-        left_top_slope = slope(trap_left.top())
-        right_top_slope = slope(trap_right.top())
-        left_bottom_slope = slope(trap_left.bottom())
-        right_bottom_slope = slope(trap_right.bottom())
-        if not np.allclose(left_top_slope, right_top_slope) or \
-           not np.allclose(left_bottom_slope, right_bottom_slope):
+        if not np.allclose([trap_left.top_fit[0], trap_left.bottom_fit[0]],
+                           [trap_right.top_fit[0], trap_right.bottom_fit[0]]):
            return None
 
         # Check both vertices either above or below the originator 
@@ -416,6 +945,9 @@ class Trapezoids(object):
                 new_trap_verts.append(trap_left.bottom_line[0])
             new_trap_verts = np.array(new_trap_verts)
             new_trap_originators = np.concatenate([trap_left.originators[:-1], trap_right.originators[1:]])
-            return Trapezoid(new_trap_verts, new_trap_originators)
+            top_line = np.array([trap_left.top_line[0], trap_right.top_line[1]])
+            bottom_line = np.array([trap_left.bottom_line[0], trap_right.bottom_line[1]])
+            return Trapezoid.from_lines(new_trap_verts, top_line, bottom_line, new_trap_originators,
+                                        (trap_left.top_occupant, trap_left.bottom_occupant))
 
         return None
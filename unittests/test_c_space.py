@@ -1,5 +1,6 @@
 import unittest
 from src.c_space import *
+from matplotlib.path import Path
 
 class TestCSpace(unittest.TestCase):
 
@@ -56,3 +57,280 @@ class TestCSpace(unittest.TestCase):
 
     
 
+
+
+    def test_batched(self):
+        bounds = np.array([[10, 10], [790, 790]])
+        for _ in range(50):
+            vehicle = Polygons.make_convex(np.random.randint(3, 12), bounds)
+            obstacles = [Polygons.make_convex(np.random.randint(3, 20), bounds) for _ in range(5)]
+            outputs = minkowski_sums(obstacles, vehicle)
+            self.assertEqual(len(outputs), len(obstacles))
+            for obstacle, output in zip(obstacles, outputs):
+                expected = minkowski_sum_fast(obstacle, vehicle)
+                # minkowski_sum_fast can keep the closing vertex when float32 rounding moves it
+                if len(expected) == len(output) + 1:
+                    expected = expected[:-1]
+                np.testing.assert_allclose(output, expected, atol=10**-3)
+
+
+    def test_parallel(self):
+        bounds = np.array([[10, 10], [790, 790]])
+        vehicle = Polygons.make_convex(6, bounds)
+        obstacles = [Polygons.make_convex(np.random.randint(3, 10), bounds) for _ in range(50)]
+        outputs = parallel_minkowski_sums(obstacles, vehicle, workers=2, chunks_per_worker=3)
+        expected = minkowski_sums(obstacles, vehicle)
+        np.testing.assert_equal(outputs.offsets, expected.offsets)
+        np.testing.assert_equal(outputs.vertices, expected.vertices)
+
+
+class TestRotatedCSpace(unittest.TestCase):
+    bounds = [10, 10, 790, 790]
+
+    def test_slices(self):
+        obstacles = Polygons.make_random(self.bounds, 60)
+        vehicle = np.array([[0, 0], [60, 0], [60, 10], [0, 10]])
+        stack = RotatedCSpace(obstacles, vehicle, 4, [-100, -100, 900, 900])
+        self.assertEqual(len(stack), 4)
+        np.testing.assert_allclose(np.ptp(stack.vehicle(1), axis=0), [10, 60])
+        self.assertEqual(stack.nearest(2 * np.pi - 0.1), 0)
+        self.assertEqual(stack.nearest(np.pi + 0.5), 2)
+        for expected, output in zip(compute_cspace(obstacles, vehicle), stack.cspace(0)):
+            np.testing.assert_equal(expected, output)
+        self.assertEqual(stack.built(), [])
+        point_locator = stack.locator(2)
+        self.assertIs(stack.locator(2), point_locator)
+        self.assertEqual(stack.built(), [2])
+        point = obstacles[0].mean(axis=0)
+        self.assertGreaterEqual(point_locator.trapezoids[point_locator.query(point)].occupant, 0)
+
+
+class TestIncrementalCSpace(unittest.TestCase):
+    bounds = [-200, -200, 1000, 1000]
+
+    def test_move(self):
+        rng = np.random.default_rng(0)
+        obstacles = Polygons.make_random_scene([10, 10, 790, 790], 150, rng)
+        vehicle = np.array([[0, 0], [30, 0], [30, 15], [0, 15]])
+        cspace = IncrementalCSpace(obstacles, vehicle, self.bounds, rng=1)
+        self.assertEqual(len(cspace.cspace()), len(compute_cspace(obstacles, vehicle)))
+        for _ in range(5):
+            idx = int(rng.integers(len(obstacles)))
+            trapezoids = cspace.point_locator.trapezoids
+            before = list(trapezoids.trapezoids)
+            changed = cspace.move({idx: cspace.obstacles[idx] + rng.uniform(-150, 150, 2)})
+            self.assertGreater(len(changed), 0)
+            # The trapezoids that are not reported are the ones from before
+            for i, trap in enumerate(trapezoids.trapezoids):
+                if i not in changed:
+                    self.assertIs(trap, before[i])
+            fresh = trapezoid_decomposition_pl(compute_cspace(cspace.obstacles, vehicle), self.bounds)
+            points = rng.uniform(-150, 950, (1000, 2))
+            np.testing.assert_equal([trapezoids[i].occupant >= 0 for i in cspace.point_locator.query_many(points)],
+                                    [fresh.trapezoids[i].occupant >= 0 for i in fresh.query_many(points)])
+            self.assertEqual(len(cspace.point_locator.misplaced(points)), 0)
+
+    def test_many_moves(self):
+        obstacles = Polygons.make_random_scene([10, 10, 790, 790], 200, np.random.default_rng(101))
+        vehicle = np.array([[0, 0], [30, 0], [30, 15], [0, 15]])
+        cspace = IncrementalCSpace(obstacles, vehicle, self.bounds, rng=1)
+        rng = np.random.default_rng(23)
+        for _ in range(12):
+            indices = rng.choice(len(obstacles), rng.integers(1, 4), replace=False)
+            shifted = {int(idx): cspace.obstacles[idx] + rng.uniform(-200, 200, 2) for idx in indices}
+            cspace.move({idx: polygon for idx, polygon in shifted.items()
+                         if polygon.min() >= -60 and polygon.max() <= 860})
+        # Every edge is still where the point locator can take it out again
+        for outline in cspace.outlines.values():
+            for ring in outline:
+                cspace.point_locator.remove_polygon(ring)
+        self.assertEqual(cspace.point_locator.trapezoids.trap_count(), 1)
+
+    def test_rebuild(self):
+        obstacles = Polygons.make_random_scene([10, 10, 790, 790], 100, np.random.default_rng(5))
+        vehicle = np.array([[0, 0], [30, 0], [30, 15], [0, 15]])
+        cspace = IncrementalCSpace(obstacles, vehicle, self.bounds, rng=1, rebuild_factor=1.2)
+        max_depth = cspace.build_stats["max_depth"]
+        rng = np.random.default_rng(8)
+        rebuilt = False
+        for _ in range(60):
+            idx = int(rng.integers(len(obstacles)))
+            polygon = cspace.obstacles[idx] + rng.uniform(-100, 100, 2)
+            if polygon.min() >= -60 and polygon.max() <= 860:
+                cspace.move({idx: polygon})
+            rebuilt = rebuilt or cspace.build_stats["max_depth"] != max_depth
+            self.assertLessEqual(cspace.point_locator.depth_stats()["max_depth"],
+                                 cspace.rebuild_factor * cspace.build_stats["max_depth"])
+        self.assertTrue(rebuilt)
+        self.assertLessEqual(cspace.point_locator.depth_stats()["max_depth"], 2 * max_depth)
+        self.assertEqual(len(cspace.point_locator.misplaced(np.random.uniform(-150, 950, (500, 2)))), 0)
+        # The rebuilt structure still finds every edge to take out
+        for outline in cspace.outlines.values():
+            for ring in outline:
+                cspace.point_locator.remove_polygon(ring)
+        self.assertEqual(cspace.point_locator.trapezoids.trap_count(), 1)
+
+    def test_move_cost(self):
+        # Moves compare the node count and depth the point locator keeps, without measuring it
+        obstacles = Polygons.make_random_scene([10, 10, 790, 790], 200, np.random.default_rng(5))
+        vehicle = np.array([[0, 0], [30, 0], [30, 15], [0, 15]])
+        cspace = IncrementalCSpace(obstacles, vehicle, self.bounds, rng=1)
+        measured = []
+        pruned = []
+        depth_stats, prune = cspace.point_locator.depth_stats, cspace.point_locator.prune
+        cspace.point_locator.depth_stats = lambda: measured.append(1) or depth_stats()
+        cspace.point_locator.prune = lambda: pruned.append(1) or prune()
+        rng = np.random.default_rng(9)
+        for _ in range(20):
+            idx = int(rng.integers(len(obstacles)))
+            polygon = cspace.obstacles[idx] + rng.uniform(-20, 20, 2)
+            if polygon.min() >= -60 and polygon.max() <= 860:
+                cspace.move({idx: polygon})
+        # Only the prunes, which come once the moves changed a share of the structure, measured it
+        self.assertEqual(len(measured), len(pruned))
+        self.assertLess(len(pruned), 20)
+        del cspace.point_locator.depth_stats, cspace.point_locator.prune
+        stats = cspace.point_locator.depth_stats()
+        self.assertEqual(cspace.point_locator.node_count, stats["nodes"])
+        self.assertGreaterEqual(cspace.point_locator.max_depth, stats["max_depth"])
+
+    def test_failed_move(self):
+        obstacles = Polygons.make_random_scene([10, 10, 790, 790], 100, np.random.default_rng(3))
+        vehicle = np.array([[0, 0], [30, 0], [30, 15], [0, 15]])
+        cspace = IncrementalCSpace(obstacles, vehicle, self.bounds, rng=1)
+        outlines = {outline_id: [ring.copy() for ring in outline] for outline_id, outline in cspace.outlines.items()}
+        count = cspace.point_locator.trapezoids.trap_count()
+        with self.assertRaises(ValueError):
+            cspace.move({0: obstacles[0] + [10, 0], 1: obstacles[1] + [1000, 0]})
+        # Nothing changed, and the C-space can still move
+        np.testing.assert_equal(cspace.obstacles[0], obstacles[0])
+        self.assertEqual(list(cspace.outlines), list(outlines))
+        for outline_id, outline in outlines.items():
+            np.testing.assert_equal(np.concatenate(cspace.outlines[outline_id]), np.concatenate(outline))
+        self.assertEqual(cspace.point_locator.trapezoids.trap_count(), count)
+        self.assertGreater(len(cspace.move({0: obstacles[0] + [10, 0]})), 0)
+        self.assertEqual(len(cspace.point_locator.misplaced(np.random.uniform(-150, 950, (500, 2)))), 0)
+
+    def test_hole(self):
+        ring = [np.array([[100, 100], [400, 100], [400, 150], [100, 150]], dtype=float)]
+        ring.append(ring[0] + [0, 250])
+        ring.append(np.array([[100, 100], [150, 100], [150, 400], [100, 400]], dtype=float))
+        ring.append(ring[2] + [250, 0])
+        vehicle = np.array([[0, 0], [20, 0], [20, 20], [0, 20]])
+        cspace = IncrementalCSpace(ring, vehicle, self.bounds, rng=1)
+        np.testing.assert_equal(cspace.cspace().holes, [False, True])
+        inside = np.array([250, 250], dtype=float)
+        trapezoids = cspace.point_locator.trapezoids
+        self.assertLess(trapezoids[cspace.point_locator.query(inside)].occupant, 0)
+        # Opening the ring leaves one outline and no hole
+        cspace.move({3: ring[3] + [300, 0]})
+        np.testing.assert_equal(cspace.cspace().holes, [False, False])
+        self.assertLess(trapezoids[cspace.point_locator.query(inside)].occupant, 0)
+        self.assertGreaterEqual(trapezoids[cspace.point_locator.query(np.array([120., 250.]))].occupant, 0)
+        self.assertEqual(len(cspace.point_locator.misplaced(np.random.uniform(-150, 950, (500, 2)))), 0)
+
+
+class TestDepthBoundedBuild(unittest.TestCase):
+    bounds = [10, 10, 790, 790]
+
+    def test_within_limit(self):
+        polygons = Polygons.make_random(self.bounds, 60)
+        point_locator = trapezoid_decomposition_pl(polygons, self.bounds, depth_factor=100)
+        self.assertEqual(len(point_locator.build_stats["attempts"]), 1)
+        self.assertIsNone(point_locator.build_stats["rebuild"])
+        self.assertLessEqual(point_locator.build_stats["max_depth"], point_locator.build_stats["depth_limit"])
+
+    def test_retries(self):
+        polygons = Polygons.make_random(self.bounds, 60)
+        # No order can be this shallow, so every attempt is made and the last one is kept
+        point_locator = trapezoid_decomposition_pl(polygons, self.bounds, depth_factor=0.1, max_attempts=3)
+        self.assertEqual(len(point_locator.build_stats["attempts"]), 3)
+        self.assertGreater(point_locator.build_stats["max_depth"], point_locator.build_stats["depth_limit"])
+        point = polygons[0].mean(axis=0)
+        self.assertTrue(point_locator.trapezoids[point_locator.query(point)].includes_point_loose(point))
+
+    def test_background(self):
+        polygons = Polygons.make_random(self.bounds, 60)
+        point_locator = trapezoid_decomposition_pl(polygons, self.bounds, depth_factor=0.1, max_attempts=3,
+                                                   background=True)
+        self.assertEqual(len(point_locator.build_stats["attempts"]), 1)
+        self.assertIsNone(point_locator.build_stats["rebuild"].result())
+
+
+class TestEdgeOrder(unittest.TestCase):
+    bounds = [10, 10, 790, 790]
+
+    def test_seeded(self):
+        polygons = Polygons(Polygons.make_random(self.bounds, 60))
+        edges, owners, interior_above, order = polygons.edge_order(7)
+        self.assertTrue((edges[:, 0, 0] <= edges[:, 1, 0]).all())
+        np.testing.assert_equal(np.sort(order), np.arange(len(edges)))
+        np.testing.assert_equal(order, polygons.edge_order(7)[3])
+        first = trapezoid_decomposition_pl(polygons, self.bounds, rng=3)
+        second = trapezoid_decomposition_pl(polygons, self.bounds, rng=3)
+        np.testing.assert_equal(first.edge_history, second.edge_history)
+        self.assertEqual(len(first.trapezoids.trapezoids), len(second.trapezoids.trapezoids))
+        deep = trapezoid_decomposition_pl(polygons, self.bounds, depth_factor=0.1, max_attempts=3, rng=3)
+        attempts = trapezoid_decomposition_pl(polygons, self.bounds, depth_factor=0.1, max_attempts=3,
+                                              rng=3).build_stats["attempts"]
+        self.assertEqual(deep.build_stats["attempts"], attempts)
+
+
+class TestMergedCSpace(unittest.TestCase):
+    def test_no_intersections(self):
+        bounds = [10, 10, 790, 790]
+        for _ in range(5):
+            obstacles = Polygons.make_random(bounds, 200)
+            vehicle = Polygons.make_convex(6, np.array([[0, 0], [40, 40]]))
+            enlarged = [minkowski_sum_fast(obstacle, vehicle) for obstacle in obstacles]
+            cspace = compute_cspace(obstacles, vehicle)
+            self.assertLessEqual(sum(len(polygon) for polygon in cspace), sum(len(polygon) for polygon in enlarged))
+            point_locator = PointLocator([-100, -100, 900, 900])
+            for edge in Polygons(cspace).random_edge_sampler():
+                self.assertFalse(point_locator.add_line(edge))
+
+    def test_near_vertex(self):
+        # The pentagon passes just under a triangle vertex, once enlarged the two meet in a sliver
+        triangle = np.array([[1128.5432885961072, 5359.169206209206], [1179.7350430960378, 5362.225766557303],
+                             [1180.8198393667988, 5362.484229152283]])
+        pentagon = np.array([[1214.9537047453005, 5327.05121214821], [1175.777537387621, 5343.7333110719355],
+                             [1118.703750249355, 5344.259247325322], [1080.0586118467422, 5332.015573364995],
+                             [1097.585749234962, 5307.473149849812]])
+        vehicle = np.array([[0, 0], [30, 0], [30, 15], [0, 15]])
+        cspace = compute_cspace([triangle, pentagon], vehicle)
+        self.assertEqual(len(cspace), 1)
+        enlarged = minkowski_sums([triangle, pentagon], vehicle)
+        points = np.random.rand(2000, 2) * [200, 100] + [1050, 5290]
+        inside = np.array([Path(polygon).contains_points(points) for polygon in enlarged]).any(axis=0)
+        np.testing.assert_equal(Path(cspace[0]).contains_points(points), inside)
+
+    def test_ring(self):
+        # The space inside a ring of obstacles is free, though the vehicle cannot get there from outside
+        ring = [np.array([[100, 100], [400, 100], [400, 150], [100, 150]], dtype=float)]
+        ring.append(ring[0] + [0, 250])
+        ring.append(np.array([[100, 100], [150, 100], [150, 400], [100, 400]], dtype=float))
+        ring.append(ring[2] + [250, 0])
+        vehicle = np.array([[0, 0], [20, 0], [20, 20], [0, 20]])
+        cspace = compute_cspace(ring, vehicle)
+        np.testing.assert_equal(cspace.holes, [False, True])
+        point_locator = trapezoid_decomposition_pl(cspace, [0, 0, 500, 500], rng=0)
+        for point, occupied in [([250, 250], False), ([120, 250], True), ([50, 50], False), ([140, 390], True)]:
+            trap = point_locator.trapezoids[point_locator.query(np.array(point, dtype=float))]
+            self.assertEqual(trap.occupant >= 0, occupied)
+        # The trapezoids along the hole are labelled with the outline around it, as polygon_at finds
+        located = Polygons(cspace)
+        for sweep in (False, True):
+            point_locator = trapezoid_decomposition_pl(cspace, [0, 0, 500, 500], sweep=sweep, rng=0)
+            for trap in point_locator.trapezoids.trapezoids:
+                if trap is not None:
+                    self.assertIn(trap.top_occupant, (-1, 0))
+                    self.assertIn(trap.bottom_occupant, (-1, 0))
+                    if trap.occupant >= 0:
+                        self.assertEqual(located.polygon_at(trap.raw().mean(axis=0)), trap.occupant)
+        # Removing the trapezoids within the outlines keeps the free ones in the hole
+        point_locator = PointLocator([0, 0, 500, 500])
+        for edge in Polygons(cspace).random_edge_sampler():
+            point_locator.add_line(edge)
+        point_locator.remove_traps_within_polygons(Polygons(cspace))
+        for point, occupied in [([250, 250], False), ([120, 250], True), ([50, 50], False)]:
+            self.assertEqual(point_locator.trapezoids[point_locator.query(np.array(point, dtype=float))] is None, occupied)
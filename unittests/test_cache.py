@@ -0,0 +1,116 @@
+import unittest
+from src.cache import *
+from src.structures import *
+import numpy as np
+import os
+import tempfile
+
+
+class TestResultCache(unittest.TestCase):
+    bounds = [-100, -100, 900, 900]
+
+    def scene(self, seed):
+        obstacles = Polygons.make_random_scene([10, 10, 790, 790], 120, np.random.default_rng(seed))
+        vehicle = np.array([[0, 0], [20, 0], [20, 10], [0, 10]])
+        return obstacles, vehicle
+
+    def test_key(self):
+        obstacles, vehicle = self.scene(0)
+        as_list = [np.array(polygon) for polygon in obstacles]
+        self.assertEqual(scene_key(obstacles, vehicle), scene_key(as_list, vehicle.astype(float)))
+        self.assertNotEqual(scene_key(obstacles, vehicle), scene_key(obstacles, vehicle + 1))
+        self.assertNotEqual(scene_key(obstacles, vehicle), scene_key(obstacles[1:], vehicle))
+        self.assertNotEqual(scene_key(obstacles, vehicle, [0, 0, 10, 10]), scene_key(obstacles, vehicle))
+
+    def test_memory(self):
+        cache = ResultCache()
+        obstacles, vehicle = self.scene(0)
+        cspace = cache.cspace(obstacles, vehicle)
+        self.assertIs(cache.cspace([np.array(polygon) for polygon in obstacles], vehicle), cspace)
+        point_locator = cache.point_locator(obstacles, vehicle, self.bounds, rng=1)
+        self.assertIsNotNone(point_locator.compiled)
+        # The query nodes outnumber the trapezoids, and count towards the size
+        self.assertEqual(point_locator.node_count, point_locator.depth_stats()["nodes"])
+        self.assertGreaterEqual(result_nbytes(point_locator), point_locator.compiled.nbytes() +
+                                point_locator.trapezoids.trap_count() * TRAPEZOID_NBYTES +
+                                point_locator.node_count * QUERY_NODE_NBYTES)
+        self.assertIs(cache.point_locator(obstacles, vehicle, self.bounds, rng=1), point_locator)
+        graph = cache.graph(obstacles, vehicle, self.bounds, rng=1)
+        # The graph is over a copy without the occupied trapezoids, the cached locator keeps them
+        self.assertIsNot(graph.pl, point_locator)
+        self.assertGreater(len(graph.interfaces), 0)
+        self.assertTrue(all(graph.traps[idx].occupant < 0 for idx in graph.interfaces))
+        self.assertTrue(any(trap is not None and trap.occupant >= 0 for trap in point_locator.trapezoids.trapezoids))
+        self.assertEqual(cache.stats, {"hits": 4, "disk_hits": 0, "misses": 3})
+        self.assertEqual(cache.nbytes, sum(size for _, size in cache.entries.values()))
+
+    def test_rng(self):
+        cache = ResultCache()
+        obstacles, vehicle = self.scene(0)
+        point_locator = cache.point_locator(obstacles, vehicle, self.bounds, rng=1)
+        self.assertIs(cache.point_locator(obstacles, vehicle, self.bounds, rng=np.int64(1)), point_locator)
+        # A Generator has no stable repr to key on
+        with self.assertRaises(ValueError):
+            cache.point_locator(obstacles, vehicle, self.bounds, rng=np.random.default_rng(1))
+        with self.assertRaises(ValueError):
+            cache.graph(obstacles, vehicle, self.bounds, rng=np.random.default_rng(1))
+        self.assertEqual(cache.stats["misses"], 2)
+
+    def test_eviction(self):
+        obstacles, vehicle = self.scene(0)
+        size = result_nbytes(compute_cspace(obstacles, vehicle))
+        cache = ResultCache(max_bytes=int(2.5 * size))
+        first = cache.cspace(obstacles, vehicle)
+        cache.cspace(obstacles, vehicle + 1)
+        cache.cspace(obstacles, vehicle)
+        cache.cspace(obstacles, vehicle + 2)
+        # The least recently used entry went
+        self.assertEqual(len(cache), 2)
+        self.assertIn(("cspace", scene_key(obstacles, vehicle)), cache)
+        self.assertNotIn(("cspace", scene_key(obstacles, vehicle + 1)), cache)
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+        self.assertIs(cache.cspace(obstacles, vehicle), first)
+
+    def test_disk(self):
+        obstacles, vehicle = self.scene(1)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory=directory)
+            cspace = cache.cspace(obstacles, vehicle)
+            point_locator = cache.point_locator(obstacles, vehicle, self.bounds, rng=1)
+
+            # A new process finds the results in the directory
+            cache = ResultCache(directory=directory)
+            loaded = cache.cspace(obstacles, vehicle)
+            np.testing.assert_equal(np.concatenate(loaded), np.concatenate(cspace))
+            mapped = cache.point_locator(obstacles, vehicle, self.bounds, rng=1)
+            self.assertIsInstance(mapped, MappedPointLocator)
+            points = np.random.rand(200, 2) * 1000 - 100
+            np.testing.assert_equal(mapped.query_many(points), point_locator.query_many(points))
+            self.assertEqual(cache.stats["disk_hits"], 2)
+            self.assertEqual(cache.stats["misses"], 0)
+            graph = cache.graph(obstacles, vehicle, self.bounds, rng=1)
+            self.assertTrue(all(graph.traps[idx].occupant < 0 for idx in graph.interfaces))
+            np.testing.assert_equal(mapped.query_many(points), point_locator.query_many(points))
+
+            # Only the most recently used file fits
+            cache = ResultCache(directory=directory, max_disk_bytes=cache.disk_nbytes - 1)
+            cache.cspace(obstacles, vehicle + 1)
+            self.assertEqual(list(cache.files), [cache._file_name("cspace", scene_key(obstacles, vehicle + 1))])
+            self.assertEqual(sorted(name for name in os.listdir(directory) if name.endswith(".plc")), list(cache.files))
+
+    def test_disk_order(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory=directory)
+            obstacles, vehicle = self.scene(2)
+            for shift in range(4):
+                cache.cspace(obstacles, vehicle + shift)
+            # Files written and read within one tick of the clock keep the order they were used in
+            cache.clear()
+            cache.cspace(obstacles, vehicle)
+            cache.cspace(obstacles, vehicle + 2)
+            order = list(cache.files)
+            self.assertEqual(order[-2:], [cache._file_name("cspace", scene_key(obstacles, vehicle + shift))
+                                          for shift in (0, 2)])
+            for _ in range(3):
+                cache = ResultCache(directory=directory)
+                self.assertEqual(list(cache.files), order)
@@ -3,7 +3,13 @@ import unittest
 from src.point_location import *
 from src.structures import *
 from src.graph import *
+from src.persistence import *
+from src.sweep import *
 import numpy as np
+import random
+import os
+import time
+import tempfile
 from numpy import array
 from tqdm import tqdm
 
@@ -46,7 +52,26 @@ class TestTrapezoidRep(unittest.TestCase):
         self.assertTrue(np.allclose(trap.bottom_line, np.array([[275., 122.], [353., 123.98305085]])))
         self.assertEqual(trap.left_p[0], 275)
         self.assertEqual(trap.right_p[0], 353)
-    
+
+    def test_from_lines(self):
+        vertices = np.array([[10, 10], [200, 20], [200, 100], [10, 300]])
+        trap = Trapezoid(vertices, originator_vertices=[[200, 60], [10, 150]])
+        fast_trap = Trapezoid.from_lines(vertices, np.array([[10, 300], [200, 100]]), np.array([[10, 10], [200, 20]]),
+                                         [[200, 60], [10, 150]])
+        np.testing.assert_equal(fast_trap.top_line, trap.top_line)
+        np.testing.assert_equal(fast_trap.bottom_line, trap.bottom_line)
+        np.testing.assert_equal(fast_trap.originators, trap.originators)
+        self.assertEqual(fast_trap.left_p[0], trap.left_p[0])
+        self.assertEqual(fast_trap.right_p[0], trap.right_p[0])
+        self.assertTrue(fast_trap.includes_point(np.array([100, 100])))
+
+    def test_line_fit(self):
+        for edge in [np.array([[10., 300.], [200., 100.]]), np.array([[100., 30.], [240., 30.]]),
+                     np.array([[275., 122.], [353., 123.98305085]])]:
+            fit = line_fit(edge)
+            for x in np.concatenate([edge[:, 0], edge[:, 0] + [-10**-5, 10**-5], np.random.rand(20) * 400]):
+                self.assertEqual(fit_interpolation(fit, x), linear_interpolation(edge, x))
+
     def test_is_left_pointed(self):
         vertices = np.array([[309., 169.],
                             [471., 170.71247357],
@@ -334,3 +359,582 @@ class TestIntegration(unittest.TestCase):
             point_locator = PointLocator(bounds)
             for edge in random_polygons.random_edge_sampler():
                 point_locator.add_line(edge)
+
+
+class TestBatchQuery(unittest.TestCase):
+    def test_matches_single_query(self):
+        bounds = [10, 10, 790, 790]
+        for _ in range(20):
+            random_polygons = Polygons(Polygons.make_random(bounds, 40))
+            point_locator = PointLocator(bounds)
+            for edge in random_polygons.random_edge_sampler():
+                point_locator.add_line(edge)
+            points = np.random.rand(500, 2) * 780 + 10
+            expected = np.array([point_locator.query(p) for p in points])
+            np.testing.assert_equal(point_locator.query_many(points), expected)
+
+    def test_failure(self):
+        bounds = [10, 10, 790, 790]
+        point_locator = PointLocator(bounds)
+        point_locator.add_line(np.array([[200, 100], [240, 30]]))
+        output = point_locator.query_many(np.array([[5, 100], [300, 300]]))
+        self.assertEqual(output[0], FAILURE_INDEX)
+        self.assertEqual(output[1], point_locator.query(np.array([300, 300])))
+        self.assertEqual(len(point_locator.query_many(np.zeros((0, 2)))), 0)
+
+
+class TestCompiledLocator(unittest.TestCase):
+    def test_matches_dag(self):
+        bounds = [10, 10, 790, 790]
+        for _ in range(20):
+            random_polygons = Polygons(Polygons.make_random(bounds, 40))
+            point_locator = PointLocator(bounds)
+            for edge in random_polygons.random_edge_sampler():
+                point_locator.add_line(edge)
+            points = np.random.rand(300, 2) * 790 + 5
+            expected = point_locator.query_many(points)
+            compiled = point_locator.freeze()
+            np.testing.assert_equal(compiled.query_many(points), expected)
+            np.testing.assert_equal([compiled.query(p) for p in points], expected)
+
+    def test_add_line_drops_compiled(self):
+        bounds = [10, 10, 790, 790]
+        point_locator = PointLocator(bounds)
+        point_locator.add_line(np.array([[200, 100], [240, 30]]))
+        point_locator.freeze()
+        point_locator.add_line(np.array([[100, 300], [400, 300]]))
+        self.assertIsNone(point_locator.compiled)
+        point = np.array([300, 500])
+        self.assertEqual(point_locator.freeze().query(point), point_locator.query(point))
+        self.assertRaises(ValueError, point_locator.query, np.array([5, 500]))
+
+    def test_grid(self):
+        bounds = [10, 10, 790, 790]
+        for _ in range(10):
+            random_polygons = Polygons(Polygons.make_random(bounds, 40))
+            point_locator = PointLocator(bounds)
+            for edge in random_polygons.random_edge_sampler():
+                point_locator.add_line(edge)
+            # Random points, points on the cell borders and the polygon vertices
+            grid_points = np.stack(np.meshgrid(np.linspace(10, 790, 65), np.linspace(10, 790, 65)), -1)
+            points = np.concatenate([np.random.rand(300, 2) * 790 + 5, grid_points.reshape(-1, 2),
+                                     np.concatenate(point_locator.edge_history)])
+            expected = point_locator.query_many(points)
+            point_locator.freeze(grid_resolution=64)
+            self.assertGreater(point_locator.grid.leaf_fraction(), 0)
+            np.testing.assert_equal(point_locator.query_many(points), expected)
+            np.testing.assert_equal([point_locator.grid.query(p) for p in points], expected)
+
+        point_locator.freeze(grid_resolution=(100, 50), grid_bytes=400)
+        self.assertEqual(point_locator.grid.shape, (7, 14))
+        np.testing.assert_equal(point_locator.query_many(points), expected)
+        point_locator.add_line(np.array([[12, 12], [13, 12]]))
+        self.assertIsNone(point_locator.grid)
+
+    def test_grid_speed(self):
+        # A single point goes through the grid at least about as fast as down the compiled structure
+        bounds = [10, 10, 790, 790]
+        random.seed(2)
+        point_locator = build_point_locator(Polygons(Polygons.make_random(bounds, 600)).random_edge_sampler(), bounds)
+        points = [tuple(p) for p in np.random.default_rng(0).uniform(10, 790, (3000, 2))]
+        compiled = point_locator.freeze()
+        grid = QueryGrid(compiled, bounds, 128)
+
+        def best_time(query):
+            times = []
+            for _ in range(5):
+                start = time.perf_counter()
+                for p in points:
+                    query(p)
+                times.append(time.perf_counter() - start)
+            return min(times)
+        self.assertEqual([grid.query(p) for p in points], [compiled.query(p) for p in points])
+        self.assertLessEqual(best_time(grid.query), 1.2 * best_time(compiled.query))
+
+
+class TestPersistence(unittest.TestCase):
+    def build(self, bounds):
+        random_polygons = Polygons(Polygons.make_random(bounds, 40))
+        point_locator = PointLocator(bounds)
+        for edge, polygon, interior_above in random_polygons.random_edge_sampler(labels=True):
+            point_locator.add_line(edge, polygon, interior_above)
+        return point_locator
+
+    def test_round_trip(self):
+        bounds = [10, 10, 790, 790]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "map.plm")
+            for _ in range(10):
+                point_locator = self.build(bounds)
+                save_point_locator(point_locator, path)
+                mapped = load_point_locator(path)
+                self.assertIsInstance(mapped.compiled.kind, np.memmap)
+
+                points = np.random.rand(300, 2) * 780 + 10
+                np.testing.assert_equal(mapped.query_many(points), point_locator.query_many(points))
+                mapped.add_grid(32)
+                np.testing.assert_equal(mapped.query_many(points), point_locator.query_many(points))
+                self.assertEqual(mapped.trapezoids.trap_count(), point_locator.trapezoids.trap_count())
+                for idx, trap in enumerate(point_locator.trapezoids.trapezoids):
+                    if trap is not None:
+                        self.assertEqual(sorted(mapped.trapezoids.right_adjacent(idx)),
+                                         sorted(point_locator.trapezoids.right_adjacent(idx)))
+                        self.assertEqual(mapped.trapezoids[idx].occupant, trap.occupant)
+                Graph(mapped, bounds[0])
+
+    def test_scene(self):
+        bounds = [10, 10, 790, 790]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "scene.plm")
+            count = save_random_scene(path, bounds, 2000, np.random.default_rng(1), chunk_polygons=50)
+            loaded_bounds, polygons = load_scene(path)
+            expected = Polygons.make_random_scene(bounds, 2000, np.random.default_rng(1))
+            self.assertEqual(loaded_bounds, bounds)
+            self.assertEqual(len(polygons), count)
+            np.testing.assert_equal(np.concatenate(polygons), np.concatenate(expected))
+            with self.assertRaises(ValueError):
+                load_point_locator(path)
+
+    def test_thaw(self):
+        bounds = [10, 10, 790, 790]
+        point_locator = PointLocator(bounds)
+        point_locator.add_line(np.array([[200, 100], [240, 30]]))
+        point_locator.add_line(np.array([[100, 300], [400, 300]]))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "map.plm")
+            save_point_locator(point_locator, path)
+            thawed = load_point_locator(path, mmap=False).thaw()
+
+        for edge in [np.array([[100, 300], [400, 200]]), np.array([[200, 100], [280, 100]])]:
+            point_locator.add_line(edge)
+            thawed.add_line(edge)
+        points = np.random.rand(300, 2) * 780 + 10
+        np.testing.assert_equal(thawed.query_many(points), point_locator.query_many(points))
+        self.assertEqual(thawed.trapezoids.trap_count(), point_locator.trapezoids.trap_count())
+
+    def test_thaw_counts(self):
+        bounds = [10, 10, 790, 790]
+        edge = np.array([[100, 300], [400, 300]])
+        point_locator = PointLocator(bounds)
+        for line in [edge, np.array([[100, 300], [200, 100]]), edge]:
+            point_locator.add_line(line)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "map.plm")
+            save_point_locator(point_locator, path)
+            thawed = load_point_locator(path, mmap=False).thaw()
+        self.assertEqual(dict(thawed.segment_count), dict(point_locator.segment_count))
+        self.assertEqual(dict(thawed.endpoint_count), dict(point_locator.endpoint_count))
+        # The edge added twice is still there after one removal, and gone after the second
+        points = np.random.rand(300, 2) * 780 + 10
+        for locator in (point_locator, thawed):
+            count = locator.trapezoids.trap_count()
+            self.assertEqual(locator.remove_line(edge), [])
+            self.assertIn(segment_key(make_lr(edge)), locator.segments)
+            self.assertEqual(locator.trapezoids.trap_count(), count)
+            locator.remove_line(edge)
+            self.assertNotIn(segment_key(make_lr(edge)), locator.segments)
+            self.assertEqual(len(locator.misplaced(points)), 0)
+        self.assertEqual(dict(thawed.endpoint_count), dict(point_locator.endpoint_count))
+
+    def test_thaw_random(self):
+        bounds = [10, 10, 790, 790]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "map.plm")
+            for seed in range(12):
+                np.random.seed(seed)
+                random.seed(seed)
+                polygons = Polygons.make_random(bounds, 60)
+                half = len(polygons) // 2
+                point_locator = PointLocator(bounds)
+                for edge in Polygons(polygons[:half]).random_edge_sampler():
+                    point_locator.add_line(edge)
+                save_point_locator(point_locator, path)
+                mapped = load_point_locator(path, mmap=False)
+                for idx, trap in enumerate(point_locator.trapezoids.trapezoids):
+                    if trap is not None:
+                        np.testing.assert_equal(mapped.trapezoids[idx].top(), trap.top())
+                        np.testing.assert_equal(mapped.trapezoids[idx].bottom(), trap.bottom())
+                thawed = mapped.thaw()
+                for edge in Polygons(polygons[half:]).random_edge_sampler():
+                    thawed.add_line(edge)
+                points = np.random.rand(500, 2) * 780 + 10
+                self.assertEqual(len(thawed.misplaced(points)), 0)
+
+
+class TestRemoveLine(unittest.TestCase):
+    top_triangle = np.array([[200, 100], [240, 30], [280, 100]])
+    bottom_triangle = np.array([[100, 300], [400, 300], [400, 200]])
+
+    def add_polygon(self, point_locator, polygon):
+        for i in range(len(polygon)):
+            point_locator.add_line(np.array([polygon[i], polygon[(i + 1) % len(polygon)]]))
+
+    def test_remove_single(self):
+        bounds = [10, 10, 790, 790]
+        point_locator = PointLocator(bounds)
+        point_locator.add_line(np.array([[200, 100], [240, 30]]))
+        self.assertEqual(point_locator.trapezoids.trap_count(), 4)
+        new_traps = point_locator.remove_line(np.array([[240, 30], [200, 100]]))
+        self.assertEqual(len(new_traps), 1)
+        self.assertEqual(point_locator.trapezoids.trap_count(), 1)
+        self.assertEqual(point_locator.query(np.array([220, 70])), new_traps[0])
+        self.assertRaises(ValueError, point_locator.remove_line, np.array([[200, 100], [240, 30]]))
+
+    def test_remove_polygon(self):
+        bounds = [10, 10, 790, 790]
+        point_locator = PointLocator(bounds)
+        self.add_polygon(point_locator, self.top_triangle)
+        self.add_polygon(point_locator, self.bottom_triangle)
+        point_locator.remove_polygon(self.top_triangle)
+
+        expected = PointLocator(bounds)
+        self.add_polygon(expected, self.bottom_triangle)
+        self.assertEqual(point_locator.trapezoids.trap_count(), expected.trapezoids.trap_count())
+        for x in [10, 100, 400]:
+            self.assertEqual(len(point_locator.trapezoids.right_adjacent_to(x)),
+                             len(expected.trapezoids.right_adjacent_to(x)))
+
+        # Adding it back continues to work on the patched structure
+        self.add_polygon(point_locator, self.top_triangle)
+        self.add_polygon(expected, self.top_triangle)
+        self.assertEqual(point_locator.trapezoids.trap_count(), expected.trapezoids.trap_count())
+        for point in [[240, 60], [220, 200], [300, 250], [50, 50]]:
+            trap = point_locator.trapezoids[point_locator.query(np.array(point))]
+            expected_trap = expected.trapezoids[expected.query(np.array(point))]
+            self.assertTrue(np.allclose(trap.extent(point[0]), expected_trap.extent(point[0])))
+
+    def test_vertical_first(self):
+        # The far end of a removed vertical edge still holds up the wall at its x
+        square = np.array([[160, 160], [160, 340], [340, 340], [340, 160]])
+        edges = [np.array([square[i], square[(i + 1) % 4]]) for i in range(4)]
+        for order in [[0, 1, 2, 3], [1, 0, 2, 3], [3, 0, 2, 1], [3, 2, 1, 0]]:
+            point_locator = PointLocator([10, 10, 790, 790])
+            for edge in edges:
+                point_locator.add_line(edge)
+            for i in order:
+                point_locator.remove_line(edges[i])
+            self.assertEqual(point_locator.trapezoids.trap_count(), 1)
+
+    def test_random(self):
+        bounds = [10, 10, 790, 790]
+        for _ in range(20):
+            polygons = Polygons.make_random(bounds, 40)
+            point_locator = PointLocator(bounds)
+            for edge in Polygons(polygons).random_edge_sampler():
+                point_locator.add_line(edge)
+            for polygon in polygons[:2]:
+                point_locator.remove_polygon(polygon)
+
+            for point in np.random.rand(200, 2) * 780 + 10:
+                trap = point_locator.trapezoids[point_locator.query(point)]
+                bottom, top = trap.extent(point[0])
+                self.assertTrue(bottom - 10**-6 <= point[1] <= top + 10**-6)
+
+    def test_bounded(self):
+        # Taking polygons out and putting them back does not grow the search structure
+        bounds = [10, 10, 790, 790]
+        random.seed(7)
+        polygons = Polygons.make_random(bounds, 80)
+        point_locator = PointLocator(bounds)
+        rng = np.random.default_rng(0)
+        for edge in Polygons(polygons).random_edge_sampler(rng=rng):
+            point_locator.add_line(edge)
+        stats = point_locator.depth_stats()
+        present = list(range(len(polygons)))
+        absent = []
+        for _ in range(60):
+            absent.append(present.pop(int(rng.integers(len(present)))))
+            point_locator.remove_polygon(polygons[absent[-1]])
+            if len(absent) > 2:
+                idx = absent.pop(int(rng.integers(len(absent) - 1)))
+                for edge in Polygons([polygons[idx]]).random_edge_sampler(rng=rng):
+                    point_locator.add_line(edge)
+                present.append(idx)
+        after = point_locator.depth_stats()
+        self.assertLessEqual(after["max_depth"], 2 * stats["max_depth"])
+        self.assertLessEqual(after["nodes"], 2 * stats["nodes"])
+        self.assertEqual(len(point_locator.misplaced(np.random.rand(1000, 2) * 780 + 10)), 0)
+
+    def test_local(self):
+        # A removal only walks the search structure down to the trapezoids it replaces
+        bounds = [10, 10, 790, 790]
+        random.seed(3)
+        polygons = Polygons.make_random(bounds, 600)
+        polygons.sort(key=len)
+        point_locator = PointLocator(bounds)
+        for edge in Polygons(polygons).random_edge_sampler(rng=np.random.default_rng(0)):
+            point_locator.add_line(edge)
+        point_locator.prune()
+        nodes = point_locator.node_count
+        traversals = []
+        whole_structure = point_locator.query_nodes
+        point_locator.query_nodes = lambda: traversals.append(1) or whole_structure()
+        point_locator.remove_polygon(polygons[0])
+        self.assertEqual(traversals, [])
+        self.assertLess(point_locator.stale_nodes, PRUNE_FRACTION * point_locator.node_count)
+        # The node count is kept as the removal goes
+        del point_locator.query_nodes
+        self.assertEqual(point_locator.node_count, point_locator.depth_stats()["nodes"])
+        self.assertGreater(point_locator.node_count, nodes)
+        self.assertEqual(len(point_locator.misplaced(np.random.rand(1000, 2) * 780 + 10)), 0)
+
+        # Once the changed nodes add up, a removal prunes them
+        for polygon in polygons[1:]:
+            point_locator.remove_polygon(polygon)
+            self.assertLessEqual(point_locator.stale_nodes, PRUNE_FRACTION * point_locator.node_count)
+        self.assertEqual(point_locator.trapezoids.trap_count(), 1)
+
+
+class TestSweepBuild(unittest.TestCase):
+    bounds = [10, 10, 790, 790]
+
+    def depth(self, node):
+        if not isinstance(node, Query):
+            return 0
+        return 1 + max(self.depth(node.true_child), self.depth(node.false_child))
+
+    def test_random(self):
+        for _ in range(20):
+            polygons = Polygons(Polygons.make_random(self.bounds, 100))
+            point_locator = build_point_locator(polygons.random_edge_sampler(), self.bounds)
+            for point in np.random.rand(200, 2) * 780 + 10:
+                trap = point_locator.trapezoids[point_locator.query(point)]
+                bottom, top = trap.extent(point[0])
+                self.assertTrue(bottom - 10**-6 <= point[1] <= top + 10**-6)
+
+            # Balanced over the slabs, then over the edges crossing the slab
+            edge_count = len(point_locator.segments)
+            self.assertLessEqual(self.depth(point_locator.tree_root), 1 + 3 * np.log2(2 * edge_count + 1))
+
+    def test_deterministic(self):
+        polygons = Polygons(Polygons.make_random(self.bounds, 60))
+        first = build_point_locator(polygons.random_edge_sampler(), self.bounds)
+        second = build_point_locator(polygons.random_edge_sampler(), self.bounds)
+        self.assertEqual([trap.tolist() for trap in first.traps()], [trap.tolist() for trap in second.traps()])
+
+    def test_update(self):
+        polygons = Polygons.make_random(self.bounds, 60)
+        # A polygon is added and another removed
+        while len(polygons) < 2:
+            polygons = Polygons.make_random(self.bounds, 60)
+        point_locator = build_point_locator(Polygons(polygons[1:]).random_edge_sampler(), self.bounds)
+        for edge in Polygons(polygons[:1]).random_edge_sampler():
+            point_locator.add_line(edge)
+        point_locator.remove_polygon(polygons[1])
+        for point in np.random.rand(200, 2) * 780 + 10:
+            trap = point_locator.trapezoids[point_locator.query(point)]
+            bottom, top = trap.extent(point[0])
+            self.assertTrue(bottom - 10**-6 <= point[1] <= top + 10**-6)
+
+
+class TestNeighborLinks(unittest.TestCase):
+    def check_links(self, trapezoids):
+        for trap in trapezoids.trapezoids:
+            if trap is None:
+                continue
+            for idx in trap.right_neighbors:
+                neighbor = trapezoids[idx]
+                self.assertIn(trap.index, neighbor.left_neighbors)
+                self.assertEqual(neighbor.leftp()[0], trap.rightp()[0])
+                self.assertLess(max(trap.walls[1][0], neighbor.walls[0][0]), min(trap.walls[1][1], neighbor.walls[0][1]))
+            for idx in trap.left_neighbors:
+                self.assertIn(trap.index, trapezoids[idx].right_neighbors)
+            bottoms = [trapezoids[idx].walls[0][0] for idx in trap.right_neighbors]
+            self.assertEqual(bottoms, sorted(bottoms))
+
+    def test_split(self):
+        point_locator = PointLocator([10, 10, 790, 790])
+        point_locator.add_line(np.array([[200, 100], [240, 30]]))
+        left = point_locator.query(np.array([100, 100]))
+        top = point_locator.query(np.array([220, 200]))
+        bottom = point_locator.query(np.array([220, 20]))
+        right = point_locator.query(np.array([500, 100]))
+        self.assertEqual(point_locator.trapezoids[left].upper_right, top)
+        self.assertEqual(point_locator.trapezoids[left].lower_right, bottom)
+        self.assertEqual(point_locator.trapezoids[top].upper_right, right)
+        self.assertEqual(point_locator.trapezoids[bottom].upper_right, right)
+        self.assertEqual(point_locator.trapezoids[right].left_neighbors, [bottom, top])
+        self.check_links(point_locator.trapezoids)
+
+    def test_random(self):
+        bounds = [10, 10, 790, 790]
+        for i in range(20):
+            compact = i % 2 == 1
+            polygons = Polygons.make_random(bounds, 60)
+            point_locator = PointLocator(bounds, compact)
+            for edge in Polygons(polygons).random_edge_sampler():
+                point_locator.add_line(edge)
+            self.check_links(point_locator.trapezoids)
+            point_locator.remove_polygon(polygons[0])
+            self.check_links(point_locator.trapezoids)
+            self.check_links(build_point_locator(Polygons(polygons).random_edge_sampler(), bounds, compact).trapezoids)
+
+
+class TestDepth(unittest.TestCase):
+    def test_tracked_depth(self):
+        bounds = [10, 10, 790, 790]
+        for _ in range(10):
+            polygons = Polygons.make_random(bounds, 60)
+            point_locator = PointLocator(bounds)
+            for edge in Polygons(polygons).random_edge_sampler():
+                point_locator.add_line(edge)
+            tracked = point_locator.max_depth
+            stats = point_locator.depth_stats()
+            self.assertEqual(tracked, stats["max_depth"])
+            self.assertLessEqual(stats["mean_depth"], stats["max_depth"])
+
+            point_locator.remove_polygon(polygons[0])
+            tracked = point_locator.max_depth
+            self.assertGreaterEqual(tracked, point_locator.depth_stats()["max_depth"])
+
+
+class TestTrapezoidStore(unittest.TestCase):
+    def test_neighbors(self):
+        store = TrapezoidStore(capacity=4)
+        for _ in range(8):
+            store.append(None)
+        rng = np.random.default_rng(0)
+        expected = {}
+        for _ in range(500):
+            idx, side = int(rng.integers(8)), int(rng.integers(2))
+            expected[idx, side] = rng.integers(0, 100, rng.integers(0, 6)).tolist()
+            store.set_neighbors(idx, side, expected[idx, side])
+        for (idx, side), neighbors in expected.items():
+            self.assertEqual(store.neighbors(idx, side), neighbors)
+        # The blocks that moved away are reclaimed, so the data stays near the live entries
+        self.assertLessEqual(len(store.neighbor_data), 4 * 8 * 2 * 2 * 6)
+
+    def test_view(self):
+        trapezoids = Trapezoids(compact=True)
+        trap = Trapezoid(np.array([[10, 10], [10, 20], [20, 40], [20, 5]]), [[20, 40], [10, 20]])
+        idx = trapezoids.add(trap)
+        view = trapezoids[idx]
+        self.assertIsInstance(view, TrapezoidView)
+        np.testing.assert_equal(view.raw(), trap.raw())
+        np.testing.assert_equal(view.top(), trap.top())
+        np.testing.assert_equal(view.bottom(), trap.bottom())
+        np.testing.assert_equal(view.leftp(), trap.leftp())
+        np.testing.assert_equal(view.rightp(), trap.rightp())
+        np.testing.assert_equal(view.originators, trap.originators)
+        self.assertTrue(view.includes_point(np.array([15, 15])))
+
+        view.add_parent("parent")
+        self.assertEqual(trapezoids[idx].parents, ["parent"])
+        trapezoids.pop(idx)
+        self.assertIsNone(trapezoids[idx])
+        self.assertEqual(trapezoids.add(trap), idx)
+        self.assertEqual(trapezoids[idx].parents, [])
+
+    def test_grow(self):
+        store = TrapezoidStore(capacity=2)
+        for i in range(10):
+            store.append(Trapezoid(np.array([[i, 0], [i, 1], [i + 1, 1], [i + 1, 0]]), []))
+        self.assertEqual(len(store), 10)
+        np.testing.assert_equal(store[7].leftp(), [7, 0])
+        self.assertGreater(store.nbytes(), 0)
+
+    def test_matches_objects(self):
+        bounds = [10, 10, 790, 790]
+        for _ in range(10):
+            polygons = Polygons.make_random(bounds, 60)
+            edges = list(Polygons(polygons).random_edge_sampler())
+            point_locator = PointLocator(bounds)
+            compact_locator = PointLocator(bounds, compact=True)
+            for edge in edges:
+                point_locator.add_line(edge)
+                compact_locator.add_line(edge)
+            compact_locator.remove_polygon(polygons[0])
+            point_locator.remove_polygon(polygons[0])
+            self.assertEqual([trap.tolist() for trap in point_locator.traps()],
+                             [trap.tolist() for trap in compact_locator.traps()])
+            points = np.random.rand(100, 2) * 780 + 10
+            np.testing.assert_equal(point_locator.query_many(points), compact_locator.query_many(points))
+
+
+class TestVectorizedChecks(unittest.TestCase):
+    bounds = [10, 10, 790, 790]
+
+    def test_matches_scalar(self):
+        for compact in (False, True):
+            polygons = Polygons(Polygons.make_random(self.bounds, 40))
+            point_locator = build_point_locator(polygons.random_edge_sampler(), self.bounds, compact)
+            trapezoids = point_locator.trapezoids
+            indices = [trap.index for trap in trapezoids.trapezoids if trap is not None]
+            for edge in list(polygons.random_edge_sampler())[:20]:
+                edge = make_lr(edge)
+                expected = [trapezoids[idx].is_intersected(edge) for idx in indices]
+                self.assertEqual(intersected_mask(*trapezoids.line_arrays(indices), edge).tolist(), expected)
+                self.assertEqual(trapezoids.intersected_by(edge, indices).tolist(), expected)
+                self.assertEqual(trapezoids.intersected_by(edge, indices[:MIN_BLOCK - 1]).tolist(),
+                                 expected[:MIN_BLOCK - 1])
+
+            points = np.random.rand(50, 2) * 780 + 10
+            for idx in indices[:20]:
+                trap = trapezoids[idx]
+                self.assertEqual(trap.includes_points(points).tolist(), [trap.includes_point(p) for p in points])
+                self.assertEqual(trap.includes_points(points, loose=True).tolist(),
+                                 [trap.includes_point_loose(p) for p in points])
+
+    def test_misplaced(self):
+        polygons = Polygons.make_random(self.bounds, 40)
+        point_locator = PointLocator(self.bounds)
+        for edge in Polygons(polygons).random_edge_sampler():
+            point_locator.add_line(edge)
+        points = np.random.rand(500, 2) * 780 + 10
+        self.assertEqual(len(point_locator.misplaced(points)), 0)
+        self.assertEqual(point_locator.misplaced([[0, 0]]).tolist(), [0])
+
+
+class TestHintedQuery(unittest.TestCase):
+    bounds = [10, 10, 790, 790]
+
+    def test_trajectory(self):
+        for compact in (False, True):
+            polygons = Polygons(Polygons.make_random(self.bounds, 60))
+            point_locator = PointLocator(self.bounds, compact)
+            for edge in polygons.random_edge_sampler():
+                point_locator.add_line(edge)
+            trajectory = np.clip(np.cumsum(np.random.randn(500, 2) * 3, axis=0) + 400, 11, 789)
+            expected = [point_locator.query(p) for p in trajectory]
+            self.assertEqual(list(point_locator.locate_trajectory(trajectory)), expected)
+
+    def test_bad_hint(self):
+        point_locator = PointLocator(self.bounds)
+        point_locator.add_line(np.array([[200, 100], [240, 30]]))
+        point = np.array([300, 300])
+        expected = point_locator.query(point)
+        for hint in [None, -1, 1000, 0, expected]:
+            self.assertEqual(point_locator.query_from(hint, point), expected)
+        point_locator.trapezoids.pop(0)
+        self.assertEqual(point_locator.query_from(0, point), expected)
+
+
+class TestOccupancy(unittest.TestCase):
+    bounds = [10, 10, 790, 790]
+
+    def check_labels(self, point_locator, polygons):
+        for trap in point_locator.trapezoids.trapezoids:
+            if trap is not None:
+                self.assertEqual(trap.occupant >= 0, polygons.contains_trap(trap))
+
+    def test_labels(self):
+        for compact in (False, True):
+            polygons = Polygons.make_random(self.bounds, 60)
+            point_locator = PointLocator(self.bounds, compact)
+            for edge, polygon, interior_above in Polygons(polygons).random_edge_sampler(labels=True):
+                point_locator.add_line(edge, polygon, interior_above)
+            self.check_labels(point_locator, Polygons(polygons))
+            self.check_labels(build_point_locator(Polygons(polygons).random_edge_sampler(labels=True), self.bounds,
+                                                  compact, labels=True), Polygons(polygons))
+            point_locator.remove_polygon(polygons[0])
+            self.check_labels(point_locator, Polygons(polygons[1:]))
+
+    def test_remove_occupied(self):
+        polygons = Polygons(Polygons.make_random(self.bounds, 60))
+        point_locator = PointLocator(self.bounds)
+        for edge, polygon, interior_above in polygons.random_edge_sampler(labels=True):
+            point_locator.add_line(edge, polygon, interior_above)
+        expected = [trap.index for trap in point_locator.trapezoids.trapezoids
+                    if trap is not None and not polygons.contains_trap(trap)]
+        point_locator.remove_occupied_traps()
+        self.assertEqual([trap.index for trap in point_locator.trapezoids.trapezoids if trap is not None], expected)
@@ -1,5 +1,7 @@
 from src.structures import *
+from src.trapezoids import Trapezoid
 import unittest
+import random
 import numpy as np
 
 class TestPolygonCounter(unittest.TestCase):
@@ -49,3 +51,216 @@ class TestPolygonCounter(unittest.TestCase):
     #                       [400, 200]])
     #    vehicle = Polygon(square)
     #    np.assertEqual(edges[0], np.array([edges]))
+
+
+
+class TestBatchedLineUtils(unittest.TestCase):
+    def test_matches_scalar(self):
+        edges = np.random.rand(100, 2, 2) * 100
+        # Some vertical edges
+        edges[:10, 1, 0] = edges[:10, 0, 0]
+        lr_edges = make_lr_many(edges)
+        for edge, lr_edge in zip(edges, lr_edges):
+            np.testing.assert_equal(lr_edge, make_lr(edge))
+        np.testing.assert_equal(normals(edges), [normal(edge) for edge in edges])
+        np.testing.assert_equal(slopes(lr_edges[10:]), [slope(edge) for edge in lr_edges[10:]])
+        self.assertTrue(np.isnan(slopes(lr_edges[:10])).all())
+
+        # Mostly within the edges, some just outside
+        xs = lr_edges[:, 0, 0] + (np.random.rand(100) * 1.2 - 0.1) * (lr_edges[:, 1, 0] - lr_edges[:, 0, 0])
+        ys, in_range = interpolate_edges(lr_edges[10:], xs[10:])
+        np.testing.assert_equal(np.where(in_range, ys, -1000000000),
+                                [linear_interpolation(edge, x) for edge, x in zip(lr_edges[10:], xs[10:])])
+
+        points = np.stack([xs, np.full(100, 50.0)], axis=1)
+        points[10:, 1] = np.where(in_range, ys, 50.0)
+        points[::3, 1] += 1
+        np.testing.assert_equal(points_on_edges(lr_edges, points),
+                                [point_on_edge(edge, point) for edge, point in zip(lr_edges, points)])
+
+    def test_contains_trap(self):
+        polygons = Polygons([np.array([[100, 100], [200, 100], [200, 200], [100, 200]]),
+                             np.array([[300, 300], [400, 320], [350, 400]])])
+        self.assertTrue(polygons.contains_trap(Trapezoid(np.array([[100, 100], [100, 200], [200, 200], [200, 100]]), [])))
+        self.assertTrue(polygons.contains_trap(Trapezoid(np.array([[300, 300], [350, 400], [350, 310]]), [])))
+        self.assertFalse(polygons.contains_trap(Trapezoid(np.array([[100, 100], [100, 200], [150, 300], [150, 50]]), [])))
+        # The trapezoids around a hole are in the polygon, the one filling it is not
+        outline = np.array([[0, 0], [300, 0], [300, 300], [0, 300]])
+        hole = np.array([[100, 100], [100, 200], [200, 200], [200, 100]])
+        polygons = Polygons(PolygonSet.from_polygons([outline, hole], [False, True]))
+        self.assertTrue(polygons.contains_trap(Trapezoid(np.array([[0, 0], [0, 300], [100, 300], [100, 0]]), [])))
+        self.assertTrue(polygons.contains_trap(Trapezoid(np.array([[100, 0], [100, 100], [200, 100], [200, 0]]), [])))
+        self.assertFalse(polygons.contains_trap(Trapezoid(np.array([[100, 100], [100, 200], [200, 200], [200, 100]]), [])))
+
+
+class TestPolygonIndex(unittest.TestCase):
+    def test_query(self):
+        for count in [0, 1, 7, 100]:
+            low = np.random.rand(count, 2) * 700
+            boxes = np.concatenate([low, low + np.random.rand(count, 2) * 100], axis=1)
+            index = PolygonIndex(boxes, node_size=4)
+            for _ in range(50):
+                corner = np.random.rand(2) * 700
+                query_low, query_high = corner, corner + np.random.rand(2) * 50
+                overlap = ((boxes[:, 0] <= query_high[0]) & (boxes[:, 2] >= query_low[0]) &
+                           (boxes[:, 1] <= query_high[1]) & (boxes[:, 3] >= query_low[1]))
+                contain = ((boxes[:, 0] <= query_low[0]) & (boxes[:, 2] >= query_high[0]) &
+                           (boxes[:, 1] <= query_low[1]) & (boxes[:, 3] >= query_high[1]))
+                np.testing.assert_equal(index.query(query_low, query_high), np.flatnonzero(overlap))
+                np.testing.assert_equal(index.query(query_low, query_high, containing=True), np.flatnonzero(contain))
+
+    def test_polygon_at(self):
+        polygons = Polygons([np.array([[100, 100], [200, 100], [200, 200], [100, 200]]),
+                             np.array([[300, 300], [400, 320], [350, 400]])])
+        self.assertEqual(polygons.polygon_at([150, 150]), 0)
+        self.assertEqual(polygons.polygon_at([200, 150]), 0)
+        self.assertEqual(polygons.polygon_at([350, 310]), 1)
+        self.assertEqual(polygons.polygon_at([350, 350]), 1)
+        self.assertIsNone(polygons.polygon_at([250, 250]))
+        self.assertIsNone(polygons.polygon_at([310, 390]))
+
+
+class TestMergeIntersecting(unittest.TestCase):
+    def test_split(self):
+        edges = np.random.rand(80, 2, 2) * 100
+        points_on = split_at_intersections(edges)
+        for i, edge in enumerate(edges):
+            self.assertEqual(points_on[i][0], tuple(edge[0]))
+            self.assertEqual(points_on[i][-1], tuple(edge[1]))
+            for j, other in enumerate(edges[:i]):
+                # Crossing: the endpoints of each are on both sides of the other
+                sides = [(a[1, 0] - a[0, 0]) * (b[1] - a[0, 1]) - (a[1, 1] - a[0, 1]) * (b[0] - a[0, 0])
+                         for a, c in ((edge, other), (other, edge)) for b in c]
+                crossing = sides[0] * sides[1] < 0 and sides[2] * sides[3] < 0
+                self.assertEqual(crossing, len(set(points_on[i]) & set(points_on[j])) == 1)
+
+    def test_squares(self):
+        square = np.array([[0, 0], [100, 0], [100, 100], [0, 100]], dtype=float)
+        # Overlapping, touching along an edge, and apart
+        outlines = Polygons([square, square + 50, square + [100, 0], square + 500]).merge_intersecting()
+        self.assertEqual(len(outlines), 2)
+        self.assertAlmostEqual(signed_area(outlines[0]), 200 * 100 + 100 * 50)
+        np.testing.assert_equal(outlines[1], square + 500)
+        # A ring of rectangles has a hole, filled only if asked
+        ring = [np.array([[0, 0], [300, 0], [300, 100], [0, 100]], dtype=float)]
+        ring.append(ring[0] + [0, 200])
+        ring.append(np.array([[0, 0], [100, 0], [100, 300], [0, 300]], dtype=float))
+        ring.append(ring[2] + [200, 0])
+        outlines = Polygons(ring).merge_intersecting()
+        np.testing.assert_equal(outlines.holes, [False, True])
+        self.assertEqual(len(outlines[1]), 4)
+        self.assertAlmostEqual(signed_area(outlines[0]), 300 * 300)
+        self.assertAlmostEqual(signed_area(outlines[1]), -100 * 100)
+        self.assertIsNone(Polygons(outlines).polygon_at([150, 150]))
+        self.assertEqual(Polygons(outlines).polygon_at([50, 150]), 0)
+        outlines = Polygons(ring).merge_intersecting(fill_holes=True)
+        self.assertEqual(len(outlines), 1)
+        self.assertEqual(len(outlines[0]), 4)
+        self.assertAlmostEqual(signed_area(outlines[0]), 300 * 300)
+
+    def test_random(self):
+        polygons = []
+        for _ in range(30):
+            center = np.random.rand(2) * 600 + 100
+            radius = np.random.rand() * 80 + 10
+            polygons.append(Polygons.make_convex(8, np.array([center - radius, center + radius])))
+        outlines = Polygons(polygons).merge_intersecting()
+        self.assertLessEqual(np.count_nonzero(~outlines.holes), len(polygons))
+        points = np.random.rand(5000, 2) * 800
+        inside = np.array([Path(polygon).contains_points(points) for polygon in polygons]).any(axis=0)
+        in_outline = np.array([Path(outline).contains_points(points) for outline in outlines]).reshape(-1, len(points))
+        # A point in a hole is in it and in the outline around it
+        np.testing.assert_equal(in_outline.sum(axis=0) % 2 == 1, inside)
+
+    def test_near_walls(self):
+        # Walls 0.0004 apart are one wall, under the tolerance of a scene 6000 across
+        left = np.array([[0, 0], [100.0004, 0], [100.0004, 10], [0, 10]])
+        right = np.array([[100, 9.5], [200, 9.5], [200, 20], [100, 20]])
+        far = np.array([[5900, 5900], [6000, 5900], [6000, 6000]])
+        outlines = Polygons([left, right, far]).merge_intersecting()
+        self.assertEqual(len(outlines), 2)
+        self.assertAlmostEqual(signed_area(outlines[0]), 100 * 10 + 100 * 10.5, places=2)
+
+    def test_near_crossing(self):
+        # Two edges cross 0.000005 left of a wall, which meets them at that crossing
+        polygons = [np.array([[687.8844292249336, 82.47145883428456], [688.06985877999, 72.31899145499648],
+                              [688.06985877999, 30.938353332437877], [605.3085825348728, 30.938353332437877],
+                              [602.058480586363, 37.78389806545354], [602.058480586363, 79.16453618801214],
+                              [602.118266442778, 79.36617853860804], [604.406788189185, 82.23042751052292],
+                              [605.1231529798164, 82.47145883428456]]),
+                    np.array([[595.7591518534848, 55.11994514569861], [602.6135729707772, 53.20140233172002],
+                              [602.6135729707772, 11.820764209161425], [602.5553204188842, 11.10485654615617],
+                              [519.794044173767, 11.10485654615617], [512.6957301634419, 12.278185627541141],
+                              [512.6957301634419, 53.658823750099735], [512.9978756083676, 55.11994514569861]]),
+                    np.array([[617.3296422304397, 85.50192477825706], [617.4808642107657, 85.25596974272301],
+                              [618.1299771611808, 83.08394170864884], [618.1299771611808, 41.703303586090236],
+                              [618.0340007501219, 39.31076587120366], [617.9458038639316, 38.93126972246437],
+                              [615.8253705036502, 36.61474306503965], [533.064094258533, 36.61474306503965],
+                              [531.9296958391119, 37.359253566978786], [531.7115606497883, 37.68641640712057],
+                              [531.7115606497883, 79.06705452967915], [534.5683659853225, 85.50192477825706]]),
+                    np.array([[800, 800], [801, 800], [800, 801]], dtype=float)]
+        outlines = Polygons(polygons).merge_intersecting()
+        self.assertEqual(len(outlines), 2)
+        points = np.random.rand(5000, 2) * [180, 80] + [510, 10]
+        inside = np.array([Path(polygon).contains_points(points) for polygon in polygons]).any(axis=0)
+        np.testing.assert_equal(Path(outlines[0]).contains_points(points), inside)
+
+
+class TestRandomScene(unittest.TestCase):
+    bounds = [10, 10, 790, 790]
+
+    def test_scene(self):
+        polygons = Polygons.make_random_scene(self.bounds, 400, np.random.default_rng(0), max_polygon_vertices=6)
+        counts = np.array([len(polygon) for polygon in polygons])
+        self.assertGreaterEqual(counts.sum(), 398)
+        self.assertLessEqual(counts.sum(), 400)
+        self.assertTrue(((counts >= 3) & (counts <= 6)).all())
+        vertices = np.concatenate(polygons)
+        self.assertTrue(((vertices > 10) & (vertices < 790)).all())
+        for polygon in polygons:
+            self.assertGreater(signed_area(polygon), 0)
+        # Convex and apart, so the union is the polygons themselves
+        self.assertEqual(len(Polygons(polygons).merge_intersecting()), len(polygons))
+
+    def test_seeded(self):
+        first = Polygons.make_random_scene(self.bounds, 1000, np.random.default_rng(3))
+        second = Polygons.make_random_scene(self.bounds, 1000, np.random.default_rng(3))
+        counts, chunks = Polygons.random_scene(self.bounds, 1000, np.random.default_rng(3), chunk_polygons=7)
+        np.testing.assert_equal(np.concatenate(first), np.concatenate(second))
+        np.testing.assert_equal(np.concatenate(first), np.concatenate(list(chunks)))
+        np.testing.assert_equal([len(polygon) for polygon in first], counts)
+        third = Polygons.make_random_scene(self.bounds, 1000, np.random.default_rng(4))
+        self.assertFalse(np.array_equal(np.concatenate(first)[:10], np.concatenate(third)[:10]))
+
+
+class TestPolygonSet(unittest.TestCase):
+
+    def test_layout(self):
+        square = np.array([[0, 0], [10, 0], [10, 10], [0, 10]])
+        triangle = np.array([[20, 20], [20, 30], [30, 20]])
+        polygons = PolygonSet.from_polygons([square, triangle])
+        self.assertEqual(len(polygons), 2)
+        np.testing.assert_equal(polygons.offsets, [0, 4, 7])
+        np.testing.assert_equal(polygons[-1], triangle)
+        np.testing.assert_equal(polygons.polygon_edges(1)[2], [[30, 20], [20, 20]])
+        np.testing.assert_equal(polygons.edge_polygon, [0, 0, 0, 0, 1, 1, 1])
+        np.testing.assert_equal(polygons.boxes, [[0, 0, 10, 10], [20, 20, 30, 30]])
+        np.testing.assert_equal(polygons.counterclockwise, [True, False])
+        np.testing.assert_equal(polygons[1:][0], triangle)
+        with self.assertRaises(IndexError):
+            polygons[2]
+        with self.assertRaises(ValueError):
+            PolygonSet(square, [0, 2])
+
+    def test_same_as_list(self):
+        polygons = Polygons.make_random_scene([10, 10, 790, 790], 300, np.random.default_rng(1))
+        self.assertIsInstance(polygons, PolygonSet)
+        as_list = [np.array(polygon) for polygon in polygons]
+        random.seed(2)
+        from_set = list(Polygons(polygons).random_edge_sampler(labels=True))
+        random.seed(2)
+        from_list = list(Polygons(as_list).random_edge_sampler(labels=True))
+        for (edge, polygon, above), (other, other_polygon, other_above) in zip(from_set, from_list):
+            np.testing.assert_equal(edge, other)
+            self.assertEqual((polygon, above), (other_polygon, other_above))
+        np.testing.assert_equal(Polygons(polygons).index.boxes, Polygons(as_list).index.boxes)